@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import tempfile
+from importlib import import_module
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.six import string_types
+
+from staticpreprocessor.compat import setting_changed
+
+
+_compile_cache = []
+
+
+class BaseCompileCache(object):
+    '''
+    A cache of compiled processor output, keyed by a hash of the processor's
+    command and the contents of its inputs.
+    '''
+
+    def get(self, key):
+        '''
+        Returns the cached content for ``key`` as bytes, or ``None``.
+        '''
+        raise NotImplementedError()
+
+    def set(self, key, content):
+        '''
+        Stores the bytes ``content`` against ``key``.
+        '''
+        raise NotImplementedError()
+
+
+class DjangoCompileCache(BaseCompileCache):
+    '''
+    Stores compiled output in one of the caches configured in the ``CACHES``
+    setting, so that it can be shared through e.g. memcached or redis.
+    '''
+
+    def __init__(self, alias='default', timeout=None,
+                 key_prefix='staticpreprocessor'):
+        self.alias = alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        try:
+            from django.core.cache import caches
+        except ImportError:  # Django < 1.7
+            from django.core.cache import get_cache
+            return get_cache(self.alias)
+        return caches[self.alias]
+
+    def make_key(self, key):
+        return '{0}:{1}'.format(self.key_prefix, key)
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    def set(self, key, content):
+        self.cache.set(self.make_key(key), content, self.timeout)
+
+
+class FileSystemCompileCache(BaseCompileCache):
+    '''
+    Stores compiled output as files below ``location``, which may be a
+    directory shared between machines.
+    '''
+
+    def __init__(self, location):
+        self.location = location
+
+    def path(self, key):
+        return os.path.join(self.location, key[:2], key[2:])
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, content):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+        # Write to a temporary file and move it into place so that other
+        # readers never see a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+
+def get_compile_cache():
+    '''
+    Returns the compile cache described by the ``STATIC_PREPROCESSOR_CACHE``
+    setting, or ``None`` if no cache is configured.
+
+    The setting may be a cache instance, a dotted path to a cache class or a
+    tuple of a dotted path and a dictionary of keyword arguments.
+    '''
+    from staticpreprocessor.conf import settings
+    if _compile_cache:
+        return _compile_cache[0]
+    cache = settings.STATIC_PREPROCESSOR_CACHE
+    if cache is not None and not isinstance(cache, BaseCompileCache):
+        try:
+            if isinstance(cache, (tuple, list)):
+                klass, kwargs = cache[0], cache[1]
+            else:
+                klass, kwargs = cache, {}
+            if isinstance(klass, string_types):
+                module, attr = klass.rsplit('.', 1)
+                klass = getattr(import_module(module), attr)
+            cache = klass(**kwargs)
+        except (IndexError, TypeError, ValueError,
+                ImportError, AttributeError):
+            raise ImproperlyConfigured(
+                '"{0}" is an invalid compile cache'.format(cache))
+    _compile_cache.append(cache)
+    return cache
+
+
+def _settings_changed(setting, **kwargs):
+    if setting in ('STATIC_PREPROCESSOR_CACHE', 'CACHES'):
+        del _compile_cache[:]
+setting_changed.connect(_settings_changed)
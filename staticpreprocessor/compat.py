@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+from importlib import import_module
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # Django < 1.8
+    from django.test.signals import setting_changed  # noqa
+
+try:
+    from django.apps import apps
+except ImportError:  # Django < 1.7
+    apps = None
+
+
+def get_installed_apps():
+    '''
+    Returns a list of ``(name, path)`` pairs for the installed apps, where
+    ``path`` is the app's directory.
+    '''
+    if apps is not None:
+        return [
+            (app_config.name, app_config.path)
+            for app_config in apps.get_app_configs()
+        ]
+    from django.conf import settings
+    installed_apps = []
+    for app_name in settings.INSTALLED_APPS:
+        module = import_module(app_name)
+        installed_apps.append(
+            (app_name, os.path.dirname(os.path.abspath(module.__file__))))
+    return installed_apps
@@ -18,6 +18,17 @@ class StaticPreprocessorAppConf(AppConf):
     FINDERS = []
     PROCESSORS = []
     DIRS = []
+    IGNORE_PATTERNS = []
+    CACHE = None
+    STATE_FILE = None
+    BUDGET_REGRESSION = None
+    BUDGET_MIN_DELTA = {'size': 0, 'gzip_size': 0, 'duration': 1.0}
+    STRICT_BUDGETS = False
+    REMOTE_STORAGE = None
+    SYNC_WORKERS = None
+    DEDUPLICATE = False
+    VARIANTS = {}
+    VERSION_TIMEOUT = 10
 
     class Meta:
         prefix = 'static_preprocessor'
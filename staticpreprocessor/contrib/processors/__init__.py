@@ -1 +1,19 @@
 # -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+
+# The extensions each contrib processor operates on by default, so that the
+# processors can be skipped without being imported when nothing matches.
+# Each entry must match the ``extensions`` of the class it names.
+EXTENSIONS = {
+    'staticpreprocessor.contrib.processors.handlebars.HandlebarsProcessor':
+        ['.handlebars'],
+    'staticpreprocessor.contrib.processors.images.JPEGProcessor':
+        ['.jpg', '.jpeg'],
+    'staticpreprocessor.contrib.processors.images.PNGProcessor': ['.png'],
+    'staticpreprocessor.contrib.processors.images.WebPProcessor':
+        ['.png', '.jpg', '.jpeg'],
+    'staticpreprocessor.contrib.processors.less.LessProcessor': ['.less'],
+    'staticpreprocessor.contrib.processors.sass.SassProcessor':
+        ['.sass', '.scss'],
+}
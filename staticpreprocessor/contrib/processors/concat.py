@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import fnmatch
+import json
+import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile, File
+
+from staticpreprocessor.processors import BaseListProcessor
+from staticpreprocessor.utils import is_local_storage
+
+
+class ConcatProcessor(BaseListProcessor):
+    '''
+    Concatenates the processed files into :py:attr:`output`, streaming each
+    one through a buffer of :py:attr:`buffer_size` bytes so that memory use
+    doesn't grow with the size of the files.
+
+    Files are ordered by the first of the :py:attr:`order` patterns they
+    match, then by path, so the output is the same on every run. A
+    :py:attr:`banner` can be written before each file and a
+    :py:attr:`separator` between files, and a JSON :py:attr:`index` of where
+    each file starts in the output can be written for source mapping.
+
+    In a local storage the output is written to a temporary file beside it
+    that replaces it once complete; in other storages it is spooled to a
+    temporary file and then saved through the storage.
+    '''
+
+    output = ''
+    # Glob-type patterns, relative to the storage, giving the order of the
+    # files; files matching none of them come last
+    order = None
+    # Written between consecutive files
+    separator = ''
+    # Written before each file, formatted with its ``name``
+    banner = ''
+    # The path to write the index of offsets in the output to, if any
+    index = None
+    buffer_size = 64 * 1024
+    require_input = True
+
+    def get_outputs(self):
+        outputs = [self.output] if self.output else []
+        if self.index:
+            outputs.append(self.index)
+        return outputs
+
+    def get_name(self, file):
+        '''
+        Returns the ``/``-separated path of ``file`` relative to the storage.
+        '''
+        return self.get_storage_name(file).replace(os.sep, '/')
+
+    def sort_files(self, file_list):
+        '''
+        Returns ``(name, file)`` pairs for ``file_list`` in the order they
+        are to be concatenated.
+        '''
+        patterns = list(self.order or ())
+
+        def key(item):
+            name = item[0]
+            for position, pattern in enumerate(patterns):
+                if fnmatch.fnmatch(name, pattern):
+                    return position, name
+            return len(patterns), name
+        return sorted(((self.get_name(f), f) for f in file_list), key=key)
+
+    def write_files(self, output, files):
+        '''
+        Writes the ``(name, file)`` pairs in ``files`` to the file object
+        ``output``, and returns the index entry of each.
+        '''
+        separator = self.separator.encode('utf-8')
+        entries = []
+        offset = 0
+        # Newlines written so far, giving the line each file starts on
+        lines = 0
+        for position, (name, file) in enumerate(files):
+            prefix = separator if position else b''
+            if self.banner:
+                prefix += self.banner.format(name=name).encode('utf-8')
+            output.write(prefix)
+            offset += len(prefix)
+            lines += prefix.count(b'\n')
+            entry = {'name': name, 'offset': offset, 'line': lines + 1}
+            with self.storage.open(file) as f:
+                for chunk in iter(lambda: f.read(self.buffer_size), b''):
+                    output.write(chunk)
+                    offset += len(chunk)
+                    lines += chunk.count(b'\n')
+            entry['length'] = offset - entry['offset']
+            entries.append(entry)
+            self.report_progress(file, entry['length'])
+        return entries
+
+    def handle_list(self, file_list, **kwargs):
+        if not self.output:
+            raise ImproperlyConfigured(
+                'ConcatProcessor requires an output to write to')
+        outputs = set(self.get_storage_name(o) for o in self.get_outputs())
+        files = self.sort_files(
+            f for f in file_list if self.get_storage_name(f) not in outputs)
+        if is_local_storage(self.storage):
+            path = self.storage.path(self.output)
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as output:
+                    entries = self.write_files(output, files)
+                os.rename(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            mode = getattr(self.storage, 'file_permissions_mode', None)
+            os.chmod(path, 0o644 if mode is None else mode)
+        else:
+            with tempfile.TemporaryFile() as output:
+                entries = self.write_files(output, files)
+                output.seek(0)
+                if self.storage.exists(self.output):
+                    self.storage.delete(self.output)
+                self.storage.save(self.output, File(output, self.output))
+        if self.index:
+            content = json.dumps(
+                {'output': self.output, 'files': entries}, indent=2,
+                sort_keys=True)
+            if self.storage.exists(self.index):
+                self.storage.delete(self.index)
+            self.storage.save(self.index, ContentFile(content.encode('utf-8')))
@@ -1,12 +1,130 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import fnmatch
+import os
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from django.core.files.base import ContentFile
+
+from staticpreprocessor.cache import get_compile_cache
 from staticpreprocessor.processors import CommandListProcessor
 
 
 class HandlebarsProcessor(CommandListProcessor):
+    '''
+    Precompiles Handlebars templates one at a time, caching each compiled
+    template by its content, and concatenates them into one or more bundles.
+
+    A :py:attr:`command` that writes its own ``{output}``, as this processor
+    used to take, is instead run once for each bundle, on all of its
+    templates.
+    '''
 
-    command = 'handlebars {input} --output {output} '\
-              '--known each --known if --known unless'
     extensions = ['.handlebars']
     output = 'handlebars_templates.js'
+    version_command = 'handlebars --version'
+    # Used if no command is given; it writes the template to standard output
+    default_command = 'handlebars {input}{known_string}{namespace_string}'
+    known_helpers = ['each', 'if', 'unless']
+    # The template namespace, or a dictionary mapping bundle outputs to the
+    # namespace of each
+    namespace = None
+    # Maps output paths to glob-type patterns matching the templates, relative
+    # to the storage, that go into each bundle
+    bundles = None
+    # The number of templates to compile at once; defaults to the CPU count
+    workers = None
+
+    def __init__(self, **kwargs):
+        super(HandlebarsProcessor, self).__init__(**kwargs)
+        # Compiled templates, keyed by cache key
+        self.compiled = {}
+
+    def get_namespace(self, output):
+        '''
+        Returns the namespace of the templates in the bundle ``output``.
+        '''
+        if isinstance(self.namespace, dict):
+            return self.namespace.get(output)
+        return self.namespace
+
+    def get_command(self, **kwargs):
+        '''
+        Returns :py:attr:`command`, or :py:attr:`default_command` if it isn't
+        set, formatted with ``known_string`` and ``namespace_string``, the
+        options for the known helpers and for the ``namespace`` keyword
+        argument, defaulting to :py:attr:`namespace` if it is a string.
+        '''
+        namespace = kwargs.pop('namespace', self.namespace)
+        if isinstance(namespace, dict):
+            namespace = None
+        kwargs.update({
+            'known_string': ''.join(
+                ' --known {0}'.format(h) for h in self.known_helpers),
+            'namespace_string': (
+                ' --namespace {0}'.format(namespace) if namespace else ''),
+        })
+        return (self.command or self.default_command).format(**kwargs)
+
+    def get_bundles(self):
+        return self.bundles or {self.output: '*'}
+
+    def get_outputs(self):
+        return list(self.get_bundles())
+
+    def compile_template(self, file, **kwargs):
+        '''
+        Returns the precompiled JavaScript for the template ``file``, from the
+        cache if it has been compiled before.
+        '''
+        cache = get_compile_cache() if self.use_cache else None
+        key = self.get_cache_key(file, output='', stdout=True, **kwargs)
+        if key is None:
+            return self.get_command_output(file, **kwargs)
+        if key in self.compiled:
+            return self.compiled[key]
+        content = cache.get(key) if cache is not None else None
+        if content is None:
+            content = self.get_command_output(file, **kwargs)
+            if cache is not None:
+                cache.set(key, content)
+        self.compiled[key] = content
+        return content
+
+    def handle_list(self, file_list, **kwargs):
+        file_list = sorted(file_list)
+        if not file_list:
+            return
+        kwargs.pop('output', None)
+        kwargs.pop('namespace', None)
+        root = self.storage.path('')
+        bundles = [
+            (output, self.get_namespace(output), [
+                f for f in file_list
+                if fnmatch.fnmatch(os.path.relpath(f, root), pattern)])
+            for output, pattern in sorted(self.get_bundles().items())
+        ]
+        if '{output}' in self.command:
+            for output, namespace, files in bundles:
+                self.run_command(
+                    ' '.join(files), files=files, output=output,
+                    namespace=namespace, **kwargs)
+            return
+        # Each template is compiled once for each namespace it is used in
+        jobs = list(OrderedDict.fromkeys(
+            (file, namespace)
+            for output, namespace, files in bundles for file in files))
+        pool = ThreadPool(min(self.workers or cpu_count(), len(jobs) or 1))
+        try:
+            fragments = dict(zip(jobs, pool.map(
+                lambda job: self.compile_template(
+                    job[0], namespace=job[1], **kwargs), jobs)))
+        finally:
+            pool.close()
+            pool.join()
+        for output, namespace, files in bundles:
+            content = b''.join(fragments[(f, namespace)] for f in files)
+            self.storage.save(output, ContentFile(content))
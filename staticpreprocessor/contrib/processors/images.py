@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import shlex
+import shutil
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+from django.core.files.base import ContentFile
+from django.utils.six.moves import zip
+
+from staticpreprocessor.cache import get_compile_cache
+from staticpreprocessor.processors import (
+    BaseFileProcessor, CommandLimitsMixin, CommandRunner,
+)
+from staticpreprocessor.utils import file_hash
+
+
+class CommandEncoder(object):
+    '''
+    Encodes image content by running ``command`` on a temporary copy of it.
+
+    ``command`` is formatted with ``input``, the path of the copy, and
+    ``output``, the path the command should write its result to. Commands
+    that have no output option may modify ``input`` in place instead. The
+    command is run by ``runner``, a
+    :py:class:`~staticpreprocessor.processors.CommandRunner` applying the
+    processor's limits.
+    '''
+
+    def __init__(self, command, suffix='', output_suffix=None, runner=None):
+        self.command = command
+        self.suffix = suffix
+        self.output_suffix = output_suffix or suffix
+        self.runner = runner or CommandRunner()
+
+    def __repr__(self):
+        return 'CommandEncoder({0!r})'.format(self.command)
+
+    def __call__(self, content):
+        directory = tempfile.mkdtemp()
+        try:
+            input = os.path.join(directory, 'input' + self.suffix)
+            output = os.path.join(directory, 'output' + self.output_suffix)
+            with open(input, 'wb') as f:
+                f.write(content)
+            command = self.command.format(input=input, output=output)
+            self.runner.call(shlex.split(command))
+            if not os.path.exists(output):
+                output = input
+            with open(output, 'rb') as f:
+                return f.read()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def _encode(args):
+    encoder, path = args
+    with open(path, 'rb') as f:
+        return encoder(f.read())
+
+
+class BaseImageProcessor(CommandLimitsMixin, BaseFileProcessor):
+    '''
+    Base class for processors that re-encode images.
+
+    Images are encoded across a pool of worker processes, each of which is
+    sent only the path of the image and reads it itself. Each result is
+    stored in the compile cache, if one is configured, keyed by a hash of
+    the processor's fingerprint, the encoder and the image's content, so
+    unchanged images are never re-encoded. Identical images are only
+    encoded once per run.
+    '''
+
+    remove_processed_files = False
+    # The number of worker processes; defaults to the CPU count
+    workers = None
+    use_cache = True
+    # Whether results larger than the original image should be discarded
+    only_if_smaller = True
+
+    def get_encoder(self):
+        '''
+        Returns a picklable callable that takes and returns image content as
+        bytes.
+        '''
+        raise NotImplementedError()
+
+    def get_output_name(self, file):
+        '''
+        Returns the name to save the encoded version of ``file`` as.
+        Defaults to ``file``, i.e. images are replaced.
+        '''
+        return file
+
+    def get_cache_key(self, encoder, digest):
+        '''
+        Returns the cache key for the result of ``encoder`` on an image
+        whose content has the hex SHA1 ``digest``.
+        '''
+        encoder_name = getattr(encoder, '__name__', None) or repr(encoder)
+        key = hashlib.sha1()
+        key.update('{0}\n{1}.{2}\n'.format(
+            self.get_fingerprint(), getattr(encoder, '__module__', ''),
+            encoder_name,
+        ).encode('utf-8'))
+        key.update(digest.encode('ascii'))
+        return key.hexdigest()
+
+    def encode(self, encoder, paths):
+        '''
+        Yields the encoded version of each of the images at ``paths``, in
+        order, as the workers finish them.
+        '''
+        workers = min(self.workers or cpu_count(), len(paths))
+        if workers <= 1:
+            for path in paths:
+                yield _encode((encoder, path))
+            return
+        pool = Pool(workers)
+        try:
+            for result in pool.imap(_encode, [(encoder, p) for p in paths]):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def handle_list(self, file_list, **kwargs):
+        encoder = self.get_encoder()
+        cache = get_compile_cache() if self.use_cache else None
+        # Maps the key of each image content that needs encoding to the files
+        # with that content, so that duplicate images are only encoded once
+        pending = OrderedDict()
+        for file in sorted(file_list):
+            key = self.get_cache_key(
+                encoder, file_hash(self.storage.path(file)))
+            if key in pending:
+                pending[key].append(file)
+                continue
+            result = cache.get(key) if cache is not None else None
+            if result is None:
+                pending[key] = [file]
+            else:
+                self.handle_result(file, result)
+        encoded = self.encode(encoder, [
+            self.storage.path(files[0]) for files in pending.values()])
+        for (key, files), result in zip(pending.items(), encoded):
+            if cache is not None:
+                cache.set(key, result)
+            for file in files:
+                self.handle_result(file, result)
+
+    def handle_result(self, file, result):
+        '''
+        Saves the encoded ``result`` of ``file``, or a copy of the original if
+        the result isn't smaller and is to be saved under another name.
+        '''
+        output = self.get_output_name(file)
+        size = self.storage.size(file)
+        if not self.only_if_smaller or len(result) < size:
+            self.storage.save(output, ContentFile(result))
+        elif output != file:
+            with self.storage.open(file) as f:
+                self.storage.save(output, f)
+        self.report_progress(file, size)
+
+
+class PNGProcessor(BaseImageProcessor):
+    '''
+    Losslessly recompresses PNG images in place with ``optipng``.
+    '''
+
+    extensions = ['.png']
+    version_command = 'optipng -v'
+    optimization_level = 2
+
+    def get_encoder(self):
+        return CommandEncoder(
+            'optipng -quiet -o{0} {{input}}'.format(self.optimization_level),
+            suffix='.png', runner=self.get_runner())
+
+
+class JPEGProcessor(BaseImageProcessor):
+    '''
+    Losslessly optimises JPEG images in place with ``jpegtran``.
+    '''
+
+    extensions = ['.jpg', '.jpeg']
+    version_command = 'jpegtran -version'
+    progressive = True
+
+    def get_encoder(self):
+        return CommandEncoder(
+            'jpegtran -copy none -optimize {0}-outfile {{output}} {{input}}'
+            .format('-progressive ' if self.progressive else ''),
+            suffix='.jpg', runner=self.get_runner())
+
+
+class WebPProcessor(BaseImageProcessor):
+    '''
+    Generates a WebP variant of each image with ``cwebp``, alongside the
+    original.
+    '''
+
+    extensions = ['.png', '.jpg', '.jpeg']
+    version_command = 'cwebp -version'
+    quality = 80
+    lossless = False
+    only_if_smaller = False
+
+    def get_encoder(self):
+        return CommandEncoder(
+            'cwebp -quiet {0} {{input}} -o {{output}}'.format(
+                '-lossless' if self.lossless else '-q {0}'.format(
+                    self.quality)),
+            output_suffix='.webp', runner=self.get_runner())
+
+    def get_output_name(self, file):
+        return os.path.splitext(file)[0] + '.webp'
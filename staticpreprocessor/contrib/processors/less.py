@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from staticpreprocessor.processors import CommandListProcessor
+from staticpreprocessor.processors import (
+    CommandListProcessor, EntryPointProcessorMixin,
+)
 
 
-class LessProcessor(CommandListProcessor):
+class LessProcessor(EntryPointProcessorMixin, CommandListProcessor):
 
     compress = True
     yui_compress = False
     optimization = None
     extensions = ['.less']
     output = 'less_styles.css'
+    version_command = 'lessc --version'
 
     def get_command(self, **kwargs):
         return 'lessc {compress_string} {input} {output}'.format(
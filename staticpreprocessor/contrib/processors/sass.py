@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from staticpreprocessor.processors import CommandListProcessor
+from staticpreprocessor.processors import (
+    CommandListProcessor, EntryPointProcessorMixin,
+)
 
 
-class SassProcessor(CommandListProcessor):
+class SassProcessor(EntryPointProcessorMixin, CommandListProcessor):
 
     compass = False
     extensions = ['.sass', '.scss']
     output = 'sass_styles.css'
+    version_command = 'sass --version'
 
     def get_command(self, **kwargs):
         return 'sass --no-cache {compass_string} {input} {output}'.format(
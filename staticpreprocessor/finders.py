@@ -2,22 +2,36 @@
 from __future__ import unicode_literals
 
 import os
+from collections import OrderedDict
+from importlib import import_module
+
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import FileSystemStorage
-from django.utils.datastructures import SortedDict
-from django.utils.functional import memoize
-from django.utils.importlib import import_module
 
-from django.contrib.staticfiles import utils
 from django.contrib.staticfiles.finders import (
     BaseFinder, FileSystemFinder as BaseFileSystemFinder,
     AppDirectoriesFinder as BaseAppDirectoriesFinder
 )
 
+from staticpreprocessor.compat import get_installed_apps, setting_changed
+from staticpreprocessor.patterns import get_ignore_patterns
 from staticpreprocessor.storage import StaticPreprocessorFileStorage
+from staticpreprocessor.utils import get_files, get_mtime, walk_files
 
 
-_finders = SortedDict()
+# Finder instances, keyed by import path
+_finders = {}
+# ``(app name, location)`` pairs for app source directories, keyed by
+# ``(source_dir, app_names)``
+_app_locations = {}
+# For each finder's import path, a dictionary mapping each prefixed relative
+# path the finder lists to the absolute paths it was found at, or None if
+# the finder is asked directly
+_path_indexes = {}
+# For each indexed finder's import path, the modification times of the
+# directories its files were listed from, which change when files are added
+# to them
+_index_directories = {}
 
 
 class FileSystemFinder(BaseFileSystemFinder):
@@ -30,7 +44,7 @@ class FileSystemFinder(BaseFileSystemFinder):
         # List of locations with static files
         self.locations = []
         # Maps dir paths to an appropriate storage instance
-        self.storages = SortedDict()
+        self.storages = OrderedDict()
         if not isinstance(settings.STATIC_PREPROCESSOR_DIRS, (list, tuple)):
             raise ImproperlyConfigured(
                 'Your STATIC_PREPROCESSOR_DIRS setting is not a tuple or '
@@ -54,11 +68,13 @@ class FileSystemFinder(BaseFileSystemFinder):
 
     def list(self, ignore_patterns):
         '''
-        List all files in all locations.
+        List all files in all locations, skipping those matched by the
+        ``STATIC_PREPROCESSOR_IGNORE_PATTERNS`` setting or ``ignore_patterns``.
         '''
+        ignore = get_ignore_patterns(ignore_patterns)
         for prefix, root in self.locations:
             storage = self.storages[root]
-            for path in utils.get_files(storage, ignore_patterns):
+            for path in get_files(storage, ignore):
                 yield path, storage
 
 
@@ -67,26 +83,193 @@ class AppDirectoriesFinder(BaseAppDirectoriesFinder):
     storage_class = StaticPreprocessorFileStorage
     source_dir = 'rawstatic'
 
+    def __init__(self, app_names=None, *args, **kwargs):
+        # The list of apps that are handled
+        self.apps = []
+        # Mapping of app names to storage instances
+        self.storages = OrderedDict()
+        for app_name, location in get_app_locations(
+                self.source_dir, app_names):
+            self.storages[app_name] = self.storage_class(location)
+            self.apps.append(app_name)
+
+    def list(self, ignore_patterns):
+        '''
+        List all files in all app storages, skipping those matched by the
+        ``STATIC_PREPROCESSOR_IGNORE_PATTERNS`` setting or ``ignore_patterns``.
+        '''
+        ignore = get_ignore_patterns(ignore_patterns)
+        for storage in self.storages.values():
+            if storage.exists(''):
+                for path in get_files(storage, ignore):
+                    yield path, storage
+
+
+class FastFileSystemFinder(FileSystemFinder):
+    '''
+    A ``FileSystemFinder`` that walks its locations directly with
+    ``os.scandir`` rather than through the storage API, pruning ignored
+    directories as it goes.
+    '''
+
+    def list(self, ignore_patterns):
+        ignore = get_ignore_patterns(ignore_patterns)
+        for prefix, root in self.locations:
+            storage = self.storages[root]
+            for path in walk_files(storage.location, ignore):
+                yield path, storage
+
+
+class FastAppDirectoriesFinder(AppDirectoriesFinder):
+    '''
+    An ``AppDirectoriesFinder`` that walks each app's ``rawstatic``
+    directory directly with ``os.scandir``, pruning ignored directories as
+    it goes.
+    '''
+
+    def list(self, ignore_patterns):
+        ignore = get_ignore_patterns(ignore_patterns)
+        for storage in self.storages.values():
+            for path in walk_files(storage.location, ignore):
+                yield path, storage
+
+
+def get_app_locations(source_dir, app_names=None):
+    '''
+    Returns a list of ``(app name, location)`` pairs for the installed apps
+    that have a ``source_dir`` directory.
+
+    The installed apps are only probed once for each ``source_dir``, after
+    which the cached index is returned.
+    '''
+    key = (source_dir, tuple(app_names) if app_names else None)
+    if key not in _app_locations:
+        locations = []
+        for app_name, app_path in get_installed_apps():
+            if app_names and app_name not in app_names:
+                continue
+            location = os.path.join(app_path, source_dir)
+            if os.path.isdir(location):
+                locations.append((app_name, location))
+        _app_locations[key] = locations
+    return _app_locations[key]
+
+
+def get_path_index(import_path, refresh=False):
+    '''
+    Returns a dictionary mapping each relative path listed by the finder at
+    ``import_path`` to the list of absolute paths it was found at, or
+    ``None`` if the finder has to be asked with its own ``find()``, either
+    because it isn't one of this module's finders or because its storages
+    have no local paths.
+
+    The index is built by listing the finder once and cached until
+    ``refresh`` is ``True`` or the finder caches are cleared. The
+    modification times of the directories listed are recorded with it.
+    '''
+    if refresh or import_path not in _path_indexes:
+        finder = get_finder(import_path)
+        index = None
+        directories = {}
+        if isinstance(finder, (FileSystemFinder, AppDirectoriesFinder)):
+            index = {}
+            try:
+                for storage in finder.storages.values():
+                    root = storage.path('')
+                    directories[root] = get_mtime(root)
+                for path, storage in finder.list([]):
+                    if getattr(storage, 'prefix', None):
+                        prefixed_path = os.path.join(storage.prefix, path)
+                    else:
+                        prefixed_path = path
+                    full_path = storage.path(path)
+                    index.setdefault(prefixed_path, []).append(full_path)
+                    directory = os.path.dirname(full_path)
+                    while directory not in directories:
+                        directories[directory] = get_mtime(directory)
+                        directory = os.path.dirname(directory)
+            except NotImplementedError:
+                index = None
+        _path_indexes[import_path] = index
+        _index_directories[import_path] = directories
+    return _path_indexes[import_path]
+
 
-def find(path, all=False):  # pragma: no cover
+def may_have_new_file(import_path, path):
+    '''
+    Returns whether a file may have been added at the prefixed relative
+    ``path`` to the locations of the indexed finder at ``import_path``
+    since its index was built, judging by the modification time of the
+    directory it would be in in each of the finder's storages.
+    '''
+    directories = _index_directories.get(import_path, {})
+    for storage in get_finder(import_path).storages.values():
+        prefix = getattr(storage, 'prefix', None)
+        relative_path = path
+        if prefix:
+            prefix = os.path.join(prefix, '')
+            if not path.startswith(prefix):
+                continue
+            relative_path = path[len(prefix):]
+        directory = os.path.dirname(
+            os.path.join(storage.path(''), relative_path))
+        if directory in directories:
+            if get_mtime(directory) != directories[directory]:
+                return True
+        elif os.path.isdir(directory):
+            # A directory with no files in it when the index was built
+            return True
+    return False
+
+
+def _lookup(index, path):
+    '''
+    Returns the absolute paths ``path`` is indexed at in ``index``, or
+    ``None`` if any of them no longer exists.
+    '''
+    matches = index.get(path, [])
+    for match in matches:
+        if not os.path.exists(match):
+            return None
+    return list(matches)
+
+
+def find(path, all=False):
     '''
     Find a static file with the given path using all enabled finders.
 
     If ``all`` is ``False`` (default), return the first matching
     absolute path (or ``None`` if no match). Otherwise return a list.
+
+    Lookups are answered from an index of each finder's files. A finder's
+    index is only rebuilt if a file it holds for the path has gone, or if
+    the path isn't in it and the directory the file would be in has
+    changed since it was built, so a miss costs a dictionary lookup and a
+    ``stat`` per location.
     '''
+    from staticpreprocessor.conf import settings
+    path = os.path.normpath(path)
     matches = []
-    for finder in get_finders():
-        result = finder.find(path, all=all)
-        if not all and result:
-            return result
-        if not isinstance(result, (list, tuple)):
-            result = [result]
-        matches.extend(result)
-    if matches:
+    for import_path in settings.STATIC_PREPROCESSOR_FINDERS:
+        index = get_path_index(import_path)
+        if index is None:
+            result = get_finder(import_path).find(path, all=all)
+            if all:
+                found = list(result or [])
+            else:
+                found = [result] if result else []
+        else:
+            found = _lookup(index, path)
+            if found is None or \
+                    not found and may_have_new_file(import_path, path):
+                index = get_path_index(import_path, refresh=True)
+                found = _lookup(index, path) or []
+        matches.extend(found)
+        if matches and not all:
+            return matches[0]
+    if all:
         return matches
-    # No match.
-    return all and [] or None
+    return None
 
 
 def get_finders():
@@ -95,11 +278,16 @@ def get_finders():
         yield get_finder(finder_path)
 
 
-def _get_finder(import_path):
+def get_finder(import_path):
     '''
     Imports the staticpreprocessor finder class described by import_path, where
     import_path is the full Python path to the class.
+
+    Finder instances are cached, so each finder is only imported and
+    instantiated once.
     '''
+    if import_path in _finders:
+        return _finders[import_path]
     module, attr = import_path.rsplit('.', 1)
     try:
         mod = import_module(module)
@@ -115,5 +303,22 @@ def _get_finder(import_path):
         raise ImproperlyConfigured(
             'Finder "{0}" is not a subclass of "{1}"'
             .format(Finder, BaseFinder))
-    return Finder()
-get_finder = memoize(_get_finder, _finders, 1)
+    _finders[import_path] = Finder()
+    return _finders[import_path]
+
+
+def clear_caches():
+    '''
+    Clears the cached finder instances, app locations and path indexes.
+    '''
+    _finders.clear()
+    _app_locations.clear()
+    _path_indexes.clear()
+    _index_directories.clear()
+
+
+def _settings_changed(setting, **kwargs):
+    if setting.startswith('STATIC_PREPROCESSOR_') or \
+            setting == 'INSTALLED_APPS':
+        clear_caches()
+setting_changed.connect(_settings_changed)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import errno
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class BuildLock(object):
+    '''
+    An exclusive lock on the file at ``path``, held by at most one process
+    at a time, so that concurrent ``preprocess_static`` runs don't work in
+    the same root at once.
+
+    The lock is taken with ``flock``, so it is released by the operating
+    system if the process holding it dies. Where ``fcntl`` isn't available
+    the lock always succeeds.
+    '''
+
+    # The number of seconds between attempts to take a held lock
+    poll_interval = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=True, timeout=None):
+        '''
+        Takes the lock and returns ``True``. If another process holds it,
+        waits for up to ``timeout`` seconds, or indefinitely if ``timeout``
+        is ``None``, unless ``blocking`` is ``False``, returning ``False``
+        if the lock couldn't be taken.
+        '''
+        if self.file is not None:
+            return True
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        lock_file = open(self.path, 'a')
+        if fcntl is None:  # pragma: no cover
+            self.file = lock_file
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lock_file.close()
+                    raise
+                if not blocking or (
+                        deadline is not None and time.time() >= deadline):
+                    lock_file.close()
+                    return False
+                time.sleep(self.poll_interval)
+            else:
+                self.file = lock_file
+                return True
+
+    def release(self):
+        if self.file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    @property
+    def locked(self):
+        return self.file is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def get_build_lock():
+    '''
+    Returns the ``BuildLock`` for ``STATIC_PREPROCESSOR_ROOT``, whose file
+    is kept beside the root, rather than in it, so that clearing the root
+    leaves it alone.
+    '''
+    from staticpreprocessor.conf import settings
+    root = os.path.abspath(settings.STATIC_PREPROCESSOR_ROOT)
+    return BuildLock(root + '.lock')
@@ -1,19 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import datetime
+import hashlib
+import json
 import os
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import FileSystemStorage
 from django.core.management.base import CommandError, NoArgsCommand
-from django.utils.datastructures import SortedDict
 from django.utils.encoding import smart_text
-from django.utils.importlib import import_module
-from django.utils.six import string_types
 from django.utils.six.moves import input
 
-from staticpreprocessor import finders, storage, conf, processors
+from staticpreprocessor import (
+    finders, storage, conf, processors, state, sync, variants,
+)
+from staticpreprocessor.lock import get_build_lock
+from staticpreprocessor.progress import Progress
+from staticpreprocessor.utils import (
+    FileSet, file_hash, in_shard, is_local_storage, walk_files,
+)
 
 
 class Command(NoArgsCommand):
@@ -37,20 +47,71 @@ class Command(NoArgsCommand):
             action='store_false', dest='clear', default=True,
             help='DO NOT clear the existing files using the storage '
                  'before trying to copy or link the original file.'),
+        make_option(
+            '--plan',
+            action='store_true', dest='plan', default=False,
+            help='Report what would be copied and processed, and how long '
+                 'it is expected to take, without changing anything.'),
+        make_option(
+            '--strict-budgets',
+            action='store_true', dest='strict_budgets', default=None,
+            help='Fail if any processor exceeds its output size or time '
+                 'budgets.'),
+        make_option(
+            '--incremental',
+            action='store_true', dest='incremental', default=False,
+            help='Skip processors whose configuration and inputs are '
+                 'unchanged since the last run recorded in the state file. '
+                 'Implies --no-clear.'),
+        make_option(
+            '--shard',
+            dest='shard', default=None, metavar='N/M',
+            help='Only do the Nth of M shares of the processing, and write '
+                 'a partial manifest for --merge.'),
+        make_option(
+            '--merge',
+            action='append', dest='merge', default=[], metavar='DIR',
+            help='Merge the results of a sharded run from DIR, a copy of '
+                 'one shard\'s STATIC_PREPROCESSOR_ROOT. Give once for each '
+                 'shard.'),
+        make_option(
+            '--variant',
+            action='append', dest='variants', default=[], metavar='NAME',
+            help='Only build the named variant of those in '
+                 'STATIC_PREPROCESSOR_VARIANTS. May be given more than once.'),
+        make_option(
+            '--no-wait',
+            action='store_false', dest='wait', default=True,
+            help='Fail at once if another run holds the build lock, rather '
+                 'than waiting for it to finish.'),
+        make_option(
+            '--lock-timeout',
+            type='float', dest='lock_timeout', default=None,
+            metavar='SECONDS',
+            help='Fail if the build lock isn\'t released within SECONDS.'),
+        make_option(
+            '--progress',
+            action='store_true', dest='progress', default=False,
+            help='Report the progress, throughput and estimated time left '
+                 'of collecting and of each processor.'),
     )
+    shard_manifest_name = '.staticpreprocessor-shard.json'
+    # The minimum number of seconds between progress reports of a step
+    progress_interval = 1.0
     help = 'Precompile static files'
     requires_model_validation = True
 
     def __init__(self, *args, **kwargs):
         super(NoArgsCommand, self).__init__(*args, **kwargs)
-        self.copied_files = []
+        self.copied_files = FileSet()
+        # Maps the hashes of collected files to their prefixed paths
+        self.collected_hashes = {}
+        self.build_state = None
         self.storage = storage.default_storage
-        try:
-            self.storage.path('')
-        except NotImplementedError:
-            self.local = False
-        else:
-            self.local = True
+        self.local = is_local_storage(self.storage)
+        # The storage without local paths the run is uploaded to, if it is
+        # staged locally
+        self.destination = None
 
     def set_options(self, **options):
         '''
@@ -59,6 +120,58 @@ class Command(NoArgsCommand):
         self.interactive = options['interactive']
         self.verbosity = int(options.get('verbosity', 1))
         self.clear = options['clear']
+        self.plan = options.get('plan', False)
+        self.incremental = options.get('incremental', False)
+        if self.incremental:
+            self.clear = False
+        self.shard = self.parse_shard(options.get('shard'))
+        self.merge = options.get('merge') or []
+        self.progress = options.get('progress', False)
+        self.wait = options.get('wait', True)
+        self.lock_timeout = options.get('lock_timeout')
+        try:
+            self.variants = variants.get_variants(
+                options.get('variants') or None)
+        except ImproperlyConfigured as e:
+            raise CommandError(e)
+        if self.variants and (self.shard is not None or self.merge):
+            raise CommandError(
+                'Variants can\'t be built in a sharded run.')
+        if not self.local:
+            if not self.plan:
+                try:
+                    remote = sync.get_remote_storage()
+                except ImproperlyConfigured as e:
+                    raise CommandError(e)
+                if remote is not None:
+                    raise CommandError(
+                        'STATIC_PREPROCESSOR_STORAGE must be a local storage '
+                        'to sync to STATIC_PREPROCESSOR_REMOTE_STORAGE.')
+            # Stage the run in STATIC_PREPROCESSOR_ROOT, where the processors
+            # can work on local files, and upload the results afterwards
+            self.destination = self.storage
+            self.storage = storage.StaticPreprocessorFileStorage()
+            self.local = True
+        self.strict_budgets = options.get('strict_budgets')
+        if self.strict_budgets is None:
+            self.strict_budgets = \
+                conf.settings.STATIC_PREPROCESSOR_STRICT_BUDGETS
+
+    def parse_shard(self, shard):
+        '''
+        Returns the zero-based ``(index, count)`` for a ``--shard`` value of
+        the form ``N/M``, or ``None``.
+        '''
+        if shard is None:
+            return None
+        try:
+            number, count = [int(part) for part in shard.split('/')]
+        except ValueError:
+            number = count = 0
+        if not 1 <= number <= count:
+            raise CommandError(
+                '--shard must be of the form N/M, where 1 <= N <= M.')
+        return number - 1, count
 
     def collect(self):
         '''
@@ -68,7 +181,41 @@ class Command(NoArgsCommand):
         if self.clear:
             self.clear_dir('')
 
-        found_files = SortedDict()
+        found_files = FileSet()
+        files = (
+            (prefixed_path, path, storage)
+            for prefixed_path, path, storage in self.find_files()
+            if found_files.add(prefixed_path, storage)
+        )
+        progress = None
+        if self.progress:
+            # Find every file first, so that the time left can be estimated
+            files = list(files)
+            progress = self.start_progress('Collecting', len(files))
+        for prefixed_path, path, storage in files:
+            self.copy_file(path, prefixed_path, storage)
+            if progress is not None:
+                progress.update(size=storage.size(path))
+        if progress is not None:
+            progress.label = 'Collected'
+            progress.finish()
+
+        return self.copied_files
+
+    def start_progress(self, label, total=None):
+        '''
+        Returns a ``Progress`` for a step, reporting at verbosity 1.
+        '''
+        return Progress(
+            label, lambda msg: self.log(msg, level=1), total,
+            self.progress_interval)
+
+    def find_files(self):
+        '''
+        Yields ``(prefixed_path, path, storage)`` for every file found by the
+        finders, including files hidden by one of the same name found
+        earlier.
+        '''
         for finder in finders.get_finders():
             for path, storage in finder.list([]):
                 # Prefix the relative path if the source storage contains it
@@ -76,38 +223,42 @@ class Command(NoArgsCommand):
                     prefixed_path = os.path.join(storage.prefix, path)
                 else:
                     prefixed_path = path
+                yield prefixed_path, path, storage
 
-                if prefixed_path not in found_files:
-                    found_files[prefixed_path] = (storage, path)
-                    self.copy_file(path, prefixed_path, storage)
-
-        return self.copied_files
-
-    def get_processors(self):
+    def get_processors(self, files=None, variant=None, log=True):
+        '''
+        Returns the configured processors, or those of ``variant``. If
+        ``files`` is given, processors that could have no inputs among them,
+        or among the outputs of the processors before them, are left out
+        without being imported, which is logged if ``log`` is ``True``.
+        '''
+        if variant is not None:
+            get_processors = variant.get_processors
+        elif self.destination is not None:
+            def get_processors(lazy=False):
+                return processors.get_processors(lazy, storage=self.storage)
+        else:
+            get_processors = processors.get_processors
+        if files is None:
+            return get_processors()
         pre_processors = []
-        for processor in conf.settings.STATIC_PREPROCESSOR_PROCESSORS:
-            if isinstance(processor, processors.BaseProcessor):
+        for processor, selected in processors.select_processors(
+                get_processors(lazy=True), files):
+            if selected:
                 pre_processors.append(processor)
-            elif isinstance(processor, type) and \
-                    issubclass(processor, processors.BaseProcessor):
-                pre_processors.append(processor())
-            elif isinstance(processor, (tuple, list) + string_types):
-                try:
-                    if isinstance(processor, (tuple, list)):
-                        klass, kwargs = processor[0], processor[1]
-                    else:
-                        klass, kwargs = processor, {}
-                    module, attr = klass.rsplit('.', 1)
-                    module = import_module(module)
-                    pre_processors.append(getattr(module, attr)(**kwargs))
-                except (IndexError, TypeError, ValueError,
-                        ImportError, AttributeError):
-                    raise ImproperlyConfigured(
-                        '"{0}" is an invalid preprocessor'.format(processor))
+            elif log:
+                self.log(
+                    'Skipping processor with no matching files: {0}\n'
+                    .format(getattr(processor, 'path',
+                                    processor.__class__.__name__)),
+                    level=1
+                )
         return pre_processors
 
     def handle_noargs(self, **options):
         self.set_options(**options)
+        if self.plan:
+            return self.handle_plan()
         # Warn before doing anything more.
         if (isinstance(self.storage, FileSystemStorage) and
                 self.storage.location):
@@ -136,30 +287,575 @@ Type 'yes' to continue, or 'no' to cancel: '''.format(
             if confirm != 'yes':
                 raise CommandError('Collecting static files cancelled.')
 
+        lock = get_build_lock()
+        waited_since = self.acquire_lock(lock)
+        try:
+            if self.merge:
+                return self.handle_merge()
+            self.handle_build(waited_since)
+        finally:
+            lock.release()
+        self.log('Completed pre-processing static files.\n', level=1)
+        if destination_path:
+            self.log(
+                'Results are in{0}'.format(destination_display),
+                level=1
+            )
+        for variant in self.variants:
+            self.log(
+                'Results for variant "{0}" are in:\n\n {1}'.format(
+                    variant.name, variant.root),
+                level=1
+            )
+
+    def acquire_lock(self, lock):
+        '''
+        Takes the build ``lock``, waiting for another run holding it to
+        finish unless ``--no-wait`` was given. Returns the time at which
+        the wait began, or ``None`` if the lock was free.
+        '''
+        if lock.acquire(blocking=False):
+            return None
+        if not self.wait:
+            raise CommandError(
+                'Another preprocess_static run is in progress, holding the '
+                'lock "{0}".'.format(lock.path))
+        waited_since = time.time()
+        self.log(
+            'Waiting for another preprocess_static run to finish...\n',
+            level=1
+        )
+        if not lock.acquire(timeout=self.lock_timeout):
+            raise CommandError(
+                'Timed out waiting for another preprocess_static run to '
+                'finish, after {0}s.'.format(self.lock_timeout))
+        return waited_since
+
+    def handle_build(self, waited_since=None):
+        '''
+        Collects the files and runs the processors.
+
+        If the command waited, from ``waited_since``, for another run to
+        finish and that run had the same settings and found the same
+        files, its results are reused and nothing is done.
+        '''
+        self.build_state = build_state = state.get_build_state()
+        if self.incremental and not build_state.enabled:
+            raise CommandError(
+                '--incremental requires STATIC_PREPROCESSOR_STATE_FILE to be '
+                'set.')
+        last_run = build_state.data.get('last_run', {})
+        if waited_since is not None and build_state.enabled and \
+                last_run.get('timestamp', 0) >= waited_since and \
+                last_run.get('fingerprint') == self.get_run_fingerprint(
+                    self.get_source_hashes()):
+            self.log(
+                'Reusing the results of the run waited for, as nothing has '
+                'changed since it started.\n',
+                level=1
+            )
+            return
+        run_start = start = time.time()
         collected = self.collect()
+        build_state.record_collect(len(collected), time.time() - start)
+        if build_state.enabled:
+            build_state.prune_files(collected)
         self.log(
             'Collected {0} file(s) for processing...\n'
             .format(len(collected)),
             level=1
         )
-        for processor in self.get_processors():
+        if self.local:
+            pre_processors = self.get_processors(
+                walk_files(self.storage.path('')))
+        else:
+            pre_processors = self.get_processors(collected)
+        keys = state.get_processor_keys(pre_processors)
+        if self.shard is not None:
+            self.check_shardable(pre_processors)
+            base = self.get_tree_hashes()
+        breaches = self.run_processors(pre_processors, keys)
+        variant_keys = {}
+        for variant, (processor_keys, variant_breaches) in zip(
+                self.variants, self.build_variants()):
+            variant_keys[variant.name] = processor_keys
+            breaches += variant_breaches
+        if breaches and self.strict_budgets:
+            raise CommandError(
+                '{0} processor budget(s) exceeded.'.format(breaches))
+        remote = self.destination if self.destination is not None \
+            else sync.get_remote_storage()
+        if self.shard is not None:
+            self.write_shard_manifest(base)
+        elif remote is not None:
+            self.sync(remote)
+        build_state.data['last_run'] = {
+            'finished': datetime.datetime.utcnow().isoformat(),
+            'timestamp': time.time(),
+            'duration': time.time() - run_start,
+            'collected': len(collected),
+            'processors': keys,
+        }
+        if variant_keys:
+            build_state.data['last_run']['variants'] = variant_keys
+        if build_state.enabled:
+            build_state.data['last_run']['fingerprint'] = \
+                self.get_run_fingerprint(dict(
+                    (name, record['hash'])
+                    for name, record in build_state.files.items()))
+        build_state.save()
+
+    def check_shardable(self, pre_processors):
+        '''
+        Raises ``CommandError`` if a processor would read the outputs of
+        processors before it in a way a sharded run can't reproduce: a
+        processor run by a single shard only sees the files the earlier
+        processors handled in that shard, and a processor that shards by
+        file never sees an output written by another shard.
+        '''
+        # Extensions of the files written by processors that shard by file,
+        # which may be any file if they don't declare their extensions
+        sharded = set()
+        sharded_any = False
+        # Extensions of the outputs declared by earlier processors
+        declared = set()
+        for processor in pre_processors:
+            written = declared if processor.shard_files else \
+                declared | sharded
+            if (processor.extensions is None and written) or \
+                    (not processor.shard_files and sharded_any) or \
+                    not written.isdisjoint(processor.extensions or ()):
+                raise CommandError(
+                    'Processor {0} reads the outputs of processors before '
+                    'it, so it can\'t be run with --shard.'.format(
+                        processor.__class__.__name__))
+            if processor.shard_files:
+                if processor.extensions is None:
+                    sharded_any = True
+                else:
+                    sharded.update(processor.extensions)
+            declared.update(
+                os.path.splitext(output)[1]
+                for output in processor.get_outputs())
+
+    def get_source_hashes(self):
+        '''
+        Returns a dictionary mapping the name of each file the finders find
+        to its hash, using the hashes recorded in the build state for files
+        that look unchanged.
+        '''
+        found_files = FileSet()
+        hashes = {}
+        for prefixed_path, path, storage in self.find_files():
+            if found_files.add(prefixed_path, storage):
+                hashes[prefixed_path] = self.build_state.hash_file(
+                    prefixed_path, storage.path(path))
+        return hashes
+
+    def get_run_fingerprint(self, files):
+        '''
+        Returns a hash of everything a run depends on: the hashes of the
+        collected ``files``, the finders and ignore patterns, the
+        configuration of each processor and variant, and the shard.
+
+        Only the processors that would run on ``files`` are included, and
+        their fingerprints are those of the resolved processors, which
+        cover their class attributes and tool versions, so a change in
+        either is never mistaken for an unchanged run.
+        '''
+        settings = conf.settings
+        names = list(files)
+        groups = [self.get_processors(names, log=False)]
+        names.extend(
+            output for processor in groups[0]
+            for output in processor.get_outputs())
+        groups.extend(
+            self.get_processors(names, variant, log=False)
+            for variant in self.variants)
+        data = {
+            'files': files,
+            'finders': list(settings.STATIC_PREPROCESSOR_FINDERS),
+            'ignore_patterns': list(
+                settings.STATIC_PREPROCESSOR_IGNORE_PATTERNS),
+            'processors': [
+                [processor.get_fingerprint() for processor in group]
+                for group in groups
+            ],
+            'variants': [variant.name for variant in self.variants],
+            'shard': self.shard,
+        }
+        return hashlib.sha1(
+            json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def run_processors(self, pre_processors, keys, variant=None):
+        '''
+        Runs ``pre_processors``, identified by ``keys`` in the build state,
+        in order, and returns the number of budget breaches.
+
+        If ``variant`` is given, the processors are working on a copy of
+        the processed files in the variant's root, so their inputs are
+        hashed afresh.
+        '''
+        build_state = self.build_state
+        prefix = '' if variant is None else '[{0}] '.format(variant.name)
+        breaches = 0
+        # Outputs produced during this run, whose collected hashes are stale
+        produced = set()
+        for key, processor in zip(keys, pre_processors):
+            record = {}
+            if build_state.enabled:
+                record = {
+                    'fingerprint': processor.get_fingerprint(),
+                    'inputs': self.get_input_hashes(
+                        processor, produced, recorded=variant is None),
+                }
+            if self.shard is not None:
+                if processor.shard_files:
+                    processor.shard = self.shard
+                elif not in_shard(key, self.shard):
+                    self.log(
+                        'Leaving processor to another shard: {0}\n'.format(
+                            processor.__class__.__name__),
+                        level=1
+                    )
+                    continue
+            if self.incremental and build_state.is_up_to_date(
+                    key, outputs=self.get_output_hashes(processor), **record):
+                self.log(
+                    '{0}Skipping unchanged processor: {1}\n'.format(
+                        prefix, processor.__class__.__name__),
+                    level=1
+                )
+                if getattr(processor, 'remove_processed_files', False):
+                    for name in record['inputs']:
+                        processor.storage.delete(name)
+                produced.update(processor.get_outputs())
+                continue
             self.log(
-                'Running processor: {0}\n'.format(
-                    processor.__class__.__name__),
+                '{0}Running processor: {1}\n'.format(
+                    prefix, processor.__class__.__name__),
                 level=1
             )
-            processor.handle()
+            start = time.time()
+            if self.progress:
+                processor.progress = self.start_progress(
+                    prefix + processor.__class__.__name__)
+            try:
+                processor.handle()
+            finally:
+                if processor.progress is not None:
+                    processor.progress.finish()
+                    processor.progress = None
+            stats = processor.get_output_stats()
+            stats['duration'] = time.time() - start
+            breaches += self.check_budgets(
+                processor, stats, build_state.get_processor(key))
+            if build_state.enabled:
+                record['outputs'] = self.get_output_hashes(processor)
+            build_state.record_processor(key, **dict(record, **stats))
+            produced.update(processor.get_outputs())
             self.log(
-                'Finished running processor: {0}'.format(
-                    processor.__class__.__name__),
+                '{0}Finished running processor: {1}'.format(
+                    prefix, processor.__class__.__name__),
                 level=2
             )
-        self.log('Completed pre-processing static files.\n', level=1)
-        if destination_path:
+        return breaches
+
+    def build_variants(self):
+        '''
+        Builds every selected variant in parallel, and returns a list of
+        each one's processor keys and number of budget breaches.
+        '''
+        if not self.variants:
+            return []
+        pool = ThreadPool(len(self.variants))
+        try:
+            return pool.map(self.build_variant, self.variants)
+        finally:
+            pool.close()
+            pool.join()
+
+    def build_variant(self, variant):
+        '''
+        Copies the processed files into the root of ``variant`` and runs the
+        variant's processors there. Returns the processors' keys and the
+        number of budget breaches.
+        '''
+        source = self.storage.path('')
+        pre_processors = self.get_processors(walk_files(source), variant)
+        outputs = set(
+            os.path.relpath(processor.storage.path(output), variant.root)
+            for processor in pre_processors
+            for output in processor.get_outputs())
+        self.copy_tree(source, variant.root, keep=outputs)
+        keys = [
+            '{0}:{1}'.format(variant.name, key)
+            for key in state.get_processor_keys(pre_processors)
+        ]
+        return keys, self.run_processors(pre_processors, keys, variant)
+
+    def copy_tree(self, source, destination, keep=()):
+        '''
+        Copies every file below ``source`` to the same path below
+        ``destination``, which is emptied first if the command is clearing.
+        Otherwise files that look unchanged, having the same size and
+        modification time, aren't copied again, and files that are no
+        longer below ``source`` are deleted, other than the names in
+        ``keep``.
+        '''
+        if self.clear:
+            shutil.rmtree(destination, ignore_errors=True)
+        names = set(walk_files(source))
+        names.discard(self.shard_manifest_name)
+        for name in walk_files(destination):
+            if name not in names and name not in keep:
+                self.log('Deleting "{0}"'.format(
+                    os.path.join(destination, name)), level=2)
+                os.remove(os.path.join(destination, name))
+        for name in sorted(names):
+            source_path = os.path.join(source, name)
+            path = os.path.join(destination, name)
+            try:
+                stat, source_stat = os.stat(path), os.stat(source_path)
+            except OSError:
+                pass
+            else:
+                if stat.st_size == source_stat.st_size and \
+                        stat.st_mtime == source_stat.st_mtime:
+                    continue
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            shutil.copy2(source_path, path)
+
+    def handle_plan(self):
+        '''
+        Reports which files would be copied or skipped and which processors
+        would run on which inputs, along with the expected duration of each
+        step based on previous runs. Nothing is copied or run.
+        '''
+        build_state = state.get_build_state()
+        files = FileSet()
+        skipped = 0
+        for prefixed_path, path, storage in self.find_files():
+            if files.add(prefixed_path, storage):
+                self.log('Would copy "{0}"'.format(storage.path(path)),
+                         level=2)
+            else:
+                skipped += 1
+                found_storage, found_path = files.get_source(prefixed_path)
+                self.log('Would skip "{0}", already found at "{1}"'.format(
+                    storage.path(path), found_storage.path(found_path)),
+                    level=2)
+        estimate = build_state.estimate_collect(len(files))
+        total = estimate or 0.0
+        self.log(
+            'Would collect {0} file(s), skipping {1} hidden duplicate(s)'
+            '{2}\n'.format(
+                len(files), skipped, self.format_estimate(estimate)),
+            level=1
+        )
+        pre_processors = self.get_processors(files)
+        keys = state.get_processor_keys(pre_processors)
+        for key, processor in zip(keys, pre_processors):
+            inputs = list(processor.filter_file_list(files))
+            estimate = build_state.get_duration(key)
+            total += estimate or 0.0
             self.log(
-                'Results are in{0}'.format(destination_display),
+                'Would run processor {0} on {1} file(s){2}\n'.format(
+                    processor.__class__.__name__, len(inputs),
+                    self.format_estimate(estimate)),
                 level=1
             )
+            for input in inputs:
+                self.log('    {0}'.format(input), level=2)
+            # Files produced or removed by this processor change what the
+            # following processors will see.
+            if getattr(processor, 'remove_processed_files', False):
+                for input in inputs:
+                    files.discard(input)
+            for output in processor.get_outputs():
+                files.add(output)
+        for variant in self.variants:
+            self.log(
+                'Would build variant "{0}" in "{1}" with {2}\n'.format(
+                    variant.name, variant.root, ', '.join(
+                        processor.__class__.__name__
+                        for processor in self.get_processors(files, variant)
+                    ) or 'no processors'),
+                level=1
+            )
+        self.log(
+            'Estimated total time: {0:.2f}s\n'.format(total), level=1)
+
+    def get_tree_hashes(self, root=None):
+        '''
+        Returns a dictionary mapping the name of each file below ``root``,
+        by default the storage's location, to its hash.
+        '''
+        if root is None:
+            root = self.storage.path('')
+        return dict(
+            (name, file_hash(os.path.join(root, name)))
+            for name in walk_files(root)
+            if name != self.shard_manifest_name
+        )
+
+    def write_shard_manifest(self, base):
+        '''
+        Writes the partial manifest of a sharded run, recording the hash of
+        every file and which files were changed or deleted since they were
+        collected, given their hashes ``base`` at that point.
+        '''
+        files = self.get_tree_hashes()
+        manifest = {
+            'shard': [self.shard[0] + 1, self.shard[1]],
+            'files': files,
+            'changed': sorted(
+                name for name, digest in files.items()
+                if base.get(name) != digest),
+            'deleted': sorted(set(base) - set(files)),
+        }
+        path = self.storage.path(self.shard_manifest_name)
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def handle_merge(self):
+        '''
+        Combines the results of the shards of a sharded run, found in the
+        directories given with ``--merge``, into the storage.
+
+        Files changed by a shard are taken from that shard, files deleted by
+        any shard and changed by none are left out, and the rest, which are
+        the same in every shard, are taken from any of them.
+        '''
+        manifests = []
+        for directory in self.merge:
+            path = os.path.join(directory, self.shard_manifest_name)
+            try:
+                with open(path) as f:
+                    manifests.append((directory, json.load(f)))
+            except (IOError, OSError, ValueError):
+                raise CommandError(
+                    'No shard manifest found in "{0}"'.format(directory))
+        counts = set(manifest['shard'][1] for _, manifest in manifests)
+        numbers = sorted(manifest['shard'][0] for _, manifest in manifests)
+        if len(counts) != 1 or numbers != list(range(1, counts.pop() + 1)):
+            raise CommandError(
+                'Every shard of a single run must be merged exactly once.')
+        sources = {}
+        changed = {}
+        deleted = set()
+        for directory, manifest in manifests:
+            for name in manifest['files']:
+                sources.setdefault(name, directory)
+            for name in manifest['changed']:
+                digest = manifest['files'][name]
+                if name in changed and changed[name][1] != digest:
+                    raise CommandError(
+                        '"{0}" was changed differently by more than one '
+                        'shard'.format(name))
+                changed[name] = (directory, digest)
+            deleted.update(manifest['deleted'])
+        for name in deleted - set(changed):
+            sources.pop(name, None)
+        sources.update(
+            (name, directory) for name, (directory, _) in changed.items())
+        if self.clear:
+            self.clear_dir('')
+        source_storages = dict(
+            (directory, FileSystemStorage(location=directory))
+            for directory in self.merge)
+        for name, directory in sorted(sources.items()):
+            self.copy_file(name, name, source_storages[directory])
+        self.log(
+            'Merged {0} file(s) from {1} shard(s)\n'.format(
+                len(sources), len(manifests)),
+            level=1
+        )
+        remote = sync.get_remote_storage()
+        if remote is not None:
+            self.sync(remote)
+
+    def sync(self, remote):
+        '''
+        Uploads the processed files to the ``remote`` storage, which
+        :py:meth:`set_options` has checked the local storage can be synced
+        to.
+        '''
+        start = time.time()
+        uploaded, deleted = sync.StorageSync(
+            self.storage, remote,
+            workers=conf.settings.STATIC_PREPROCESSOR_SYNC_WORKERS).sync()
+        for name in uploaded:
+            self.log('Uploaded "{0}"'.format(name), level=2)
+        for name in deleted:
+            self.log('Deleted remote "{0}"'.format(name), level=2)
+        self.log(
+            'Uploaded {0} changed file(s) and deleted {1} in {2:.2f}s\n'
+            .format(len(uploaded), len(deleted), time.time() - start),
+            level=1
+        )
+
+    def get_input_hashes(self, processor, produced=(), recorded=True):
+        '''
+        Returns a dictionary mapping the paths of the files ``processor``
+        would run on, relative to its storage, to their hashes.
+
+        Collected files use the hashes recorded in the build state, if
+        ``recorded`` is ``True``; files in ``produced`` are hashed afresh.
+        The processor's own outputs are never counted as its inputs, as
+        they are left alone when it runs.
+        '''
+        root = processor.storage.path('')
+        outputs = set(
+            processor.storage.path(o) for o in processor.get_outputs())
+        hashes = {}
+        for file in processor.get_file_list():
+            full_path = processor.storage.path(file)
+            if full_path in outputs:
+                continue
+            name = os.path.relpath(full_path, root)
+            record = self.build_state.files.get(name) if recorded else None
+            if record is not None and name not in produced:
+                hashes[name] = record['hash']
+            else:
+                hashes[name] = file_hash(full_path)
+        return hashes
+
+    def get_output_hashes(self, processor):
+        '''
+        Returns a dictionary mapping the outputs of ``processor`` that exist
+        to their hashes and sizes.
+        '''
+        outputs = {}
+        for output in processor.get_outputs():
+            if processor.storage.exists(output):
+                full_path = processor.storage.path(output)
+                outputs[output] = {
+                    'hash': file_hash(full_path),
+                    'size': os.path.getsize(full_path),
+                }
+        return outputs
+
+    def check_budgets(self, processor, stats, baseline):
+        '''
+        Warns about each way in which ``processor`` exceeded its budgets or
+        regressed from ``baseline``, and returns the number of breaches.
+        '''
+        messages = processor.check_budgets(
+            stats, baseline,
+            conf.settings.STATIC_PREPROCESSOR_BUDGET_REGRESSION,
+            conf.settings.STATIC_PREPROCESSOR_BUDGET_MIN_DELTA)
+        for message in messages:
+            self.stderr.write('Budget exceeded by {0}: {1}'.format(
+                processor.__class__.__name__, message))
+        return len(messages)
+
+    def format_estimate(self, estimate):
+        if estimate is None:
+            return ' (no previous timing)'
+        return ' (estimated {0:.2f}s)'.format(estimate)
 
     def log(self, msg, level=2):
         '''
@@ -175,7 +871,7 @@ Type 'yes' to continue, or 'no' to cancel: '''.format(
         dirs, files = self.storage.listdir(path)
         for f in files:
             fpath = os.path.join(path, f)
-            self.log('Deleting "{0}"'.format(smart_text(fpath)), level=1)
+            self.log('Deleting "{0}"'.format(smart_text(fpath)), level=2)
             self.storage.delete(fpath)
         for d in dirs:
             self.clear_dir(os.path.join(path, d))
@@ -188,14 +884,38 @@ Type 'yes' to continue, or 'no' to cancel: '''.format(
             self.log('Deleting existing "{0}"'.format(prefixed_path), level=2)
             self.storage.delete(prefixed_path)
         source_path = source_storage.path(path)
-        self.log('Copying "{0}"'.format(source_path), level=1)
         if self.local:
             full_path = self.storage.path(prefixed_path)
             try:
                 os.makedirs(os.path.dirname(full_path))
             except OSError:
                 pass
+        if self.build_state is not None and self.build_state.enabled:
+            digest = self.build_state.hash_file(prefixed_path, source_path)
+        elif self.local and conf.settings.STATIC_PREPROCESSOR_DEDUPLICATE:
+            digest = file_hash(source_path)
+        else:
+            digest = None
+        self.copied_files.add(prefixed_path)
+        if self.local and conf.settings.STATIC_PREPROCESSOR_DEDUPLICATE:
+            original = self.collected_hashes.setdefault(digest, prefixed_path)
+            if original != prefixed_path and \
+                    self.link_file(original, prefixed_path):
+                return
+        self.log('Copying "{0}"'.format(source_path), level=2)
         with source_storage.open(path) as source_file:
             self.storage.save(prefixed_path, source_file)
-        if not prefixed_path in self.copied_files:
-            self.copied_files.append(prefixed_path)
+
+    def link_file(self, original, prefixed_path):
+        '''
+        Hard links ``prefixed_path`` to the identical file ``original``, and
+        returns whether that was possible.
+        '''
+        try:
+            os.link(
+                self.storage.path(original), self.storage.path(prefixed_path))
+        except (OSError, AttributeError):
+            return False
+        self.log('Linking "{0}" to identical "{1}"'.format(
+            prefixed_path, original), level=2)
+        return True
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from staticpreprocessor import snapshot
+
+
+class Command(BaseCommand):
+    '''
+    Command that exports the build state, processed files and compile cache
+    into a snapshot archive for ``preprocess_static_import``.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--fingerprint',
+            action='store_true', dest='fingerprint', default=False,
+            help='Only print the fingerprint of the current settings.'),
+    )
+    args = '<archive>'
+    help = ('Export the preprocessor state into an archive. "{fingerprint}" '
+            'in the archive path is replaced with the settings fingerprint.')
+
+    def handle(self, *args, **options):
+        fingerprint = snapshot.get_fingerprint()
+        if options.get('fingerprint'):
+            self.stdout.write(fingerprint)
+            return
+        if len(args) != 1:
+            raise CommandError('Give the path of the archive to write.')
+        path = args[0].format(fingerprint=fingerprint)
+        try:
+            count = snapshot.export_snapshot(path, fingerprint)
+        except snapshot.SnapshotError as e:
+            raise CommandError(str(e))
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write(
+                'Exported {0} file(s) to "{1}"'.format(count, path))
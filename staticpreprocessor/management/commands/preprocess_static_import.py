@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from staticpreprocessor import snapshot
+
+
+class Command(BaseCommand):
+    '''
+    Command that restores a snapshot archive made by
+    ``preprocess_static_export``, so that ``preprocess_static
+    --incremental`` only has to redo what has changed since.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--force',
+            action='store_true', dest='force', default=False,
+            help='Import the snapshot even if it was made with different '
+                 'settings.'),
+        make_option(
+            '-C', '--no-clear',
+            action='store_false', dest='clear', default=True,
+            help='DO NOT clear STATIC_PREPROCESSOR_ROOT before restoring '
+                 'the files in the snapshot.'),
+    )
+    args = '<archive>'
+    help = ('Import the preprocessor state from an archive. "{fingerprint}" '
+            'in the archive path is replaced with the settings fingerprint.')
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the path of the archive to read.')
+        verbosity = int(options.get('verbosity', 1))
+        path = args[0].format(fingerprint=snapshot.get_fingerprint())
+        if not os.path.exists(path):
+            # A missing snapshot just means a cold start
+            if verbosity >= 1:
+                self.stdout.write('No snapshot found at "{0}"'.format(path))
+            return
+        try:
+            count = snapshot.import_snapshot(
+                path, options.get('force'), options.get('clear', True))
+        except snapshot.SnapshotError as e:
+            raise CommandError(str(e))
+        if verbosity >= 1:
+            self.stdout.write(
+                'Imported {0} file(s) from "{1}"'.format(count, path))
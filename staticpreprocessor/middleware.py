@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+
+from staticpreprocessor import finders, processors
+from staticpreprocessor.storage import StaticPreprocessorFileStorage
+from staticpreprocessor.utils import FileSet, get_mtime
+
+
+class PreprocessorMiddleware(object):
+    '''
+    Development middleware that serves processor outputs, recompiling them
+    on request when the raw files they are built from have changed.
+
+    Only the processor that produces the requested file is run, along with
+    the processors before it that write the files it reads, and only when
+    the modification times of their inputs differ from those seen the last
+    time it was built. The compiled output is kept in memory.
+
+    The processors are built in a private scratch root holding nothing but
+    their inputs, so ``STATIC_PREPROCESSOR_ROOT`` and any
+    ``preprocess_static`` run working in it are left alone.
+    '''
+
+    def __init__(self):
+        from staticpreprocessor.conf import settings
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed()
+        self.lock = threading.Lock()
+        # Maps output paths to (input signature, content) pairs
+        self.outputs = {}
+        self.root = tempfile.mkdtemp(prefix='staticpreprocessor-')
+        atexit.register(shutil.rmtree, self.root, True)
+        self.storage = StaticPreprocessorFileStorage(location=self.root)
+        self.output_processors = None
+        # The raw files last found and the modification times of the
+        # directories they were found in, which change when files are added
+        # to or removed from them
+        self.found_files = None
+        self.directories = {}
+
+    def get_output_processors(self):
+        '''
+        Returns a dictionary mapping output paths to the list of processors
+        that have to run, in order, to produce them, working in the scratch
+        root. The processors are only instantiated once.
+        '''
+        if self.output_processors is None:
+            output_processors = {}
+            pre_processors = processors.get_processors(storage=self.storage)
+            for index, processor in enumerate(pre_processors):
+                for output in processor.get_outputs():
+                    output_processors[os.path.normpath(output)] = \
+                        self.get_chain(pre_processors[:index + 1])
+            self.output_processors = output_processors
+        return self.output_processors
+
+    def get_chain(self, pre_processors):
+        '''
+        Returns the last of ``pre_processors`` preceded by those before it
+        that write files it reads, judged by their extensions and declared
+        outputs, and in turn by those that write files they read.
+        '''
+        chain = [pre_processors[-1]]
+        # The extensions read by the chain, or None for any file
+        reads = chain[0].extensions and set(chain[0].extensions)
+        for processor in reversed(pre_processors[:-1]):
+            writes = set(processor.extensions or ()).union(
+                os.path.splitext(output)[1]
+                for output in processor.get_outputs())
+            if reads is None or processor.extensions is None or \
+                    not reads.isdisjoint(writes):
+                chain.insert(0, processor)
+                if processor.extensions is None:
+                    reads = None
+                elif reads is not None:
+                    reads.update(processor.extensions)
+        return chain
+
+    def directories_changed(self):
+        return any(
+            get_mtime(directory) != mtime
+            for directory, mtime in self.directories.items())
+
+    def get_found_files(self):
+        '''
+        Returns a ``FileSet`` of the prefixed paths of the raw files the
+        finders list. The finders are only listed again when a directory
+        that was listed has changed since.
+        '''
+        if self.found_files is not None and not self.directories_changed():
+            return self.found_files
+        found_files = FileSet()
+        directories = {}
+        for finder in finders.get_finders():
+            for storage in getattr(finder, 'storages', {}).values():
+                root = storage.path('')
+                directories[root] = get_mtime(root)
+            for path, storage in finder.list([]):
+                if getattr(storage, 'prefix', None):
+                    prefixed_path = os.path.join(storage.prefix, path)
+                else:
+                    prefixed_path = path
+                found_files.add(prefixed_path, storage)
+                root = storage.path('')
+                if root not in directories:
+                    directories[root] = get_mtime(root)
+                directory = os.path.dirname(storage.path(path))
+                while directory not in directories:
+                    directories[directory] = get_mtime(directory)
+                    directory = os.path.dirname(directory)
+        self.found_files = found_files
+        self.directories = directories
+        return found_files
+
+    def get_sources(self, chain):
+        '''
+        Returns an ordered dictionary mapping the prefixed paths of the raw
+        files the processors in ``chain`` would operate on to their
+        ``(storage, path)``.
+        '''
+        found_files = self.get_found_files()
+        return OrderedDict(
+            (prefixed_path, found_files.get_source(prefixed_path))
+            for processor in chain
+            for prefixed_path in processor.filter_file_list(found_files)
+        )
+
+    def get_signature(self, sources):
+        '''
+        Returns a value that changes whenever a file in ``sources`` is
+        added, removed or modified.
+        '''
+        return tuple(
+            (prefixed_path, get_mtime(storage.path(path)))
+            for prefixed_path, (storage, path) in sources.items()
+        )
+
+    def build(self, chain, output, sources):
+        '''
+        Copies ``sources`` into the emptied scratch root, runs the processors
+        in ``chain`` and returns the content of ``output``.
+        '''
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root)
+        for prefixed_path, (storage, path) in sources.items():
+            with storage.open(path) as source_file:
+                self.storage.save(prefixed_path, source_file)
+        for processor in chain:
+            processor.handle()
+        with self.storage.open(output) as output_file:
+            return output_file.read()
+
+    def process_request(self, request):
+        from staticpreprocessor.conf import settings
+        if not request.path.startswith(settings.STATIC_URL):
+            return None
+        output = os.path.normpath(request.path[len(settings.STATIC_URL):])
+        with self.lock:
+            chain = self.get_output_processors().get(output)
+            if chain is None:
+                return None
+            sources = self.get_sources(chain)
+            signature = self.get_signature(sources)
+            cached = self.outputs.get(output)
+            if cached is None or cached[0] != signature:
+                cached = (signature, self.build(chain, output, sources))
+                self.outputs[output] = cached
+        content_type = mimetypes.guess_type(output)[0]
+        return HttpResponse(
+            cached[1], content_type=content_type or 'application/octet-stream')
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from staticpreprocessor.compat import setting_changed
+
+
+# Compiled ``PatternSet`` instances for the ignore patterns setting, keyed by
+# the tuple of extra patterns they include
+_ignore_patterns = {}
+
+
+def translate(pattern):
+    '''
+    Translates the gitignore-style glob ``pattern`` into a regular
+    expression. ``*`` and ``?`` don't match ``/``, while ``**`` matches any
+    number of directories.
+    '''
+    i, n = 0, len(pattern)
+    parts = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i) and i + 2 == n:
+            parts.append('.*')
+            i += 2
+            continue
+        i += 1
+        if c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '\\' and i < n:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+        elif c == '[':
+            end = pattern.find(']', i + 1 if pattern[i:i + 1] in '!^' else i)
+            if end == -1:
+                parts.append('\\[')
+            else:
+                chars = pattern[i:end].replace('\\', '\\\\')
+                if chars[:1] in ('!', '^'):
+                    chars = '^' + chars[1:]
+                parts.append('[{0}]'.format(chars))
+                i = end + 1
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts)
+
+
+class PatternSet(object):
+    '''
+    A compiled set of gitignore-style rules for ignoring files.
+
+    Patterns without a slash match a file or directory name at any depth,
+    while patterns containing one match paths relative to the directory
+    being walked. A trailing slash only matches directories, and a leading
+    ``!`` re-includes paths excluded by earlier rules, the last matching
+    rule winning. Blank lines and lines starting with ``#`` are ignored.
+
+    Consecutive rules of the same kind are combined into a single regular
+    expression, so each path is tested against as few expressions as
+    possible.
+    '''
+
+    def __init__(self, patterns=()):
+        self.patterns = list(patterns)
+        runs = []
+        for pattern in self.patterns:
+            pattern = pattern.rstrip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            elif pattern.startswith('\\'):
+                pattern = pattern[1:]
+            directory_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            source = translate(pattern.lstrip('/'))
+            if '/' not in pattern:
+                source = '(?:.*/)?' + source
+            if not runs or runs[-1][0] != negated:
+                runs.append((negated, [], []))
+            runs[-1][1].append(source)
+            if not directory_only:
+                runs[-1][2].append(source)
+        # (negated, directory regex, file regex) from the last run back
+        self.runs = [
+            (negated, self.compile(sources), self.compile(file_sources))
+            for negated, sources, file_sources in reversed(runs)
+        ]
+
+    def __bool__(self):
+        return bool(self.runs)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'PatternSet({0!r})'.format(self.patterns)
+
+    @staticmethod
+    def compile(sources):
+        if not sources:
+            return None
+        return re.compile(
+            '(?:{0})\\Z'.format('|'.join(
+                '(?:{0})'.format(source) for source in sources)),
+            re.DOTALL)
+
+    def match(self, path, is_dir=False):
+        '''
+        Returns whether the file, or directory if ``is_dir`` is ``True``, at
+        the ``/``-separated relative ``path`` is ignored.
+        '''
+        for negated, directory_regex, file_regex in self.runs:
+            regex = directory_regex if is_dir else file_regex
+            if regex is not None and regex.match(path):
+                return not negated
+        return False
+
+    @classmethod
+    def coerce(cls, patterns):
+        '''
+        Returns ``patterns`` as a ``PatternSet``, or ``None`` if there are no
+        patterns.
+        '''
+        if not isinstance(patterns, cls):
+            patterns = cls(patterns or ())
+        return patterns or None
+
+
+def get_ignore_patterns(extra=()):
+    '''
+    Returns a ``PatternSet`` of the ``STATIC_PREPROCESSOR_IGNORE_PATTERNS``
+    setting followed by the ``extra`` patterns.
+    '''
+    from staticpreprocessor.conf import settings
+    key = tuple(extra or ())
+    if key not in _ignore_patterns:
+        _ignore_patterns[key] = PatternSet(
+            list(settings.STATIC_PREPROCESSOR_IGNORE_PATTERNS) + list(key))
+    return _ignore_patterns[key]
+
+
+def _settings_changed(setting, **kwargs):
+    if setting == 'STATIC_PREPROCESSOR_IGNORE_PATTERNS':
+        _ignore_patterns.clear()
+setting_changed.connect(_settings_changed)
@@ -1,16 +1,354 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import fnmatch
+import copy
+import hashlib
+import json
+import logging
 import os
 import re
 import shlex
 import subprocess
+import sys
+import threading
+import time
+from importlib import import_module
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
-from django.contrib.staticfiles.utils import get_files
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.utils.six import integer_types, string_types
 from django.utils.six.moves import filter
 
+from staticpreprocessor.cache import get_compile_cache
 from staticpreprocessor.storage import default_storage
+from staticpreprocessor.patterns import get_ignore_patterns
+from staticpreprocessor.utils import (
+    break_link, compile_patterns, file_hash, get_files, gzip_size, in_shard,
+    is_local_storage,
+)
+
+log = logging.getLogger(__name__)
+
+# The output of each version command run, so that each tool is only probed
+# once per process
+_tool_versions = {}
+
+
+def get_tool_version(command):
+    '''
+    Returns what ``command``, which should print the version of a tool,
+    writes to standard output and standard error, or an empty string if it
+    can't be run or doesn't finish within the
+    ``STATIC_PREPROCESSOR_VERSION_TIMEOUT``. Each command is only run once.
+    '''
+    from staticpreprocessor.conf import settings
+    if command not in _tool_versions:
+        try:
+            process = subprocess.Popen(
+                shlex.split(command), stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError:
+            output = b''
+        else:
+            timer, timed_out = CommandRunner(
+                timeout=settings.STATIC_PREPROCESSOR_VERSION_TIMEOUT
+            ).start_timer([process])
+            try:
+                output = process.communicate()[0]
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            if timed_out:
+                log.warning(
+                    'Timed out probing the tool version with "%s"', command)
+                output = b''
+        _tool_versions[command] = \
+            (output or b'').decode('utf-8', 'replace').strip()
+    return _tool_versions[command]
+
+
+def _stable_value(value):
+    '''
+    Returns ``value`` as plain JSON-serialisable data that is the same
+    between runs, for use in fingerprints. Objects other than basic types
+    are represented by the dotted path to their class or function.
+    '''
+    if value is None or isinstance(
+            value, (bool, float) + integer_types + string_types):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_stable_value(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_stable_value(v) for v in value), key=repr)
+    if isinstance(value, dict):
+        return dict(
+            ('{0}'.format(k), _stable_value(v)) for k, v in value.items())
+    if not hasattr(value, '__name__'):
+        value = value.__class__
+    return '{0}.{1}'.format(
+        getattr(value, '__module__', ''), value.__name__)
+
+
+# Run by the Python interpreter to apply the limits given as JSON in its
+# first argument to itself before replacing itself with the command in the
+# rest. Limits the platform doesn't support are ignored.
+LIMITS_SCRIPT = '''
+import json, os, sys
+limits, args = json.loads(sys.argv[1]), sys.argv[2:]
+try:
+    import resource
+except ImportError:
+    resource = None
+if limits['max_memory'] is not None and resource is not None:
+    resource.setrlimit(
+        resource.RLIMIT_AS, (limits['max_memory'], limits['max_memory']))
+if limits['nice']:
+    os.nice(limits['nice'])
+if limits['cpu_affinity'] is not None and hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, limits['cpu_affinity'])
+try:
+    os.execvp(args[0], args)
+except OSError as e:
+    sys.stderr.write('{0}: {1}\\n'.format(args[0], e))
+    sys.exit(127)
+'''
+
+
+def _feed(stream, data):
+    '''
+    Writes ``data`` to ``stream`` and closes it, ignoring a reader that has
+    gone away.
+    '''
+    try:
+        stream.write(data)
+    except (IOError, OSError):
+        pass
+    finally:
+        stream.close()
+
+
+def _drain(stream, chunks):
+    '''
+    Reads ``stream`` to its end into the list ``chunks`` and closes it.
+    '''
+    try:
+        chunks.append(stream.read())
+    finally:
+        stream.close()
+
+
+class CommandRunner(object):
+    '''
+    Runs command lines within limits on each run: the ``timeout`` in
+    seconds after which it is killed, the ``max_memory`` in bytes it may
+    address, the amount to increase its ``nice``-ness by and the
+    ``cpu_affinity`` it may run on. A command that is killed, either by a
+    signal or for running too long, is rerun up to ``retries`` times.
+
+    Runners hold no reference to a processor, so that they can be pickled
+    and passed to worker processes. The memory, niceness and CPU limits are
+    applied by starting each command through the Python interpreter, rather
+    than with a ``preexec_fn``, which isn't safe to use in a program with
+    threads.
+    '''
+
+    def __init__(self, timeout=None, max_memory=None, nice=None,
+                 cpu_affinity=None, retries=0, expected_return_codes=(0,)):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.nice = nice
+        self.cpu_affinity = cpu_affinity
+        self.retries = retries
+        self.expected_return_codes = list(expected_return_codes)
+
+    def get_args(self, args):
+        '''
+        Returns the command line to run for the command line ``args``,
+        which starts it through the Python interpreter to apply
+        :py:attr:`max_memory`, :py:attr:`nice` and :py:attr:`cpu_affinity`
+        if any of them are set.
+        '''
+        if self.max_memory is None and not self.nice and \
+                self.cpu_affinity is None:
+            return list(args)
+        limits = json.dumps({
+            'max_memory': self.max_memory,
+            'nice': self.nice,
+            'cpu_affinity': None if self.cpu_affinity is None
+            else list(self.cpu_affinity),
+        })
+        return [sys.executable, '-c', LIMITS_SCRIPT, limits] + list(args)
+
+    def start_timer(self, processes):
+        '''
+        Arranges for ``processes`` to be killed once :py:attr:`timeout`
+        seconds have passed. Returns the timer, or ``None`` if there is no
+        timeout, and a list that is non-empty once they have been killed.
+        '''
+        timed_out = []
+        if self.timeout is None:
+            return None, timed_out
+
+        def kill():
+            timed_out.append(True)
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+        timer = threading.Timer(self.timeout, kill)
+        timer.start()
+        return timer, timed_out
+
+    def should_retry(self, command, attempt, duration, timed_out,
+                     errors=''):
+        '''
+        Returns whether ``command``, killed after ``duration`` seconds on
+        its ``attempt``-th run, is to be rerun, raising ``RuntimeError``
+        if it has been killed too often.
+        '''
+        if attempt <= self.retries:
+            log.warning(
+                '"%s" was killed after %.2fs, retrying', command, duration)
+            return True
+        raise RuntimeError(
+            'Static preprocessor command was killed after {0:.2f}s{1}'
+            ' ({2} attempt(s)){3}'.format(
+                duration, ', having timed out' if timed_out else '',
+                attempt, '\n' + errors if errors else ''))
+
+    def check_return_code(self, return_code, errors='', command=None):
+        if not return_code in self.expected_return_codes:
+            raise RuntimeError(
+                'Static preprocessor command{0} returned an unexpected '
+                'return code. Got: {1} Expected one of: {2}{3}'.format(
+                    ' "{0}"'.format(command) if command else '',
+                    return_code, self.expected_return_codes,
+                    '\n' + errors if errors else ''))
+
+    def call(self, args, stdout=None):
+        '''
+        Runs the command line ``args`` within the limits and returns its
+        standard output if ``stdout`` is ``subprocess.PIPE``.
+
+        Standard error is captured and logged along with how long the
+        command took. ``RuntimeError`` is raised, including the captured
+        standard error, if the command can't be run, is killed too often or
+        returns an unexpected code.
+        '''
+        command = ' '.join(args)
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.time()
+            try:
+                process = subprocess.Popen(
+                    self.get_args(args), stdout=stdout,
+                    stderr=subprocess.PIPE)
+            except OSError as e:
+                raise RuntimeError(
+                    'Static preprocessor command failed: {0}'.format(e))
+            timer, timed_out = self.start_timer([process])
+            try:
+                output, errors = process.communicate()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            duration = time.time() - start
+            errors = (errors or b'').decode('utf-8', 'replace').strip()
+            log.info('"%s" took %.2fs', command, duration)
+            if errors:
+                log.warning('"%s" wrote to stderr:\n%s', command, errors)
+            if timed_out or process.returncode < 0:
+                if self.should_retry(
+                        command, attempt, duration, timed_out, errors):
+                    continue
+            self.check_return_code(process.returncode, errors)
+            return output
+
+    def pipe(self, commands, data=None):
+        '''
+        Runs the command line strings ``commands`` with each one's standard
+        output piped into the next one's standard input, feeding ``data``
+        to the first if it isn't ``None``, and returns the output of the
+        last.
+
+        The limits apply to each command, and the timeout to the pipeline
+        as a whole, which is rerun as a whole if any command is killed. Each
+        command's standard error is captured, logged and included in the
+        ``RuntimeError`` raised if it fails, as with :py:meth:`call`.
+        '''
+        description = ' | '.join(commands)
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.time()
+            procs = []
+            # Each command's standard error, read as it is written so that
+            # a full pipe can't stall the command
+            stderrs = []
+            readers = []
+            try:
+                for command in commands:
+                    if procs:
+                        stdin = procs[-1].stdout
+                    elif data is not None:
+                        stdin = subprocess.PIPE
+                    else:
+                        stdin = None
+                    procs.append(subprocess.Popen(
+                        self.get_args(shlex.split(command)), stdin=stdin,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+                    stderrs.append([])
+                    readers.append(threading.Thread(
+                        target=_drain, args=(procs[-1].stderr, stderrs[-1])))
+                    readers[-1].start()
+                    if len(procs) > 1:
+                        # Let the previous command get SIGPIPE if this one
+                        # exits.
+                        procs[-2].stdout.close()
+            except OSError as e:
+                for proc in procs:
+                    proc.kill()
+                raise RuntimeError(
+                    'Static preprocessor command failed: {0}'.format(e))
+            timer, timed_out = self.start_timer(procs)
+            try:
+                writer = None
+                if data is not None:
+                    writer = threading.Thread(
+                        target=_feed, args=(procs[0].stdin, data))
+                    writer.start()
+                output = procs[-1].stdout.read()
+                procs[-1].stdout.close()
+                if writer is not None:
+                    writer.join()
+                return_codes = [proc.wait() for proc in procs]
+                for reader in readers:
+                    reader.join()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            duration = time.time() - start
+            errors = [
+                b''.join(chunks).decode('utf-8', 'replace').strip()
+                for chunks in stderrs
+            ]
+            log.info('"%s" took %.2fs', description, duration)
+            for command, command_errors in zip(commands, errors):
+                if command_errors:
+                    log.warning(
+                        '"%s" wrote to stderr:\n%s', command, command_errors)
+            if timed_out or any(code < 0 for code in return_codes):
+                if self.should_retry(
+                        description, attempt, duration, timed_out,
+                        '\n'.join(filter(None, errors))):
+                    continue
+            for command, return_code, command_errors in zip(
+                    commands, return_codes, errors):
+                self.check_return_code(
+                    return_code, command_errors, command=command)
+            return output
 
 
 class BaseProcessor(object):
@@ -21,6 +359,28 @@ class BaseProcessor(object):
     include_match = ''
     include_regex = ''
     extensions = None
+    # Budgets for the total size in bytes of the outputs, raw and gzipped,
+    # and for the time in seconds the processor takes to run
+    max_output_size = None
+    max_gzip_size = None
+    max_duration = None
+    # Whether each file is processed independently, so that the files can
+    # be split between the shards of a sharded run
+    shard_files = False
+    # The (index, count) of the shard to process files for, if any
+    shard = None
+    # A command printing the version of the tool the processor runs, which
+    # is part of the processor's fingerprint
+    version_command = None
+    # A staticpreprocessor.progress.Progress to report handled files to
+    progress = None
+    # Attributes that don't affect the processor's outputs, and so are left
+    # out of its fingerprint
+    fingerprint_exclude = (
+        'storage', 'workers', 'use_cache', 'timeout', 'max_memory', 'nice',
+        'cpu_affinity', 'retries', 'max_output_size', 'max_gzip_size',
+        'max_duration', 'shard', 'progress', 'fingerprint_exclude',
+    )
 
     def __init__(self, **kwargs):
         self.kwargs = kwargs
@@ -29,31 +389,182 @@ class BaseProcessor(object):
                 setattr(self, k, v)
 
     def get_file_list(self, **kwargs):
-        from staticpreprocessor.conf import settings
+        '''
+        Lists the files in the storage through the storage API, as local
+        paths if the storage has them and otherwise as names relative to
+        the storage.
+        '''
+        try:
+            location = self.storage.path('')
+        except NotImplementedError:
+            location = ''
         file_list = get_files(
-            self.storage, location=settings.STATIC_PREPROCESSOR_ROOT)
+            self.storage, get_ignore_patterns(), location=location)
+        return self.filter_file_list(file_list)
+
+    def get_storage_name(self, file):
+        '''
+        Returns the path of ``file``, as listed by :py:meth:`get_file_list`
+        or as an output name, relative to the storage, so that files listed
+        in either way can be compared.
+        '''
+        try:
+            return os.path.relpath(
+                self.storage.path(file), self.storage.path(''))
+        except NotImplementedError:
+            return os.path.normpath(file)
+
+    def filter_file_list(self, file_list):
+        '''
+        Filters ``file_list`` down to the files this processor operates on.
+        The filters are compiled once and combined into a single test for
+        each file.
+        '''
+        extensions = None
         if self.extensions is not None:
-            file_list = filter(
-                lambda f: os.path.splitext(f)[1] in self.extensions, file_list)
-        if self.exclude_match:
-            file_list = filter(
-                lambda f: not fnmatch.fnmatch(f, self.exclude_match),
-                file_list
-            )
-        if self.exclude_regex:
-            exclude_regex = re.compile(self.exclude_regex)
-            file_list = filter(
-                lambda f: not bool(exclude_regex.search(f)), file_list)
-        if self.include_match:
-            file_list = filter(
-                lambda f: fnmatch.fnmatch(f, self.include_match),
-                file_list
-            )
-        if self.include_regex:
-            include_regex = re.compile(self.include_regex)
-            file_list = filter(
-                lambda f: bool(include_regex.search(f)), file_list)
-        return file_list
+            extensions = frozenset(self.extensions)
+        exclude_match = compile_patterns(
+            [self.exclude_match] if self.exclude_match else None)
+        exclude_regex = re.compile(self.exclude_regex) \
+            if self.exclude_regex else None
+        include_match = compile_patterns(
+            [self.include_match] if self.include_match else None)
+        include_regex = re.compile(self.include_regex) \
+            if self.include_regex else None
+
+        def matches(file):
+            if extensions is not None and \
+                    os.path.splitext(file)[1] not in extensions:
+                return False
+            if exclude_match is not None and exclude_match.match(file):
+                return False
+            if exclude_regex is not None and exclude_regex.search(file):
+                return False
+            if include_match is not None and not include_match.match(file):
+                return False
+            if include_regex is not None and not include_regex.search(file):
+                return False
+            return True
+        return filter(matches, file_list)
+
+    def get_outputs(self):
+        '''
+        Returns the paths, relative to the storage, of the files this
+        processor produces.
+        '''
+        return []
+
+    def report_progress(self, file, size=None):
+        '''
+        Records that ``file``, of ``size`` bytes (by default its size in the
+        storage), has been handled, if :py:attr:`progress` is set.
+        '''
+        if self.progress is None:
+            return
+        if size is None:
+            try:
+                size = self.storage.size(file)
+            except (OSError, NotImplementedError):
+                size = 0
+        self.progress.update(size=size)
+
+    def may_have_inputs(self, extensions):
+        '''
+        Returns whether this processor could have anything to do when the
+        files in its storage have the given ``extensions``. Processors that
+        don't declare their extensions, or that run without input, always
+        may.
+        '''
+        if self.extensions is None or \
+                not getattr(self, 'require_input', True):
+            return True
+        return not set(self.extensions).isdisjoint(extensions)
+
+    def resolve(self):
+        return self
+
+    def get_configuration(self):
+        '''
+        Returns a dictionary of the settings that determine what the
+        processor produces: every public attribute defined on its class or
+        passed as a keyword argument, other than methods and those in
+        :py:attr:`fingerprint_exclude`, and the version of its tool.
+        '''
+        names = set(self.kwargs)
+        for klass in self.__class__.__mro__:
+            names.update(
+                name for name, value in vars(klass).items()
+                if not name.startswith('_') and not callable(value) and
+                not isinstance(value, (property, staticmethod, classmethod)))
+        names.difference_update(self.fingerprint_exclude)
+        configuration = dict(
+            (name, _stable_value(getattr(self, name, self.kwargs.get(name))))
+            for name in names)
+        if self.version_command:
+            configuration['tool_version'] = get_tool_version(
+                self.version_command)
+        return configuration
+
+    def get_fingerprint(self):
+        '''
+        Returns a hash identifying the processor's class and configuration,
+        which changes whenever anything affecting its outputs does,
+        including the version of its tool.
+        '''
+        fingerprint = hashlib.sha1('{0}.{1}\n{2}'.format(
+            self.__class__.__module__, self.__class__.__name__,
+            json.dumps(self.get_configuration(), sort_keys=True)
+        ).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def get_output_stats(self):
+        '''
+        Returns a dictionary of the total ``size`` and ``gzip_size`` in bytes
+        of the outputs that exist.
+        '''
+        size = compressed_size = 0
+        for output in self.get_outputs():
+            if self.storage.exists(output):
+                with self.storage.open(output) as f:
+                    content = f.read()
+                size += len(content)
+                compressed_size += gzip_size(content)
+        return {'size': size, 'gzip_size': compressed_size}
+
+    def check_budgets(self, stats, baseline=None, regression=None,
+                      min_delta=None):
+        '''
+        Returns a list of messages describing the ways in which ``stats``,
+        as recorded for a run of this processor, exceed its budgets.
+
+        If ``regression`` is given, any statistic that has grown by more
+        than that fraction of its ``baseline`` value is also reported,
+        unless it has grown by no more than its value in the ``min_delta``
+        dictionary, so that e.g. noise in short durations isn't reported.
+        '''
+        min_delta = min_delta or {}
+        messages = []
+        budgets = (
+            ('size', self.max_output_size, '{0} bytes'),
+            ('gzip_size', self.max_gzip_size, '{0} bytes gzipped'),
+            ('duration', self.max_duration, '{0:.2f}s'),
+        )
+        for stat, budget, template in budgets:
+            value = stats.get(stat)
+            if value is None:
+                continue
+            if budget is not None and value > budget:
+                messages.append('{0} exceeds the budget of {1}'.format(
+                    template.format(value), template.format(budget)))
+            previous = (baseline or {}).get(stat)
+            if regression is not None and previous and \
+                    value > previous * (1 + regression) and \
+                    value - previous > min_delta.get(stat, 0):
+                messages.append(
+                    '{0} is more than {1:.0%} up on {2} last run'.format(
+                        template.format(value), regression,
+                        template.format(previous)))
+        return messages
 
     def handle(self, **kwargs):
         raise NotImplementedError()
@@ -67,62 +578,454 @@ class BaseListProcessor(BaseProcessor):
         raise NotImplementedError()
 
     def handle(self, **kwargs):
+        '''
+        Runs :py:meth:`handle_list` on the processor's files, which are
+        listed once. Nothing is done if there are none, unless the processor
+        has ``require_input`` set to ``False``. Only the files that were
+        listed are deleted afterwards, never the processor's outputs.
+
+        If :py:attr:`progress` is set, its total is set to the number of
+        files to handle, and those files are reported as handled at the end
+        unless :py:meth:`handle_list` reported them itself.
+
+        If :py:attr:`shard` is set and :py:attr:`shard_files` is ``True``,
+        only the files belonging to the shard are handled, though all of
+        them are deleted, as the other shards handle the rest.
+
+        If ``STATIC_PREPROCESSOR_DEDUPLICATE`` is set, files to be handled
+        that were hard linked to identical files are given copies of their
+        own first, so that modifying one in place doesn't change the rest,
+        unless the processor has ``reuse_duplicates`` set and so handles
+        each content once.
+        '''
+        from staticpreprocessor.conf import settings
         kwargs.update(self.kwargs)
-        self.handle_list(self.get_file_list(**kwargs), **kwargs)
+        file_list = list(self.get_file_list(**kwargs))
+        if not file_list and getattr(self, 'require_input', True):
+            return
+        handled = file_list
+        if self.shard_files and self.shard is not None:
+            handled = [
+                f for f in file_list
+                if in_shard(self.get_storage_name(f), self.shard)
+            ]
+        # Only local files can have been hard linked when collected
+        if settings.STATIC_PREPROCESSOR_DEDUPLICATE and \
+                not getattr(self, 'reuse_duplicates', False) and \
+                is_local_storage(self.storage):
+            for file in handled:
+                break_link(self.storage.path(file))
+        if self.progress is not None:
+            self.progress.total = len(handled)
+        self.handle_list(handled, **kwargs)
+        if self.progress is not None and not self.progress.files:
+            # The processor didn't report its files one by one
+            for file in handled:
+                self.report_progress(file)
         if self.remove_processed_files:
-            for file in self.get_file_list(**kwargs):
-                self.storage.delete(file)
+            outputs = set(self.get_storage_name(o) for o in self.get_outputs())
+            for file in file_list:
+                if self.get_storage_name(file) not in outputs:
+                    self.storage.delete(file)
 
 
 class BaseFileProcessor(BaseListProcessor):
 
+    shard_files = True
+    # Whether files with the same content are only handled once, the result
+    # being reused for the others through handle_duplicate
+    reuse_duplicates = False
+
     def handle_file(self, file, **kwargs):
         raise NotImplementedError()
 
+    def handle_duplicate(self, file, original, **kwargs):
+        '''
+        Handles ``file``, whose content was the same as that of ``original``
+        before ``original`` was handled. By default ``file`` is replaced
+        with ``original`` as it now is, which suits processors that modify
+        files in place.
+        '''
+        original_path = self.storage.path(original)
+        path = self.storage.path(file)
+        if os.path.exists(original_path) and \
+                not os.path.samefile(original_path, path):
+            with open(original_path, 'rb') as f:
+                self.storage.save(file, ContentFile(f.read()))
+
     def handle_list(self, file_list, **kwargs):
+        if not self.reuse_duplicates:
+            for file in file_list:
+                self.handle_file(file, **kwargs)
+                self.report_progress(file)
+            return
+        originals = {}
         for file in file_list:
-            self.handle_file(file, **kwargs)
+            digest = file_hash(self.storage.path(file))
+            if digest in originals:
+                self.handle_duplicate(file, originals[digest], **kwargs)
+            else:
+                originals[digest] = file
+                self.handle_file(file, **kwargs)
+            self.report_progress(file)
 
 
-class CommandProcessorMixin(BaseProcessor):
+class CommandLimitsMixin(BaseProcessor):
+    '''
+    Runs the processor's commands through a :py:class:`CommandRunner`, so
+    that they are subject to its limits.
+    '''
+
+    expected_return_codes = [0]
+    # Limits on each run of a command: the seconds after which it is
+    # killed, the bytes of memory it may address, the amount to increase
+    # its niceness by and the CPUs it may run on
+    timeout = None
+    max_memory = None
+    nice = None
+    cpu_affinity = None
+    # The number of times to rerun a command that was killed
+    retries = 0
+
+    def get_runner(self):
+        '''
+        Returns a :py:class:`CommandRunner` applying the processor's limits.
+        '''
+        return CommandRunner(
+            timeout=self.timeout, max_memory=self.max_memory, nice=self.nice,
+            cpu_affinity=self.cpu_affinity, retries=self.retries,
+            expected_return_codes=self.expected_return_codes)
+
+    def call(self, args, stdout=None):
+        '''
+        Runs the command line ``args`` within the processor's limits and
+        returns its standard output if ``stdout`` is ``subprocess.PIPE``.
+        See :py:meth:`CommandRunner.call`.
+        '''
+        return self.get_runner().call(args, stdout)
+
+
+class CommandProcessorMixin(CommandLimitsMixin):
 
     command = ''
     output = ''
-    expected_return_codes = [0]
     require_input = True
+    use_cache = True
 
     def get_command(self, **kwargs):
         return self.command.format(**kwargs)
 
+    def get_outputs(self):
+        return [self.output] if self.output else []
+
+    def get_cache_key(self, input, files=None, **kwargs):
+        '''
+        Returns a key identifying the output of running the command on
+        ``input``, or ``None`` if the output can't be cached, as when there
+        is no output file for the command to write, e.g. when it modifies
+        its input in place, unless ``stdout`` is ``True`` because what the
+        command writes to standard output is what is captured.
+
+        ``files`` is the list of input files, if ``input`` is more than a
+        single file. The key is a hash of the processor's fingerprint, the
+        command (with paths relative to the storage, so that it's stable
+        between machines) and the contents of each input file and of any
+        files listed in the ``dependencies`` keyword argument.
+        '''
+        stdout = kwargs.pop('stdout', False)
+        output = kwargs.get('output', self.output)
+        if not output and not stdout:
+            return None
+        root = self.storage.path('')
+        key = hashlib.sha1()
+        files = list(files) if files is not None else [input]
+        for file in files + sorted(kwargs.pop('dependencies', ())):
+            path = os.path.join(root, file)
+            if not os.path.isfile(path):
+                return None
+            with open(path, 'rb') as f:
+                key.update(hashlib.sha1(f.read()).hexdigest().encode('ascii'))
+        kwargs.update({
+            'input': ' '.join(
+                os.path.relpath(os.path.join(root, f), root) for f in files),
+            'output': output,
+        })
+        key.update('{0}\n{1}'.format(
+            self.get_fingerprint(), self.get_command(**kwargs)
+        ).encode('utf-8'))
+        return key.hexdigest()
+
     def run_command(self, input, **kwargs):
         if not input and self.require_input:
             return
+        output = kwargs.pop('output', self.output)
+        dependencies = kwargs.pop('dependencies', ())
+        files = kwargs.pop('files', None)
+        cache = get_compile_cache() if self.use_cache else None
+        if cache is not None:
+            cache_key = self.get_cache_key(
+                input, files, output=output, dependencies=dependencies,
+                **kwargs)
+            if cache_key is not None:
+                content = cache.get(cache_key)
+                if content is not None:
+                    self.storage.save(output, ContentFile(content))
+                    return
         kwargs.update({
             'input': input,
-            'output': self.storage.path(self.output),
+            'output': self.storage.path(output),
         })
-        command = self.get_command(**kwargs)
-        try:
-            return_code = subprocess.call(shlex.split(command))
-        except OSError as e:
-            raise RuntimeError(
-                'Static preprocessor command failed: {0}'.format(e))
-        else:
-            if not return_code in self.expected_return_codes:
+        self.call(shlex.split(self.get_command(**kwargs)))
+        if cache is not None and cache_key is not None and \
+                os.path.isfile(self.storage.path(output)):
+            with self.storage.open(output) as f:
+                cache.set(cache_key, f.read())
+
+    def get_command_output(self, input, **kwargs):
+        '''
+        Runs the command on ``input`` and returns what it writes to standard
+        output, for commands that don't write to an output file themselves.
+        '''
+        kwargs.update({
+            'input': input,
+            'output': '',
+        })
+        return self.call(
+            shlex.split(self.get_command(**kwargs)), stdout=subprocess.PIPE)
+
+
+class EntryPointProcessorMixin(CommandProcessorMixin):
+    '''
+    Allows a command processor to compile each of a number of entry files
+    to its own output, rather than compiling every matching file into the
+    single :py:attr:`output`.
+
+    The other matching files (e.g. partials and imports), including the
+    other entries, which an entry may import, are dependencies of every
+    entry, but each output is built and cached on its own. Entries are
+    compiled in parallel.
+    '''
+
+    # Maps output paths to entry file paths, both relative to the storage
+    entry_points = None
+    # The number of entries to compile at once; defaults to the CPU count
+    workers = None
+
+    def get_outputs(self):
+        if self.entry_points:
+            return list(self.entry_points)
+        return super(EntryPointProcessorMixin, self).get_outputs()
+
+    def handle_list(self, file_list, **kwargs):
+        if not self.entry_points:
+            return super(EntryPointProcessorMixin, self).handle_list(
+                file_list, **kwargs)
+        entries = [
+            (output, self.storage.path(entry))
+            for output, entry in sorted(self.entry_points.items())
+        ]
+        for output, entry in entries:
+            if not os.path.isfile(entry):
                 raise RuntimeError(
-                    'Static preprocessor command returned an unexpected '
-                    'return code. Got: {0} Expected one of: {1}'
-                    .format(return_code, self.expected_return_codes)
-                )
+                    'Static preprocessor entry point "{0}" does not exist'
+                    .format(entry))
+        # Every other file, including the other entries, which may be
+        # imported, is a dependency of each entry.
+        paths = [(f, self.storage.path(f)) for f in file_list]
+        jobs = [
+            dict(kwargs, input=entry, output=output, dependencies=[
+                f for f, path in paths if path != entry])
+            for output, entry in entries
+        ]
+        pool = ThreadPool(min(self.workers or cpu_count(), len(jobs)))
+        try:
+            pool.map(lambda job: self.run_command(**job), jobs)
+        finally:
+            pool.close()
+            pool.join()
 
 
 class CommandListProcessor(CommandProcessorMixin, BaseListProcessor):
 
     def handle_list(self, file_list, **kwargs):
-        self.run_command(' '.join(file_list), **kwargs)
+        self.run_command(' '.join(file_list), files=file_list, **kwargs)
 
 
 class CommandFileProcessor(CommandProcessorMixin, BaseFileProcessor):
 
     def handle_file(self, file, **kwargs):
         self.run_command(file, **kwargs)
+
+
+class PipelineProcessor(CommandLimitsMixin, BaseListProcessor):
+    '''
+    Runs the processed files through a chain of stages, passing the output
+    of each stage to the next in memory, and writes only the result of the
+    final stage to :py:attr:`output`.
+
+    Each stage is either a command line string, formatted with the keyword
+    arguments in the same way as ``CommandProcessorMixin.command``, or a
+    callable taking and returning bytes. The first stage's command may refer
+    to ``{input}``, the space-separated list of files; if the first stage is
+    a callable it is passed the concatenated contents of the files.
+    Consecutive command stages are connected directly with OS pipes, and
+    are run within the same limits as the commands of
+    :py:class:`CommandProcessorMixin`.
+    '''
+
+    stages = []
+    output = ''
+    require_input = True
+
+    def get_outputs(self):
+        return [self.output] if self.output else []
+
+    def run_commands(self, commands, data=None):
+        '''
+        Runs ``commands`` with each one's standard output piped into the
+        next one's standard input, feeding ``data`` to the first (if it
+        isn't ``None``), and returns the output of the last. The commands
+        are run within the processor's limits.
+        '''
+        return self.get_runner().pipe(commands, data)
+
+    def handle_list(self, file_list, **kwargs):
+        file_list = list(file_list)
+        if not file_list and self.require_input:
+            return
+        kwargs.update({
+            'input': ' '.join(file_list),
+            'output': self.storage.path(self.output),
+        })
+        data = None
+        if self.stages and callable(self.stages[0]):
+            data = b''
+            for file in file_list:
+                with self.storage.open(file) as f:
+                    data += f.read()
+        commands = []
+        for stage in self.stages:
+            if callable(stage):
+                if commands:
+                    data = self.run_commands(commands, data)
+                    commands = []
+                data = stage(data)
+            else:
+                commands.append(stage.format(**kwargs))
+        if commands:
+            data = self.run_commands(commands, data)
+        self.storage.save(self.output, ContentFile(data or b''))
+
+
+class LazyProcessor(object):
+    '''
+    A processor, named by the dotted path to its class, that isn't imported
+    or instantiated until :py:meth:`resolve` is called.
+
+    The extensions it operates on are taken from ``kwargs`` or, for the
+    contrib processors, from ``staticpreprocessor.contrib.processors.
+    EXTENSIONS``, so that it can be skipped without being imported when no
+    file matches.
+    '''
+
+    def __init__(self, path, kwargs=None):
+        from staticpreprocessor.contrib.processors import EXTENSIONS
+        self.path = path
+        self.kwargs = kwargs or {}
+        self.extensions = self.kwargs.get('extensions', EXTENSIONS.get(path))
+        self.require_input = self.kwargs.get('require_input', True)
+        self.processor = None
+
+    def __repr__(self):
+        return 'LazyProcessor({0!r})'.format(self.path)
+
+    def get_fingerprint(self):
+        '''
+        Returns a hash of the processor's path and keyword arguments, which
+        identifies its configuration without importing it. Unlike the
+        fingerprint of the resolved processor, it doesn't cover the
+        processor's class attributes or the version of its tool.
+        '''
+        fingerprint = hashlib.sha1('{0}\n{1}'.format(
+            self.path, json.dumps(_stable_value(self.kwargs), sort_keys=True)
+        ).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def may_have_inputs(self, extensions):
+        if self.extensions is None or not self.require_input:
+            return True
+        return not set(self.extensions).isdisjoint(extensions)
+
+    def resolve(self):
+        '''
+        Returns the processor instance, importing its class if necessary.
+        '''
+        if self.processor is None:
+            try:
+                module, attr = self.path.rsplit('.', 1)
+                klass = getattr(import_module(module), attr)
+                self.processor = klass(**self.kwargs)
+            except (TypeError, ValueError, ImportError, AttributeError):
+                raise ImproperlyConfigured(
+                    '"{0}" is an invalid preprocessor'.format(self.path))
+        return self.processor
+
+
+def select_processors(pre_processors, files):
+    '''
+    Yields ``(processor, selected)`` for each of ``pre_processors``, where
+    ``selected`` is whether it could have inputs among ``files`` or among
+    the outputs of the selected processors before it. Selected processors
+    are resolved; the others are left as they are, so that lazy processors
+    that won't run are never imported or probed.
+    '''
+    extensions = set(os.path.splitext(f)[1] for f in files)
+    for processor in pre_processors:
+        if not processor.may_have_inputs(extensions):
+            yield processor, False
+            continue
+        processor = processor.resolve()
+        extensions.update(
+            os.path.splitext(f)[1] for f in processor.get_outputs())
+        yield processor, True
+
+
+def get_processors(lazy=False, processors=None, storage=None):
+    '''
+    Returns instances of the processors named in ``processors``, by default
+    the ``STATIC_PREPROCESSOR_PROCESSORS`` setting, in order.
+
+    If ``lazy`` is ``True``, processors given as dotted paths are returned
+    as unresolved :py:class:`LazyProcessor` instances. If ``storage`` is
+    given, the processors work in it rather than in their own storage;
+    processors given as instances are copied rather than changed.
+    '''
+    from staticpreprocessor.conf import settings
+    if processors is None:
+        processors = settings.STATIC_PREPROCESSOR_PROCESSORS
+    extra = {} if storage is None else {'storage': storage}
+    pre_processors = []
+    for processor in processors:
+        if isinstance(processor, BaseProcessor):
+            if storage is not None:
+                processor = copy.copy(processor)
+                processor.storage = storage
+            pre_processors.append(processor)
+        elif isinstance(processor, type) and \
+                issubclass(processor, BaseProcessor):
+            pre_processors.append(processor(**extra))
+        elif isinstance(processor, (tuple, list) + string_types):
+            try:
+                if isinstance(processor, (tuple, list)):
+                    path, kwargs = processor[0], processor[1]
+                else:
+                    path, kwargs = processor, {}
+                lazy_processor = LazyProcessor(path, dict(kwargs, **extra))
+            except (IndexError, TypeError, ValueError):
+                raise ImproperlyConfigured(
+                    '"{0}" is an invalid preprocessor'.format(processor))
+            if lazy:
+                pre_processors.append(lazy_processor)
+            else:
+                pre_processors.append(lazy_processor.resolve())
+    return pre_processors
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+
+
+def format_size(size):
+    '''
+    Returns ``size`` in bytes as a short human-readable string.
+    '''
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return '{0} B'.format(int(size))
+    return '{0:.1f} {1}'.format(size, unit)
+
+
+class Progress(object):
+    '''
+    Reports the progress of a step working through ``total`` files, if
+    known, by passing lines of text to ``write``.
+
+    Each line gives the files and bytes handled so far, the rates at which
+    they are being handled and, if the total is known, the estimated time
+    remaining. Lines are written at most once every ``interval`` seconds
+    however often :py:meth:`update` is called, so that reporting doesn't
+    slow the step down or flood the output.
+    '''
+
+    def __init__(self, label, write, total=None, interval=1.0):
+        self.label = label
+        self.write = write
+        self.total = total
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = self.last_report = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, files=1, size=0):
+        '''
+        Records that ``files`` more files, of ``size`` bytes in total, have
+        been handled, and reports the progress if it's been long enough.
+        '''
+        with self.lock:
+            self.files += files
+            self.bytes += size
+            now = time.time()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            self.write(self.format(now))
+
+    def get_rates(self, now):
+        '''
+        Returns the numbers of files and bytes handled per second.
+        '''
+        elapsed = max(now - self.start, 1e-6)
+        return self.files / elapsed, self.bytes / elapsed
+
+    def get_eta(self, now):
+        '''
+        Returns the estimated number of seconds until every file has been
+        handled, or ``None`` if it can't be estimated.
+        '''
+        if not self.total or not self.files:
+            return None
+        remaining = max(self.total - self.files, 0)
+        return remaining * (now - self.start) / self.files
+
+    def format(self, now):
+        files_rate, bytes_rate = self.get_rates(now)
+        if self.total is None:
+            count = '{0}'.format(self.files)
+        else:
+            count = '{0}/{1}'.format(self.files, self.total)
+        eta = self.get_eta(now)
+        return '{0}: {1} file(s), {2}, {3:.1f} file(s)/s, {4}/s{5}'.format(
+            self.label, count, format_size(self.bytes), files_rate,
+            format_size(bytes_rate),
+            '' if eta is None else ', ETA {0:.1f}s'.format(eta))
+
+    def finish(self):
+        '''
+        Reports the totals and average rates for the step.
+        '''
+        now = time.time()
+        files_rate, bytes_rate = self.get_rates(now)
+        self.write(
+            '{0}: {1} file(s), {2} in {3:.2f}s ({4:.1f} file(s)/s, {5}/s)'
+            .format(self.label, self.files, format_size(self.bytes),
+                    now - self.start, files_rate, format_size(bytes_rate)))
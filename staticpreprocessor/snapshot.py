@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+
+from staticpreprocessor import finders, processors, state
+from staticpreprocessor.cache import FileSystemCompileCache, get_compile_cache
+from staticpreprocessor.utils import walk_files
+
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = 'snapshot.json'
+STATE_NAME = 'state.json'
+ROOT_DIR = 'root'
+CACHE_DIR = 'cache'
+
+
+class SnapshotError(RuntimeError):
+    pass
+
+
+def get_fingerprint():
+    '''
+    Returns a hash of the settings that determine what a run produces: the
+    finders, the ignore patterns and the fingerprint of each configured
+    processor that would run on the files the finders find, so that the
+    tools of the others are never probed. Snapshots are only imported where
+    this matches.
+    '''
+    from staticpreprocessor.conf import settings
+    files = [
+        path for finder in finders.get_finders()
+        for path, storage in finder.list([])
+    ]
+    pre_processors = [
+        processor for processor, selected in processors.select_processors(
+            processors.get_processors(lazy=True), files)
+        if selected
+    ]
+    data = {
+        'version': SNAPSHOT_VERSION,
+        'finders': list(settings.STATIC_PREPROCESSOR_FINDERS),
+        'ignore_patterns': list(settings.STATIC_PREPROCESSOR_IGNORE_PATTERNS),
+        'processors': [
+            [key, processor.get_fingerprint()]
+            for key, processor in zip(
+                state.get_processor_keys(pre_processors), pre_processors)
+        ],
+    }
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_cache_location():
+    '''
+    Returns the directory of the compile cache, if it is stored in files.
+    '''
+    cache = get_compile_cache()
+    if isinstance(cache, FileSystemCompileCache):
+        return cache.location
+    return None
+
+
+def export_snapshot(path, fingerprint=None):
+    '''
+    Writes a gzipped tar archive to ``path`` holding the build state, the
+    contents of ``STATIC_PREPROCESSOR_ROOT`` and, if it is stored in files,
+    the compile cache. Returns the number of files archived.
+    '''
+    from staticpreprocessor.conf import settings
+    state_file = settings.STATIC_PREPROCESSOR_STATE_FILE
+    if not state_file or not os.path.exists(state_file):
+        raise SnapshotError(
+            'There is no build state to export; set '
+            'STATIC_PREPROCESSOR_STATE_FILE and run preprocess_static first.')
+    manifest = {
+        'version': SNAPSHOT_VERSION,
+        'fingerprint': fingerprint or get_fingerprint(),
+    }
+    count = 0
+    with tarfile.open(path, 'w:gz') as archive:
+        content = json.dumps(manifest, indent=2).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(content)
+        archive.addfile(info, io.BytesIO(content))
+        archive.add(state_file, STATE_NAME)
+        directories = [
+            (ROOT_DIR, settings.STATIC_PREPROCESSOR_ROOT),
+            (CACHE_DIR, get_cache_location()),
+        ]
+        for prefix, directory in directories:
+            if directory is None:
+                continue
+            for name in walk_files(directory):
+                archive.add(
+                    os.path.join(directory, name),
+                    '/'.join([prefix, name.replace(os.sep, '/')]))
+                count += 1
+    return count
+
+
+def read_manifest(archive):
+    try:
+        member = archive.extractfile(MANIFEST_NAME)
+        return json.loads(member.read().decode('utf-8'))
+    except (KeyError, ValueError, AttributeError):
+        raise SnapshotError('The archive is not a snapshot.')
+
+
+def import_snapshot(path, force=False, clear=True):
+    '''
+    Restores the build state, ``STATIC_PREPROCESSOR_ROOT`` and, if it is
+    stored in files, the compile cache from the snapshot at ``path``, so that
+    ``preprocess_static --incremental`` only has to redo what has changed
+    since. Returns the number of files restored.
+
+    Every path in the snapshot is checked before anything is written, and
+    unless ``clear`` is ``False`` the root is emptied first, so that it
+    holds nothing the snapshot doesn't.
+
+    Raises ``SnapshotError`` if the snapshot was made with different
+    settings, unless ``force`` is ``True``, or holds an unsafe path.
+    '''
+    from staticpreprocessor.conf import settings
+    state_file = settings.STATIC_PREPROCESSOR_STATE_FILE
+    if not state_file:
+        raise SnapshotError(
+            'STATIC_PREPROCESSOR_STATE_FILE must be set to import a '
+            'snapshot.')
+    destinations = {
+        ROOT_DIR: settings.STATIC_PREPROCESSOR_ROOT,
+        CACHE_DIR: get_cache_location(),
+    }
+    with tarfile.open(path, 'r:gz') as archive:
+        manifest = read_manifest(archive)
+        fingerprint = manifest.get('fingerprint')
+        if manifest.get('version') != SNAPSHOT_VERSION or (
+                not force and fingerprint != get_fingerprint()):
+            raise SnapshotError(
+                'The snapshot was made with different settings.')
+        files = []
+        for member in archive.getmembers():
+            if not member.isfile() or member.name == MANIFEST_NAME:
+                continue
+            if member.name == STATE_NAME:
+                destination = state_file
+            else:
+                prefix, _, name = member.name.partition('/')
+                name = os.path.normpath(name)
+                if name.startswith(os.pardir) or os.path.isabs(name):
+                    raise SnapshotError(
+                        'Unsafe path in snapshot: {0}'.format(member.name))
+                if destinations.get(prefix) is None:
+                    continue
+                destination = os.path.join(destinations[prefix], name)
+            files.append((member, destination))
+        if clear:
+            root = settings.STATIC_PREPROCESSOR_ROOT
+            shutil.rmtree(root, ignore_errors=True)
+            os.makedirs(root)
+        for member, destination in files:
+            directory = os.path.dirname(os.path.abspath(destination))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            source = archive.extractfile(member)
+            with open(destination, 'wb') as f:
+                shutil.copyfileobj(source, f)
+    return len(files)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import tempfile
+
+from staticpreprocessor.utils import file_hash
+
+
+log = logging.getLogger(__name__)
+
+
+class BuildState(object):
+    '''
+    A record of previous ``preprocess_static`` runs, stored as JSON at
+    ``path``.
+
+    The state holds the hash, size and modification time of each collected
+    file, and for each processor its configuration fingerprint, the hashes
+    of its inputs, the hashes and sizes of its outputs and how long it took.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = bool(path)
+        self.data = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                try:
+                    self.data = json.load(f)
+                except ValueError:
+                    log.warning(
+                        'Ignoring the unreadable build state in "%s"', path)
+            if not isinstance(self.data, dict):
+                log.warning('Ignoring the invalid build state in "%s"', path)
+                self.data = {}
+
+    @property
+    def files(self):
+        return self.data.setdefault('files', {})
+
+    def hash_file(self, name, path):
+        '''
+        Returns the hash of the file at ``path``, recording it under
+        ``name``. The file is only read if its size or modification time
+        differ from those recorded.
+        '''
+        stat = os.stat(path)
+        record = self.files.get(name)
+        if record is not None and record['size'] == stat.st_size and \
+                record['mtime'] == stat.st_mtime:
+            return record['hash']
+        digest = file_hash(path)
+        self.files[name] = {
+            'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        return digest
+
+    def prune_files(self, names):
+        '''
+        Forgets every recorded file that isn't in ``names``.
+        '''
+        for name in set(self.files) - set(names):
+            del self.files[name]
+
+    def is_up_to_date(self, key, fingerprint, inputs, outputs):
+        '''
+        Returns whether the processor identified by ``key`` last ran with the
+        same configuration ``fingerprint`` and ``inputs``, and produced the
+        ``outputs`` that currently exist.
+        '''
+        record = self.processors.get(key, {})
+        return bool(outputs) and \
+            record.get('fingerprint') == fingerprint and \
+            record.get('inputs') == inputs and \
+            record.get('outputs') == outputs
+
+    @property
+    def processors(self):
+        return self.data.setdefault('processors', {})
+
+    @property
+    def collect(self):
+        return self.data.setdefault('collect', {})
+
+    def get_duration(self, key):
+        '''
+        Returns the duration in seconds of the last run of the processor
+        identified by ``key``, or ``None`` if it hasn't been run before.
+        '''
+        return self.processors.get(key, {}).get('duration')
+
+    def get_processor(self, key):
+        '''
+        Returns the statistics recorded for the last run of the processor
+        identified by ``key``, e.g. its ``duration``, and the ``size`` and
+        ``gzip_size`` of its outputs.
+        '''
+        return dict(self.processors.get(key, {}))
+
+    def record_processor(self, key, **stats):
+        self.processors.setdefault(key, {}).update(stats)
+
+    def record_collect(self, files, duration):
+        self.collect.update({'files': files, 'duration': duration})
+
+    def estimate_collect(self, files):
+        '''
+        Returns the expected duration in seconds of collecting ``files``
+        files, based on the rate of the last collect, or ``None``.
+        '''
+        if not self.collect.get('files'):
+            return None
+        return self.collect['duration'] * files / self.collect['files']
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def get_build_state():
+    '''
+    Returns the ``BuildState`` for the ``STATIC_PREPROCESSOR_STATE_FILE``
+    setting. If the setting is ``None`` the state is not persisted.
+    '''
+    from staticpreprocessor.conf import settings
+    return BuildState(settings.STATIC_PREPROCESSOR_STATE_FILE)
+
+
+def get_processor_keys(processors):
+    '''
+    Returns a list of keys identifying each of ``processors`` between runs,
+    made up of the processor's class and outputs.
+    '''
+    keys = []
+    for processor in processors:
+        key = '{0}.{1}:{2}'.format(
+            processor.__class__.__module__, processor.__class__.__name__,
+            ','.join(processor.get_outputs()))
+        count = 1
+        unique_key = key
+        while unique_key in keys:
+            count += 1
+            unique_key = '{0}#{1}'.format(key, count)
+        keys.append(unique_key)
+    return keys
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+from django.utils.six import string_types
+
+from staticpreprocessor.utils import file_hash, walk_files
+
+
+class StorageSync(object):
+    '''
+    Uploads the files in the local ``source`` storage, where they were
+    collected and processed, to the ``destination`` storage, which may be any
+    Django storage backend.
+
+    A manifest of the hash of each uploaded file is kept in the destination,
+    so only files that have changed since the last sync are uploaded, and
+    files that have gone are deleted, without reading anything else from the
+    destination. Uploads run in parallel, one file at a time per worker,
+    or in batches of :py:attr:`batch_size` files once there are enough
+    files for every worker to get several batches.
+    '''
+
+    manifest_name = 'staticpreprocessor-manifest.json'
+    batch_size = 20
+    # The number of batches each worker must have before uploads are batched
+    min_batches = 4
+
+    def __init__(self, source, destination, workers=None):
+        self.source = source
+        self.destination = destination
+        self.workers = workers
+
+    def get_manifest(self):
+        '''
+        Returns the manifest of the last sync, mapping file names to hashes.
+        '''
+        if not self.destination.exists(self.manifest_name):
+            return {}
+        with self.destination.open(self.manifest_name) as f:
+            return json.loads(f.read().decode('utf-8')).get('files', {})
+
+    def save_manifest(self, files):
+        content = json.dumps({'files': files}, indent=2, sort_keys=True)
+        if self.destination.exists(self.manifest_name):
+            self.destination.delete(self.manifest_name)
+        self.destination.save(
+            self.manifest_name, ContentFile(content.encode('utf-8')))
+
+    def get_local_files(self):
+        '''
+        Returns a dictionary mapping the name of each file in the source
+        storage to its hash.
+        '''
+        root = self.source.path('')
+        return dict(
+            (name.replace(os.sep, '/'), file_hash(os.path.join(root, name)))
+            for name in walk_files(root)
+        )
+
+    def upload(self, name):
+        if self.destination.exists(name):
+            self.destination.delete(name)
+        with open(self.source.path(name), 'rb') as f:
+            self.destination.save(name, File(f))
+        return name
+
+    def sync(self):
+        '''
+        Brings the destination up to date with the source, and returns the
+        lists of names uploaded and deleted.
+        '''
+        manifest = self.get_manifest()
+        files = self.get_local_files()
+        changed = sorted(
+            name for name, digest in files.items()
+            if manifest.get(name) != digest
+        )
+        removed = sorted(set(manifest) - set(files))
+        if changed:
+            workers = min(self.workers or cpu_count(), len(changed))
+            if len(changed) >= workers * self.batch_size * self.min_batches:
+                chunksize = self.batch_size
+            else:
+                chunksize = 1
+            pool = ThreadPool(workers)
+            try:
+                uploaded = sorted(pool.imap_unordered(
+                    self.upload, changed, chunksize))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            uploaded = []
+        for name in removed:
+            if self.destination.exists(name):
+                self.destination.delete(name)
+        self.save_manifest(files)
+        return uploaded, removed
+
+
+def get_remote_storage():
+    '''
+    Returns the storage described by the
+    ``STATIC_PREPROCESSOR_REMOTE_STORAGE`` setting, or ``None`` if the
+    processed files aren't synced anywhere.
+
+    The setting may be a storage instance, a dotted path to a storage class
+    or a tuple of a dotted path and a dictionary of keyword arguments.
+    '''
+    from staticpreprocessor.conf import settings
+    remote = settings.STATIC_PREPROCESSOR_REMOTE_STORAGE
+    if remote is None or hasattr(remote, 'save'):
+        return remote
+    try:
+        if isinstance(remote, (tuple, list)):
+            klass, kwargs = remote[0], remote[1]
+        else:
+            klass, kwargs = remote, {}
+        if isinstance(klass, string_types):
+            klass = get_storage_class(klass)
+        return klass(**kwargs)
+    except (IndexError, TypeError, ValueError, ImportError, AttributeError,
+            ImproperlyConfigured):
+        raise ImproperlyConfigured(
+            '"{0}" is an invalid remote storage'.format(remote))
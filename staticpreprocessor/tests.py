@@ -1,23 +1,57 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
+import io
+import json
 import os
 import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
 
-from django.core.exceptions import ImproperlyConfigured
+from django.contrib.staticfiles.finders import BaseFinder
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
 from django.core.management import call_command
-from django.test import TestCase
+from django.core.management.base import CommandError
+from django.test import RequestFactory, TestCase as DjangoTestCase
 from django.test.utils import override_settings
+from django.utils.six import StringIO
 from mock import patch, MagicMock
 
+from staticpreprocessor.cache import (
+    DjangoCompileCache, FileSystemCompileCache, get_compile_cache,
+)
+from staticpreprocessor import compat, processors, snapshot
 from staticpreprocessor.conf import StaticPreprocessorAppConf, settings
-from staticpreprocessor.contrib.processors import sass, less
-from staticpreprocessor.finders import FileSystemFinder, get_finders
+from staticpreprocessor.contrib.processors import (
+    concat, handlebars, images, sass, less,
+)
+from staticpreprocessor.finders import (
+    FileSystemFinder, FastFileSystemFinder, find, get_app_locations,
+    get_finder, get_finders,
+)
+from staticpreprocessor.lock import BuildLock, get_build_lock
+from staticpreprocessor.management.commands.preprocess_static import (
+    Command,
+)
+from staticpreprocessor.middleware import PreprocessorMiddleware
+from staticpreprocessor.patterns import PatternSet
 from staticpreprocessor.processors import (
     BaseProcessor, BaseListProcessor, BaseFileProcessor, CommandProcessorMixin,
-    CommandListProcessor, CommandFileProcessor,
+    CommandListProcessor, CommandFileProcessor, CommandRunner, LazyProcessor,
+    PipelineProcessor, get_processors,
 )
+from staticpreprocessor.progress import Progress, format_size
 from staticpreprocessor.storage import StaticPreprocessorFileStorage
+from staticpreprocessor.sync import StorageSync, get_remote_storage
+from staticpreprocessor.utils import FileSet, in_shard, walk_files
 
 
 TEST_PROJECT = os.path.abspath(
@@ -25,6 +59,152 @@ TEST_PROJECT = os.path.abspath(
 )
 
 
+class TestCase(DjangoTestCase):
+    '''
+    Removes the build lock file that ``preprocess_static`` leaves beside
+    the test project's ``STATIC_PREPROCESSOR_ROOT`` after each test.
+    '''
+
+    def _post_teardown(self):
+        super(TestCase, self)._post_teardown()
+        lock_path = os.path.join(TEST_PROJECT, 'processedstatic.lock')
+        if os.path.exists(lock_path):
+            os.remove(lock_path)
+
+
+class ConcatenatingProcessor(BaseListProcessor):
+
+    extensions = ['.txt']
+    output = 'concatenated.out'
+
+    def get_outputs(self):
+        return [self.output]
+
+    def handle_list(self, file_list, **kwargs):
+        content = ''
+        for file in sorted(file_list):
+            with open(file) as f:
+                content += f.read()
+        self.storage.save(self.output, ContentFile(content))
+
+
+class UppercasingProcessor(BaseFileProcessor):
+
+    extensions = ['.up']
+    remove_processed_files = False
+
+    def handle_file(self, file, **kwargs):
+        with open(file) as f:
+            content = f.read()
+        with open(file, 'w') as f:
+            f.write(content.upper())
+
+
+class ElsewhereFinder(BaseFinder):
+    '''
+    A finder that isn't one of staticpreprocessor's, and so has to be asked
+    with its own ``find()``.
+    '''
+
+    def find(self, path, all=False):
+        match = '/elsewhere/{0}'.format(path)
+        return [match] if all else match
+
+    def list(self, ignore_patterns):
+        return []
+
+
+class NonLocalStorage(Storage):
+    '''
+    A storage without local paths, like a remote one, that keeps its files
+    in ``location`` through a ``FileSystemStorage``.
+    '''
+
+    def __init__(self, location):
+        self.files = FileSystemStorage(location=location)
+
+    def _open(self, name, mode='rb'):
+        return self.files.open(name, mode)
+
+    def _save(self, name, content):
+        return self.files.save(name, content)
+
+    def delete(self, name):
+        self.files.delete(name)
+
+    def exists(self, name):
+        return self.files.exists(name)
+
+    def listdir(self, path):
+        return self.files.listdir(path)
+
+    def size(self, name):
+        return self.files.size(name)
+
+
+class AppendingProcessor(BaseFileProcessor):
+
+    extensions = ['.up']
+    remove_processed_files = False
+
+    def handle_file(self, file, **kwargs):
+        with open(file, 'a') as f:
+            f.write('!')
+
+
+def fake_popen(function):
+    '''
+    Returns a stand-in for ``subprocess.Popen`` whose processes exit with the
+    code returned by calling ``function`` with the command's arguments.
+    '''
+    def popen(args, **kwargs):
+        process = MagicMock()
+        process.returncode = function(args)
+        process.communicate.return_value = (b'', b'')
+        return process
+    return popen
+
+
+def make_png(width=16, height=16, level=0, text=b''):
+    '''
+    Returns the content of a grey PNG image, compressed at zlib ``level``.
+    '''
+    def chunk(type, data):
+        return (struct.pack('>I', len(data)) + type + data +
+                struct.pack('>I', zlib.crc32(type + data) & 0xffffffff))
+    rows = b''.join(b'\x00' + b'\x80' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0,
+                                       0, 0)) +
+            (chunk(b'tEXt', b'Comment\x00' + text) if text else b'') +
+            chunk(b'IDAT', zlib.compress(rows, level)) +
+            chunk(b'IEND', b''))
+
+
+def recompress_png(content):
+    '''
+    A pure-Python stand-in for a PNG optimiser, which drops text chunks and
+    recompresses the image data at the highest level.
+    '''
+    output, offset = content[:8], 8
+    while offset < len(content):
+        length, = struct.unpack('>I', content[offset:offset + 4])
+        type = content[offset + 4:offset + 8]
+        data = content[offset + 8:offset + 8 + length]
+        offset += length + 12
+        if type == b'tEXt':
+            continue
+        if type == b'IDAT':
+            data = zlib.compress(zlib.decompress(data), 9)
+        output += (struct.pack('>I', len(data)) + type + data +
+                   struct.pack('>I', zlib.crc32(type + data) & 0xffffffff))
+    return output
+
+
+def fake_webp(content):
+    return b'RIFFWEBP' + content[:4]
+
+
 class TestConf(TestCase):
 
     @override_settings(STATIC_PREPROCESSOR_ROOT=None)
@@ -119,6 +299,160 @@ class TestAppDirectoriesFinder(TestCase):
             self.assertEqual(f.read().strip(), 'I am an application test file')
 
 
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+        'staticpreprocessor.finders.FastAppDirectoriesFinder',
+    ],
+    INSTALLED_APPS=['test_app', 'staticpreprocessor'],
+)
+class TestFastFinders(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+        os.makedirs(self.post)
+        for dir in ('css', 'ignored', 'css/.hidden'):
+            os.makedirs(os.path.join(self.pre, dir))
+        for name in ('css/a.css', 'ignored/b.css', 'css/.hidden/c.css',
+                     'root.txt', 'root.txt~'):
+            with open(os.path.join(self.pre, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def test_walk_files(self):
+        self.assertEqual(
+            sorted(walk_files(self.pre)),
+            sorted([os.path.join('css', 'a.css'),
+                    os.path.join('ignored', 'b.css'),
+                    os.path.join('css', '.hidden', 'c.css'),
+                    'root.txt', 'root.txt~'])
+        )
+
+    def test_walk_files_prunes_ignored(self):
+        self.assertEqual(
+            sorted(walk_files(self.pre, ['ignored', '.*', '*~'])),
+            sorted([os.path.join('css', 'a.css'), 'root.txt'])
+        )
+
+    def test_walk_files_gitignore_rules(self):
+        self.assertEqual(
+            sorted(walk_files(self.pre, ['/css/', '*', '!*.txt', '!/css/'])),
+            ['root.txt'])
+        self.assertEqual(
+            sorted(walk_files(self.pre, ['css/.hidden/', '*.txt*'])),
+            sorted([os.path.join('css', 'a.css'),
+                    os.path.join('ignored', 'b.css')]))
+
+    @override_settings(STATIC_PREPROCESSOR_IGNORE_PATTERNS=['ignored/', '.*'])
+    def test_ignore_patterns_setting(self):
+        expected = sorted([os.path.join('css', 'a.css'), 'root.txt',
+                           'root.txt~'])
+        for finder in (FileSystemFinder(), FastFileSystemFinder()):
+            self.assertEqual(
+                sorted(path for path, storage in finder.list([])), expected)
+        self.assertEqual(
+            sorted(path for path, storage in FileSystemFinder().list(['*~'])),
+            expected[:2])
+        storage = StaticPreprocessorFileStorage(location=self.pre)
+        processor = BaseProcessor(storage=storage)
+        with override_settings(STATIC_PREPROCESSOR_ROOT=self.pre):
+            self.assertEqual(
+                sorted(processor.get_file_list()),
+                [os.path.join(self.pre, path) for path in expected])
+
+    def test_walk_files_missing_root(self):
+        self.assertEqual(
+            list(walk_files(os.path.join(self.pre, 'missing'))), [])
+
+    def test_list(self):
+        finder = FastFileSystemFinder()
+        self.assertEqual(
+            sorted(path for path, storage in finder.list(['ignored'])),
+            sorted([os.path.join('css', 'a.css'),
+                    os.path.join('css', '.hidden', 'c.css'),
+                    'root.txt', 'root.txt~'])
+        )
+
+    def test_find(self):
+        self.assertEqual(
+            find('css/a.css'), os.path.join(self.pre, 'css', 'a.css'))
+        self.assertEqual(
+            find('testappfile.txt', all=True),
+            [os.path.abspath(os.path.join(
+                TEST_PROJECT, '..', 'test_app', 'rawstatic',
+                'testappfile.txt'))]
+        )
+        self.assertEqual(find('missing.css'), None)
+        self.assertEqual(find('missing.css', all=True), [])
+
+    def test_find_refreshes_index(self):
+        self.assertEqual(find('css/new.css'), None)
+        path = os.path.join(self.pre, 'css', 'new.css')
+        with open(path, 'w') as f:
+            f.write('new')
+        self.assertEqual(find('css/new.css'), path)
+        os.remove(path)
+        self.assertEqual(find('css/new.css'), None)
+
+    def test_find_misses_use_index(self):
+        with patch.object(
+                FastFileSystemFinder, 'list', autospec=True,
+                side_effect=FastFileSystemFinder.list) as list_files:
+            self.assertEqual(
+                find('css/a.css'), os.path.join(self.pre, 'css', 'a.css'))
+            for name in ('css/x.css', 'css/y.css', 'js/z.js', 'z.css',
+                         'missing/z.css'):
+                self.assertIsNone(find(name))
+            self.assertEqual(list_files.call_count, 1)
+            os.makedirs(os.path.join(self.pre, 'css', 'new'))
+            path = os.path.join(self.pre, 'css', 'new', 'x.css')
+            with open(path, 'w') as f:
+                f.write('new')
+            self.assertEqual(find('css/new/x.css'), path)
+            self.assertEqual(list_files.call_count, 2)
+
+    @override_settings(STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+        'staticpreprocessor.tests.ElsewhereFinder',
+    ])
+    def test_find_other_finders(self):
+        self.assertEqual(
+            find('css/a.css'), os.path.join(self.pre, 'css', 'a.css'))
+        self.assertEqual(find('css/b.css'), '/elsewhere/css/b.css')
+        self.assertEqual(
+            find('css/a.css', all=True),
+            [os.path.join(self.pre, 'css', 'a.css'), '/elsewhere/css/a.css'])
+
+    def test_installed_apps_without_app_registry(self):
+        installed_apps = compat.get_installed_apps()
+        with patch.object(compat, 'apps', None):
+            self.assertEqual(compat.get_installed_apps(), installed_apps)
+
+    def test_finders_cached(self):
+        path = 'staticpreprocessor.finders.FastFileSystemFinder'
+        self.assertIs(get_finder(path), get_finder(path))
+
+    def test_app_locations_cached(self):
+        locations = get_app_locations('rawstatic')
+        self.assertEqual([app for app, location in locations], ['test_app'])
+        with patch('os.path.isdir') as isdir:
+            self.assertIs(get_app_locations('rawstatic'), locations)
+            self.assertFalse(isdir.called)
+
+    def test_collection(self):
+        call_command('preprocess_static', interactive=False, clear=True)
+        for name in ('css/a.css', 'root.txt', 'testappfile.txt'):
+            self.assertTrue(os.path.exists(os.path.join(self.post, name)))
+
+
 class TestBaseProcessor(TestCase):
 
     files = [
@@ -203,19 +537,48 @@ class TestBaseListProcessor(TestCase):
         with patch.object(processor, 'handle_list') as handle_list:
             processor.handle()
             handle_list.assert_called_with(
-                get_files.return_value, **{'remove_processed_files': False})
+                self.files, **{'remove_processed_files': False})
+        self.assertEqual(get_files.call_count, 1)
 
     @patch('staticpreprocessor.processors.get_files')
     def test_handle_list_deletes(self, get_files):
         get_files.return_value = (f for f in self.files)
         processor = BaseListProcessor(remove_processed_files=True)
         storage = MagicMock()
+        storage.path.side_effect = lambda f: f
         processor.storage = storage
         with patch.object(processor, 'handle_list') as handle_list:
             processor.handle()
             handle_list.assert_called_with(
-                get_files.return_value, **{'remove_processed_files': True})
+                self.files, **{'remove_processed_files': True})
             self.assertEqual(storage.delete.call_count, 4)
+        self.assertEqual(get_files.call_count, 1)
+
+    @patch('staticpreprocessor.processors.get_files')
+    def test_handle_no_files(self, get_files):
+        get_files.return_value = iter([])
+        processor = BaseListProcessor()
+        with patch.object(processor, 'handle_list') as handle_list:
+            processor.handle()
+            self.assertFalse(handle_list.called)
+        processor = CommandListProcessor(require_input=False)
+        get_files.return_value = iter([])
+        with patch.object(processor, 'handle_list') as handle_list:
+            processor.handle()
+            handle_list.assert_called_with([], require_input=False)
+
+    @patch('staticpreprocessor.processors.get_files')
+    def test_handle_keeps_outputs(self, get_files):
+        get_files.return_value = (f for f in self.files)
+        storage = MagicMock()
+        storage.path.side_effect = lambda f: os.path.join('/', f)
+        processor = CommandListProcessor(
+            output='path/to/some/file.txt', storage=storage)
+        with patch.object(processor, 'handle_list'):
+            processor.handle()
+        self.assertEqual(
+            sorted(c[0][0] for c in storage.delete.call_args_list),
+            sorted(self.files[1:]))
 
 
 class TestBaseFileProcessor(TestCase):
@@ -234,7 +597,7 @@ class TestCommandProcessorMixin(TestCase):
     def test_bails_on_no_input(self, subprocess):
         mixin = CommandProcessorMixin(require_input=True)
         mixin.run_command('')
-        self.assertFalse(subprocess.call.called)
+        self.assertFalse(subprocess.Popen.called)
 
     def test_get_command(self):
         mixin = CommandProcessorMixin()
@@ -245,7 +608,7 @@ class TestCommandProcessorMixin(TestCase):
 
     @patch('staticpreprocessor.processors.subprocess')
     def test_run_command(self, subprocess):
-        subprocess.call.return_value = 0
+        subprocess.Popen.side_effect = fake_popen(lambda args: 0)
         storage = MagicMock()
         storage.path.side_effect = lambda f: os.path.join('/prefix/path/', f)
         mixin = CommandProcessorMixin(
@@ -254,12 +617,13 @@ class TestCommandProcessorMixin(TestCase):
             storage=storage,
         )
         mixin.run_command('input.txt')
-        subprocess.call.assert_called_with(
+        self.assertEqual(
+            subprocess.Popen.call_args[0][0],
             ['cat', 'input.txt', '>', '/prefix/path/js/processed.js'])
 
     @patch('staticpreprocessor.processors.subprocess')
     def test_run_command_failure(self, subprocess):
-        subprocess.call.return_value = 1
+        subprocess.Popen.side_effect = fake_popen(lambda args: 1)
         mixin = CommandProcessorMixin(
             output='js/processed.js',
             command='cat {input} > {output}',
@@ -267,6 +631,45 @@ class TestCommandProcessorMixin(TestCase):
         with self.assertRaises(RuntimeError):
             mixin.run_command('input.txt')
 
+    def test_stderr_reported(self):
+        mixin = CommandProcessorMixin()
+        with patch('staticpreprocessor.processors.log') as log:
+            with self.assertRaises(RuntimeError) as cm:
+                mixin.call(['sh', '-c', 'echo oops >&2; exit 3'])
+        self.assertTrue(log.warning.called)
+        self.assertIn('Got: 3', str(cm.exception))
+        self.assertIn('oops', str(cm.exception))
+
+    def test_timeout_retried(self):
+        mixin = CommandProcessorMixin(timeout=0.1, retries=1)
+        with patch('staticpreprocessor.processors.log') as log:
+            with self.assertRaises(RuntimeError) as cm:
+                mixin.call(['sleep', '5'])
+        self.assertIn('timed out', str(cm.exception))
+        self.assertIn('2 attempt(s)', str(cm.exception))
+        self.assertEqual(log.info.call_count, 2)
+
+    def test_limits(self):
+        runner = CommandProcessorMixin().get_runner()
+        self.assertEqual(runner.get_args(['true']), ['true'])
+        mixin = CommandProcessorMixin(
+            max_memory=2 ** 30, nice=1, cpu_affinity=[0])
+        self.assertEqual(
+            mixin.call(['sh', '-c', 'ulimit -v; nice'],
+                       stdout=subprocess.PIPE).split(),
+            [str(2 ** 20).encode('ascii'), b'1'])
+        mixin = CommandProcessorMixin(nice=1)
+        with self.assertRaises(RuntimeError) as cm:
+            mixin.call(['no-such-staticpreprocessor-command'])
+        self.assertIn('Got: 127', str(cm.exception))
+
+    def test_get_command_output(self):
+        mixin = CommandProcessorMixin(command='echo {input}')
+        self.assertEqual(mixin.get_command_output('input.txt'), b'input.txt\n')
+        mixin = CommandProcessorMixin(command='false')
+        with self.assertRaises(RuntimeError):
+            mixin.get_command_output('input.txt')
+
 
 class TestCommandProcessors(TestCase):
 
@@ -275,7 +678,9 @@ class TestCommandProcessors(TestCase):
         with patch.object(processor, 'run_command') as run_command:
             kwargs = {'a': 1, 'b': 2}
             processor.handle_list(['a.txt', 'b.js', 'c.css'], **kwargs)
-            run_command.assert_called_with('a.txt b.js c.css', **kwargs)
+            run_command.assert_called_with(
+                'a.txt b.js c.css', files=['a.txt', 'b.js', 'c.css'],
+                **kwargs)
 
     def test_handle_file(self):
         processor = CommandFileProcessor()
@@ -365,3 +770,2002 @@ class TestFindersExceptions(TestCase):
     def test_not_a_finder(self):
         with self.assertRaises(ImproperlyConfigured):
             list(get_finders())
+
+
+@override_settings(
+    DEBUG=True,
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.ConcatenatingProcessor',
+    ],
+)
+class TestPreprocessorMiddleware(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        self.write('a.txt', 'a')
+        self.write('b.txt', 'b')
+        self.middleware = PreprocessorMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.pre, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def request(self, path):
+        return self.middleware.process_request(self.factory.get(path))
+
+    @override_settings(DEBUG=False)
+    def test_not_used_without_debug(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            PreprocessorMiddleware()
+
+    def test_ignores_other_paths(self):
+        self.assertIsNone(self.request('/static/other.css'))
+        self.assertIsNone(self.request('/concatenated.out'))
+
+    def test_builds_and_caches(self):
+        with patch.object(
+                ConcatenatingProcessor, 'handle_list',
+                side_effect=ConcatenatingProcessor.handle_list,
+                autospec=True) as handle_list:
+            response = self.request('/static/concatenated.out')
+            self.assertEqual(response.content, b'ab')
+            response = self.request('/static/concatenated.out')
+            self.assertEqual(response.content, b'ab')
+            self.assertEqual(handle_list.call_count, 1)
+
+    def test_rebuilds_stale_inputs(self):
+        self.request('/static/concatenated.out')
+        self.write('b.txt', 'c', mtime=1)
+        self.assertEqual(
+            self.request('/static/concatenated.out').content, b'ac')
+        self.write('d.txt', 'd')
+        self.assertEqual(
+            self.request('/static/concatenated.out').content, b'acd')
+
+    @override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.UppercasingProcessor',
+        'staticpreprocessor.tests.AppendingProcessor',
+        ('staticpreprocessor.tests.ConcatenatingProcessor',
+         {'extensions': ['.up']}),
+    ])
+    def test_runs_processors_writing_inputs(self):
+        self.write('c.up', 'c')
+        self.write('d.up', 'd')
+        self.middleware = PreprocessorMiddleware()
+        self.assertEqual(
+            self.request('/static/concatenated.out').content, b'C!D!')
+
+    def test_caches_processors_and_files(self):
+        with patch.object(
+                processors, 'get_processors',
+                side_effect=processors.get_processors) as get_processors, \
+                patch.object(
+                    FastFileSystemFinder, 'list', autospec=True,
+                    side_effect=FastFileSystemFinder.list) as list_files:
+            self.request('/static/concatenated.out')
+            self.write('b.txt', 'c', mtime=1)
+            self.assertEqual(
+                self.request('/static/concatenated.out').content, b'ac')
+            self.assertEqual(get_processors.call_count, 1)
+            self.assertEqual(list_files.call_count, 1)
+            os.makedirs(os.path.join(self.pre, 'sub'))
+            self.write(os.path.join('sub', 'd.txt'), 'd')
+            self.assertEqual(
+                self.request('/static/concatenated.out').content, b'acd')
+            self.assertEqual(list_files.call_count, 2)
+
+    def test_builds_in_scratch_root(self):
+        with open(os.path.join(self.post, 'stray.txt'), 'w') as f:
+            f.write('stray')
+        self.assertEqual(
+            self.request('/static/concatenated.out').content, b'ab')
+        self.assertEqual(os.listdir(self.post), ['stray.txt'])
+        self.assertNotEqual(self.middleware.root, self.post)
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+)
+class TestCompileCache(TestCase):
+
+    def setUp(self):
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.cache_dir = tempfile.mkdtemp()
+        shutil.rmtree(self.post, ignore_errors=True)
+        os.makedirs(self.post)
+
+    def tearDown(self):
+        for dir in (self.post, self.cache_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def write(self, name, content):
+        with open(os.path.join(self.post, name), 'w') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.post, name)) as f:
+            return f.read()
+
+    def run_processor(self, **kwargs):
+        processor = CommandListProcessor(
+            extensions=['.txt'], command='cp {input} {output}',
+            output='copied.out', **kwargs)
+        processor.handle()
+        return processor
+
+    def assert_cached(self, cache):
+        with override_settings(STATIC_PREPROCESSOR_CACHE=cache):
+            self.write('input.txt', 'first')
+            self.run_processor()
+            self.assertEqual(self.read('copied.out'), 'first')
+            os.remove(os.path.join(self.post, 'copied.out'))
+            self.write('input.txt', 'first')
+            with patch('staticpreprocessor.processors.subprocess') as sp:
+                self.run_processor()
+                self.assertFalse(sp.Popen.called)
+            self.assertEqual(self.read('copied.out'), 'first')
+            self.write('input.txt', 'second')
+            self.run_processor()
+            self.assertEqual(self.read('copied.out'), 'second')
+
+    @override_settings(CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    })
+    def test_django_cache(self):
+        self.assert_cached(
+            ('staticpreprocessor.cache.DjangoCompileCache', {}))
+
+    def test_django_filebased_cache(self):
+        with override_settings(CACHES={
+            'default': {
+                'BACKEND':
+                    'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': self.cache_dir,
+            },
+        }):
+            self.assert_cached(DjangoCompileCache())
+
+    def test_filesystem_cache(self):
+        self.assert_cached(FileSystemCompileCache(self.cache_dir))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_cache_disabled(self):
+        cache = FileSystemCompileCache(self.cache_dir)
+        with override_settings(STATIC_PREPROCESSOR_CACHE=cache):
+            self.write('input.txt', 'first')
+            with patch.object(cache, 'get', return_value=None) as get:
+                self.run_processor(use_cache=False)
+                self.assertFalse(get.called)
+                self.write('input.txt', 'first')
+                self.run_processor()
+                self.assertTrue(get.called)
+
+    def test_in_place_not_cached(self):
+        cache = FileSystemCompileCache(self.cache_dir)
+        with override_settings(STATIC_PREPROCESSOR_CACHE=cache):
+            self.write('input.txt', 'first')
+            processor = CommandFileProcessor(
+                extensions=['.txt'], command='sed -i -e s/first/second/ '
+                '{input}', remove_processed_files=False)
+            self.assertIsNone(processor.get_cache_key('input.txt'))
+            processor.handle()
+        self.assertEqual(self.read('input.txt'), 'second')
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_key_for_paths_with_spaces(self):
+        processor = CommandListProcessor(
+            command='cp {input} {output}', output='copied.out')
+        self.write('input file.txt', 'first')
+        self.write('other.txt', 'other')
+        key = processor.get_cache_key('input file.txt')
+        self.assertIsNotNone(key)
+        self.assertIsNotNone(processor.get_cache_key(
+            'input file.txt other.txt', ['input file.txt', 'other.txt']))
+        self.write('input file.txt', 'second')
+        self.assertNotEqual(key, processor.get_cache_key('input file.txt'))
+
+    def test_key_independent_of_root(self):
+        processor = CommandListProcessor(command='cp {input} {output}')
+        self.write('input.txt', 'first')
+        key = processor.get_cache_key(os.path.join(self.post, 'input.txt'))
+        self.assertEqual(key, processor.get_cache_key('input.txt'))
+        self.assertIsNone(processor.get_cache_key('missing.txt'))
+
+    @override_settings(
+        STATIC_PREPROCESSOR_CACHE='staticpreprocessor.cache.Missing')
+    def test_invalid_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_compile_cache()
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+        'staticpreprocessor.finders.FastAppDirectoriesFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.ConcatenatingProcessor',
+    ],
+    INSTALLED_APPS=['test_app', 'staticpreprocessor'],
+)
+class TestPlan(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.state_dir = tempfile.mkdtemp()
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        for name in ('a.txt', 'testappfile.txt', 'style.css'):
+            with open(os.path.join(self.pre, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        for dir in (self.pre, self.post, self.state_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def plan(self):
+        stdout = StringIO()
+        call_command('preprocess_static', interactive=False, plan=True,
+                     verbosity=2, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_plan_is_read_only(self):
+        with patch.object(ConcatenatingProcessor, 'handle') as handle:
+            output = self.plan()
+            self.assertFalse(handle.called)
+        self.assertEqual(os.listdir(self.post), [])
+        self.assertIn(
+            'Would collect 3 file(s), skipping 1 hidden duplicate(s) '
+            '(no previous timing)', output)
+        self.assertIn('Would skip "{0}"'.format(os.path.abspath(os.path.join(
+            TEST_PROJECT, '..', 'test_app', 'rawstatic', 'testappfile.txt'))),
+            output)
+        self.assertIn(
+            'Would run processor ConcatenatingProcessor on 2 file(s) '
+            '(no previous timing)', output)
+        self.assertIn('    a.txt', output)
+        self.assertNotIn('    style.css', output)
+
+    def test_plan_uses_previous_timings(self):
+        state_file = os.path.join(self.state_dir, 'state.json')
+        with override_settings(STATIC_PREPROCESSOR_STATE_FILE=state_file):
+            call_command('preprocess_static', interactive=False, verbosity=0)
+            self.assertTrue(os.path.exists(state_file))
+            output = self.plan()
+        self.assertIn('Would collect 3 file(s), skipping 1 hidden '
+                      'duplicate(s) (estimated', output)
+        self.assertIn('Would run processor ConcatenatingProcessor on 2 '
+                      'file(s) (estimated', output)
+        self.assertIn('Estimated total time:', output)
+
+
+class TestProgress(TestCase):
+
+    def test_format_size(self):
+        self.assertEqual(format_size(10), '10 B')
+        self.assertEqual(format_size(1536), '1.5 KB')
+        self.assertEqual(format_size(3 * 1024 ** 3), '3.0 GB')
+
+    def test_rate_limited(self):
+        lines = []
+        clock = patch('staticpreprocessor.progress.time.time')
+        with clock as time:
+            time.return_value = 100.0
+            progress = Progress('Collecting', lines.append, total=4)
+            time.return_value = 100.5
+            progress.update(size=1024)
+            self.assertEqual(lines, [])
+            time.return_value = 101.0
+            progress.update(size=1024)
+            self.assertEqual(lines, [
+                'Collecting: 2/4 file(s), 2.0 KB, 2.0 file(s)/s, '
+                '2.0 KB/s, ETA 1.0s'])
+            time.return_value = 101.5
+            progress.update(size=1024)
+            self.assertEqual(len(lines), 1)
+            time.return_value = 102.0
+            progress.finish()
+        self.assertEqual(
+            lines[-1], 'Collecting: 3 file(s), 3.0 KB in 2.00s '
+            '(1.5 file(s)/s, 1.5 KB/s)')
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.ConcatenatingProcessor',
+        'staticpreprocessor.tests.UppercasingProcessor',
+    ],
+)
+class TestProgressCommand(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        for name in ('a.txt', 'b.txt', 'c.up'):
+            with open(os.path.join(self.pre, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def call(self, **options):
+        stdout = StringIO()
+        call_command('preprocess_static', interactive=False, stdout=stdout,
+                     **options)
+        return stdout.getvalue()
+
+    def test_progress(self):
+        output = self.call(verbosity=1, progress=True)
+        self.assertIn('Collected: 3 file(s), 14 B in', output)
+        self.assertIn('ConcatenatingProcessor: 2 file(s), 10 B in', output)
+        self.assertIn('UppercasingProcessor: 1 file(s), 4 B in', output)
+        self.assertNotIn('Copying', output)
+
+    def test_per_file_logging(self):
+        self.assertNotIn('Copying', self.call(verbosity=1))
+        self.assertIn('Copying', self.call(verbosity=2))
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+)
+class TestPipelineProcessor(TestCase):
+
+    def setUp(self):
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        shutil.rmtree(self.post, ignore_errors=True)
+        os.makedirs(self.post)
+        for name, content in (('a.txt', 'one\n'), ('b.txt', 'two\n')):
+            with open(os.path.join(self.post, name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.post, ignore_errors=True)
+
+    def read(self, name):
+        with open(os.path.join(self.post, name), 'rb') as f:
+            return f.read()
+
+    def test_command_stages(self):
+        processor = PipelineProcessor(
+            extensions=['.txt'], output='out.js',
+            stages=['cat {input}', 'tr a-z A-Z', 'sort -r'])
+        with patch.object(processor.storage, 'save',
+                          wraps=processor.storage.save) as save:
+            processor.handle()
+            self.assertEqual(save.call_count, 1)
+        self.assertEqual(sorted(os.listdir(self.post)), ['out.js'])
+        self.assertEqual(self.read('out.js'), b'TWO\nONE\n')
+
+    def test_mixed_stages(self):
+        processor = PipelineProcessor(
+            extensions=['.txt'], output='out.js',
+            stages=[lambda data: data.upper(),
+                    'sort',
+                    lambda data: data.replace(b'\n', b' ').strip() + b'!'])
+        processor.handle()
+        self.assertEqual(self.read('out.js'), b'ONE TWO!')
+
+    def test_no_input(self):
+        processor = PipelineProcessor(
+            extensions=['.css'], output='out.js', stages=['cat {input}'])
+        processor.handle()
+        self.assertFalse(os.path.exists(os.path.join(self.post, 'out.js')))
+
+    def test_failure(self):
+        processor = PipelineProcessor(
+            extensions=['.txt'], output='out.js',
+            stages=['cat {input}', 'false', 'cat'])
+        with self.assertRaises(RuntimeError):
+            processor.handle()
+        processor = PipelineProcessor(
+            extensions=['.txt'], output='out.js',
+            stages=['cat {input}', 'no-such-staticpreprocessor-command'])
+        with self.assertRaises(RuntimeError):
+            processor.handle()
+
+    def test_failure_reports_stderr(self):
+        processor = PipelineProcessor(
+            extensions=['.txt'], output='out.js',
+            stages=['cat {input}', 'ls /no/such/staticpreprocessor/dir'])
+        with patch('staticpreprocessor.processors.log') as log:
+            with self.assertRaises(RuntimeError) as cm:
+                processor.handle()
+        self.assertIn('No such file', str(cm.exception))
+        self.assertTrue(log.warning.called)
+
+    def test_limits(self):
+        processor = PipelineProcessor(
+            extensions=['.txt'], output='out.js', nice=1,
+            stages=['cat {input}', 'nice'])
+        processor.handle()
+        self.assertEqual(self.read('out.js'), b'1\n')
+
+    def test_timeout(self):
+        processor = PipelineProcessor(
+            extensions=['.txt'], output='out.js', timeout=0.1, retries=1,
+            stages=['cat {input}', 'sleep 5'])
+        with patch('staticpreprocessor.processors.log') as log:
+            with self.assertRaises(RuntimeError) as cm:
+                processor.handle()
+        self.assertIn('timed out', str(cm.exception))
+        self.assertIn('2 attempt(s)', str(cm.exception))
+        self.assertEqual(log.info.call_count, 2)
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+)
+class TestEntryPoints(TestCase):
+
+    def setUp(self):
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.cache_dir = tempfile.mkdtemp()
+        shutil.rmtree(self.post, ignore_errors=True)
+        os.makedirs(os.path.join(self.post, 'less'))
+        self.compiled = []
+
+    def tearDown(self):
+        for dir in (self.post, self.cache_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def write_sources(self, **sources):
+        defaults = {'main': 'main', 'admin': 'admin', '_mixins': 'mixins'}
+        defaults.update(sources)
+        for name, content in defaults.items():
+            with open(os.path.join(
+                    self.post, 'less', name + '.less'), 'w') as f:
+                f.write(content)
+
+    def fake_compile(self, args):
+        # Stands in for ``lessc input output``
+        input, output = args[-2:]
+        self.compiled.append(os.path.basename(input))
+        if not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        with open(input) as source:
+            with open(output, 'w') as f:
+                f.write(source.read().upper())
+        return 0
+
+    def run_processor(self):
+        processor = less.LessProcessor(entry_points={
+            'css/main.css': 'less/main.less',
+            'css/admin.css': 'less/admin.less',
+        })
+        self.compiled = []
+        with patch('staticpreprocessor.processors.subprocess.Popen',
+                   side_effect=fake_popen(self.fake_compile)):
+            processor.handle()
+        return processor
+
+    def read(self, name):
+        with open(os.path.join(self.post, name)) as f:
+            return f.read()
+
+    def test_outputs(self):
+        processor = less.LessProcessor(entry_points={'a.css': 'a.less'})
+        self.assertEqual(processor.get_outputs(), ['a.css'])
+        self.assertEqual(
+            less.LessProcessor().get_outputs(), ['less_styles.css'])
+
+    def test_compiles_each_entry(self):
+        self.write_sources()
+        self.run_processor()
+        self.assertEqual(sorted(self.compiled), ['admin.less', 'main.less'])
+        self.assertEqual(self.read('css/main.css'), 'MAIN')
+        self.assertEqual(self.read('css/admin.css'), 'ADMIN')
+        self.assertEqual(os.listdir(os.path.join(self.post, 'less')), [])
+
+    def test_missing_entry(self):
+        self.write_sources()
+        os.remove(os.path.join(self.post, 'less', 'admin.less'))
+        with self.assertRaises(RuntimeError):
+            self.run_processor()
+
+    def test_entries_cached(self):
+        with override_settings(
+                STATIC_PREPROCESSOR_CACHE=FileSystemCompileCache(
+                    self.cache_dir)):
+            self.write_sources()
+            self.run_processor()
+            self.write_sources()
+            self.run_processor()
+            self.assertEqual(self.compiled, [])
+            # An entry may import another, so changing one rebuilds both
+            self.write_sources(main='main2')
+            self.run_processor()
+            self.assertEqual(
+                sorted(self.compiled), ['admin.less', 'main.less'])
+            self.assertEqual(self.read('css/main.css'), 'MAIN2')
+            self.assertEqual(self.read('css/admin.css'), 'ADMIN')
+            self.write_sources(main='main2', _mixins='changed')
+            self.run_processor()
+            self.assertEqual(
+                sorted(self.compiled), ['admin.less', 'main.less'])
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+)
+class TestHandlebarsProcessor(TestCase):
+
+    def setUp(self):
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.cache_dir = tempfile.mkdtemp()
+        shutil.rmtree(self.post, ignore_errors=True)
+        for dir in ('admin', 'public'):
+            os.makedirs(os.path.join(self.post, dir))
+        self.compiled = []
+
+    def tearDown(self):
+        for dir in (self.post, self.cache_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def write_templates(self, **templates):
+        defaults = {'admin/list': 'list', 'admin/form': 'form',
+                    'public/page': 'page'}
+        defaults.update(templates)
+        for name, content in defaults.items():
+            with open(os.path.join(
+                    self.post, name + '.handlebars'), 'w') as f:
+                f.write(content)
+
+    def fake_compile(self, input, **kwargs):
+        # Stands in for ``handlebars input``
+        self.compiled.append(os.path.basename(input))
+        with open(input, 'rb') as f:
+            return b'[' + f.read() + b']'
+
+    def run_processor(self, **kwargs):
+        processor = handlebars.HandlebarsProcessor(**kwargs)
+        self.compiled = []
+        with patch.object(processor, 'get_command_output',
+                          side_effect=self.fake_compile):
+            processor.handle()
+        return processor
+
+    def read(self, name):
+        with open(os.path.join(self.post, name)) as f:
+            return f.read()
+
+    def test_get_command(self):
+        processor = handlebars.HandlebarsProcessor()
+        self.assertEqual(
+            processor.get_command(input='a.handlebars'),
+            'handlebars a.handlebars --known each --known if --known unless')
+        processor = handlebars.HandlebarsProcessor(
+            known_helpers=['t'], namespace='App.templates')
+        self.assertEqual(
+            processor.get_command(input='a.handlebars'),
+            'handlebars a.handlebars --known t --namespace App.templates')
+
+    def test_custom_command(self):
+        processor = handlebars.HandlebarsProcessor(
+            command='hbs {input} -o {output}{known_string}', known_helpers=[])
+        self.assertEqual(
+            processor.get_command(input='a.handlebars', output='out.js'),
+            'hbs a.handlebars -o out.js')
+        self.write_templates()
+        with patch.object(processor, 'run_command') as run_command:
+            processor.handle()
+        self.assertEqual(run_command.call_count, 1)
+        args, kwargs = run_command.call_args
+        self.assertEqual(kwargs['output'], 'handlebars_templates.js')
+        self.assertEqual(len(kwargs['files']), 3)
+
+    def test_single_bundle(self):
+        self.write_templates()
+        processor = self.run_processor()
+        self.assertEqual(processor.get_outputs(), ['handlebars_templates.js'])
+        self.assertEqual(
+            self.read('handlebars_templates.js'), '[form][list][page]')
+
+    def test_namespaced_bundles(self):
+        self.write_templates()
+        self.run_processor(bundles={
+            'js/admin.js': 'admin/*',
+            'js/all.js': '*',
+        })
+        self.assertEqual(self.read('js/admin.js'), '[form][list]')
+        self.assertEqual(self.read('js/all.js'), '[form][list][page]')
+
+    def test_namespace_per_bundle(self):
+        self.write_templates()
+        namespaces = {}
+
+        def fake_compile(input, namespace=None, **kwargs):
+            namespaces.setdefault(namespace, []).append(
+                os.path.basename(input))
+            return self.fake_compile(input)
+        processor = handlebars.HandlebarsProcessor(
+            bundles={'js/admin.js': 'admin/*', 'js/all.js': '*'},
+            namespace={'js/admin.js': 'Admin.templates'})
+        with patch.object(processor, 'get_command_output',
+                          side_effect=fake_compile):
+            processor.handle()
+        self.assertEqual(
+            sorted(namespaces['Admin.templates']),
+            ['form.handlebars', 'list.handlebars'])
+        self.assertEqual(len(namespaces[None]), 3)
+        self.assertEqual(
+            processor.get_command(
+                input='a.handlebars', namespace='Admin.templates'),
+            'handlebars a.handlebars --known each --known if --known unless'
+            ' --namespace Admin.templates')
+
+    def test_templates_cached(self):
+        with override_settings(
+                STATIC_PREPROCESSOR_CACHE=FileSystemCompileCache(
+                    self.cache_dir)):
+            self.write_templates()
+            self.run_processor()
+            self.assertEqual(len(self.compiled), 3)
+            self.write_templates(**{'public/page': 'changed'})
+            self.run_processor()
+            self.assertEqual(self.compiled, ['page.handlebars'])
+            self.assertEqual(
+                self.read('handlebars_templates.js'),
+                '[form][list][changed]')
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+)
+class TestConcatProcessor(TestCase):
+
+    def setUp(self):
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        shutil.rmtree(self.post, ignore_errors=True)
+        os.makedirs(os.path.join(self.post, 'vendor'))
+        self.files = {
+            'app.js': 'app();\n',
+            'util.js': 'util();\nmore();\n',
+            'vendor/jquery.js': 'jquery();\n',
+        }
+        for name, content in self.files.items():
+            with open(os.path.join(self.post, name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.post, ignore_errors=True)
+
+    def read(self, name):
+        with open(os.path.join(self.post, name)) as f:
+            return f.read()
+
+    def test_order(self):
+        concat.ConcatProcessor(
+            extensions=['.js'], output='all.js', order=['vendor/*']).handle()
+        self.assertEqual(
+            self.read('all.js'), 'jquery();\napp();\nutil();\nmore();\n')
+        self.assertFalse(os.path.exists(os.path.join(self.post, 'app.js')))
+
+    def test_requires_output(self):
+        with self.assertRaises(ImproperlyConfigured):
+            concat.ConcatProcessor(extensions=['.js']).handle()
+        self.assertEqual(self.read('app.js'), 'app();\n')
+
+    def test_non_local_storage(self):
+        concat.ConcatProcessor(
+            storage=NonLocalStorage(self.post), extensions=['.js'],
+            output='js/all.js', order=['vendor/*']).handle()
+        self.assertEqual(
+            self.read('js/all.js'), 'jquery();\napp();\nutil();\nmore();\n')
+        self.assertFalse(os.path.exists(os.path.join(self.post, 'app.js')))
+
+    def test_separator_and_banner(self):
+        concat.ConcatProcessor(
+            extensions=['.js'], output='all.js', separator=';\n',
+            banner='/* {name} */\n', remove_processed_files=False).handle()
+        self.assertEqual(self.read('all.js'), (
+            '/* app.js */\napp();\n;\n'
+            '/* util.js */\nutil();\nmore();\n;\n'
+            '/* vendor/jquery.js */\njquery();\n'))
+
+    def test_index(self):
+        processor = concat.ConcatProcessor(
+            extensions=['.js'], output='js/all.js', index='js/all.json',
+            banner='// {name}\n', buffer_size=4)
+        self.assertEqual(processor.get_outputs(), ['js/all.js', 'js/all.json'])
+        processor.handle()
+        content = self.read('js/all.js')
+        index = json.loads(self.read('js/all.json'))
+        self.assertEqual(index['output'], 'js/all.js')
+        self.assertEqual(
+            [entry['name'] for entry in index['files']],
+            ['app.js', 'util.js', 'vendor/jquery.js'])
+        self.assertEqual(
+            [entry['line'] for entry in index['files']], [2, 4, 7])
+        for entry in index['files']:
+            self.assertEqual(
+                content[entry['offset']:entry['offset'] + entry['length']],
+                self.files[entry['name']])
+
+    def test_output_not_concatenated(self):
+        processor = concat.ConcatProcessor(
+            extensions=['.js'], output='all.js', remove_processed_files=False)
+        processor.handle()
+        processor.handle()
+        self.assertEqual(
+            self.read('all.js'), 'app();\nutil();\nmore();\njquery();\n')
+
+
+class TestBudgets(TestCase):
+
+    def test_within_budget(self):
+        processor = BaseProcessor(
+            max_output_size=100, max_gzip_size=50, max_duration=1)
+        self.assertEqual(processor.check_budgets(
+            {'size': 100, 'gzip_size': 50, 'duration': 0.5}), [])
+
+    def test_over_budget(self):
+        processor = BaseProcessor(
+            max_output_size=100, max_gzip_size=50, max_duration=1)
+        self.assertEqual(processor.check_budgets(
+            {'size': 101, 'gzip_size': 51, 'duration': 2}), [
+            '101 bytes exceeds the budget of 100 bytes',
+            '51 bytes gzipped exceeds the budget of 50 bytes gzipped',
+            '2.00s exceeds the budget of 1.00s',
+        ])
+
+    def test_regression(self):
+        processor = BaseProcessor()
+        stats = {'size': 200, 'gzip_size': 50, 'duration': 2}
+        baseline = {'size': 100, 'gzip_size': 50, 'duration': 1.9}
+        self.assertEqual(processor.check_budgets(stats, baseline), [])
+        self.assertEqual(processor.check_budgets(stats, baseline, 0.5), [
+            '200 bytes is more than 50% up on 100 bytes last run',
+        ])
+
+    def test_regression_min_delta(self):
+        processor = BaseProcessor()
+        stats = {'size': 200, 'gzip_size': 50, 'duration': 0.02}
+        baseline = {'size': 100, 'gzip_size': 25, 'duration': 0.01}
+        self.assertEqual(len(processor.check_budgets(stats, baseline, 0.5)), 3)
+        self.assertEqual(processor.check_budgets(
+            stats, baseline, 0.5,
+            {'size': 100, 'gzip_size': 0, 'duration': 1.0}), [
+            '50 bytes gzipped is more than 50% up on 25 bytes gzipped '
+            'last run',
+        ])
+
+    @override_settings(
+        STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    )
+    def test_output_stats(self):
+        post = os.path.join(TEST_PROJECT, 'processedstatic')
+        shutil.rmtree(post, ignore_errors=True)
+        os.makedirs(post)
+        try:
+            with open(os.path.join(post, 'out.css'), 'w') as f:
+                f.write('a' * 1000)
+            processor = CommandListProcessor(output='out.css')
+            stats = processor.get_output_stats()
+            self.assertEqual(stats['size'], 1000)
+            self.assertTrue(0 < stats['gzip_size'] < 100)
+            processor = CommandListProcessor(output='missing.css')
+            self.assertEqual(
+                processor.get_output_stats(), {'size': 0, 'gzip_size': 0})
+        finally:
+            shutil.rmtree(post, ignore_errors=True)
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        ('staticpreprocessor.tests.ConcatenatingProcessor',
+         {'max_output_size': 4}),
+    ],
+    STATIC_PREPROCESSOR_BUDGET_REGRESSION=0.5,
+)
+class TestBudgetCommand(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.state_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.state_dir, 'state.json')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+
+    def tearDown(self):
+        for dir in (self.pre, self.post, self.state_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def run_command(self, content, **options):
+        with open(os.path.join(self.pre, 'a.txt'), 'w') as f:
+            f.write(content)
+        stderr = StringIO()
+        with override_settings(
+                STATIC_PREPROCESSOR_STATE_FILE=self.state_file):
+            call_command('preprocess_static', interactive=False,
+                         verbosity=0, stderr=stderr, **options)
+        return stderr.getvalue()
+
+    def test_warns(self):
+        self.assertEqual(self.run_command('abc'), '')
+        self.assertEqual(
+            self.run_command('abcde'),
+            'Budget exceeded by ConcatenatingProcessor: 5 bytes exceeds the '
+            'budget of 4 bytes\nBudget exceeded by ConcatenatingProcessor: '
+            '5 bytes is more than 50% up on 3 bytes last run\n'
+        )
+
+    def test_strict(self):
+        self.run_command('abc')
+        with self.assertRaises(CommandError):
+            self.run_command('abcde', strict_budgets=True)
+        # The baseline isn't updated by a failed strict run
+        with override_settings(STATIC_PREPROCESSOR_STRICT_BUDGETS=True):
+            with self.assertRaises(CommandError):
+                self.run_command('abcde')
+        self.assertEqual(self.run_command('abc', strict_budgets=True), '')
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.ConcatenatingProcessor',
+    ],
+)
+class TestIncrementalBuild(TestCase):
+
+    key = 'staticpreprocessor.tests.ConcatenatingProcessor:concatenated.out'
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.state_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.state_dir, 'state.json')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+
+    def tearDown(self):
+        for dir in (self.pre, self.post, self.state_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def run_command(self, content, **options):
+        with open(os.path.join(self.pre, 'a.txt'), 'w') as f:
+            f.write(content)
+        stdout = StringIO()
+        with override_settings(STATIC_PREPROCESSOR_STATE_FILE=self.state_file):
+            call_command('preprocess_static', interactive=False,
+                         verbosity=1, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def load_state(self):
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def test_state_file(self):
+        self.run_command('abc')
+        state = self.load_state()
+        digest = hashlib.sha1(b'abc').hexdigest()
+        self.assertEqual(state['files']['a.txt']['hash'], digest)
+        self.assertEqual(state['files']['a.txt']['size'], 3)
+        record = state['processors'][self.key]
+        self.assertEqual(record['inputs'], {'a.txt': digest})
+        self.assertEqual(record['outputs'], {'concatenated.out': {
+            'hash': digest, 'size': 3}})
+        self.assertEqual(len(record['fingerprint']), 40)
+        self.assertEqual(state['last_run']['collected'], 1)
+        self.assertEqual(state['last_run']['processors'], [self.key])
+
+    def test_corrupt_state_file(self):
+        self.run_command('abc')
+        with open(self.state_file, 'r+') as f:
+            f.truncate(10)
+        with patch('staticpreprocessor.state.log') as log:
+            output = self.run_command('abc', incremental=True)
+        self.assertTrue(log.warning.called)
+        self.assertIn('Running processor', output)
+        self.assertEqual(
+            self.load_state()['files']['a.txt']['hash'],
+            hashlib.sha1(b'abc').hexdigest())
+
+    def test_unchanged_processor_skipped(self):
+        self.assertIn('Running processor', self.run_command('abc'))
+        output = self.run_command('abc', incremental=True)
+        self.assertIn('Skipping unchanged processor', output)
+        self.assertNotIn('Running processor', output)
+        with open(os.path.join(self.post, 'concatenated.out')) as f:
+            self.assertEqual(f.read(), 'abc')
+
+    def test_output_matching_inputs(self):
+        with override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+                ('staticpreprocessor.contrib.processors.concat'
+                 '.ConcatProcessor',
+                 {'extensions': ['.txt'], 'output': 'bundle.txt'})]):
+            self.assertIn(
+                'Running processor', self.run_command('abc', incremental=True))
+            for run in range(2):
+                output = self.run_command('abc', incremental=True)
+                self.assertIn('Skipping unchanged processor', output)
+                self.assertNotIn('Running processor', output)
+                with open(os.path.join(self.post, 'bundle.txt')) as f:
+                    self.assertEqual(f.read(), 'abc')
+
+    def test_changed_inputs_rerun(self):
+        self.run_command('abc')
+        self.assertIn(
+            'Running processor', self.run_command('abcd', incremental=True))
+        with open(os.path.join(self.post, 'concatenated.out')) as f:
+            self.assertEqual(f.read(), 'abcd')
+
+    def test_changed_configuration_rerun(self):
+        self.run_command('abc')
+        with override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+                ('staticpreprocessor.tests.ConcatenatingProcessor',
+                 {'exclude_match': '*.tmp'})]):
+            output = self.run_command('abc', incremental=True)
+        self.assertIn('Running processor', output)
+
+    def test_changed_budget_skipped(self):
+        self.run_command('abc')
+        with override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+                ('staticpreprocessor.tests.ConcatenatingProcessor',
+                 {'max_output_size': 10})]):
+            output = self.run_command('abc', incremental=True)
+        self.assertIn('Skipping unchanged processor', output)
+
+    def test_missing_output_rerun(self):
+        self.run_command('abc')
+        os.remove(os.path.join(self.post, 'concatenated.out'))
+        self.assertIn(
+            'Running processor', self.run_command('abc', incremental=True))
+
+    def test_requires_state_file(self):
+        self.state_file = None
+        with self.assertRaises(CommandError):
+            self.run_command('abc', incremental=True)
+
+
+@patch.dict('staticpreprocessor.processors._tool_versions', clear=True)
+class TestFingerprints(TestCase):
+
+    def test_attributes(self):
+        self.assertNotEqual(
+            less.LessProcessor().get_fingerprint(),
+            less.LessProcessor(compress=False).get_fingerprint())
+        self.assertNotEqual(
+            sass.SassProcessor().get_fingerprint(),
+            sass.SassProcessor(compass=True).get_fingerprint())
+        self.assertNotEqual(
+            CommandListProcessor(command='cp {input} {output}')
+            .get_fingerprint(),
+            CommandListProcessor(command='mv {input} {output}')
+            .get_fingerprint())
+        self.assertEqual(
+            less.LessProcessor().get_fingerprint(),
+            less.LessProcessor().get_fingerprint())
+
+    def test_excluded_attributes(self):
+        self.assertEqual(
+            less.LessProcessor().get_fingerprint(),
+            less.LessProcessor(workers=2, timeout=10, max_output_size=100,
+                               storage=FileSystemStorage()).get_fingerprint())
+
+    def test_extra_kwargs(self):
+        self.assertNotEqual(
+            CommandListProcessor(command='cp {input} {flag}')
+            .get_fingerprint(),
+            CommandListProcessor(command='cp {input} {flag}', flag='-v')
+            .get_fingerprint())
+
+    def test_tool_version(self):
+        versions = iter([b'lessc 1.7.0', b'lessc 2.0.0'])
+        popen = MagicMock()
+        popen.return_value.communicate.side_effect = \
+            lambda: (next(versions), None)
+        with patch('subprocess.Popen', popen):
+            fingerprint = less.LessProcessor().get_fingerprint()
+            self.assertEqual(
+                fingerprint, less.LessProcessor().get_fingerprint())
+            self.assertEqual(popen.call_count, 1)
+            self.assertEqual(popen.call_args[0][0], ['lessc', '--version'])
+            self.assertEqual(
+                less.LessProcessor().get_configuration()['tool_version'],
+                'lessc 1.7.0')
+            # A new version of the tool is picked up once it is probed again
+            processors._tool_versions.clear()
+            self.assertNotEqual(
+                fingerprint, less.LessProcessor().get_fingerprint())
+
+    def test_missing_tool(self):
+        with patch('subprocess.Popen', side_effect=OSError):
+            configuration = less.LessProcessor().get_configuration()
+        self.assertEqual(configuration['tool_version'], '')
+
+    @override_settings(STATIC_PREPROCESSOR_VERSION_TIMEOUT=0.1)
+    def test_tool_version_timeout(self):
+        start = time.time()
+        self.assertEqual(processors.get_tool_version('sleep 5'), '')
+        self.assertLess(time.time() - start, 4)
+
+    def test_cache_key(self):
+        pre = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pre)
+        with open(os.path.join(pre, 'a.less'), 'w') as f:
+            f.write('a {}')
+        storage = FileSystemStorage(location=pre)
+        with patch('subprocess.Popen', side_effect=OSError):
+            key = less.LessProcessor(storage=storage).get_cache_key('a.less')
+            self.assertNotEqual(key, less.LessProcessor(
+                storage=storage, optimization=2).get_cache_key('a.less'))
+            processors._tool_versions['lessc --version'] = 'lessc 2.0.0'
+            self.assertNotEqual(key, less.LessProcessor(
+                storage=storage).get_cache_key('a.less'))
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+)
+class TestLazyProcessors(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        with open(os.path.join(self.pre, 'a.txt'), 'w') as f:
+            f.write('abc')
+
+    def tearDown(self):
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def run_command(self, *pre_processors):
+        stdout = StringIO()
+        with override_settings(STATIC_PREPROCESSOR_PROCESSORS=pre_processors):
+            call_command('preprocess_static', interactive=False,
+                         verbosity=1, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_declared_extensions(self):
+        processor = LazyProcessor('missing.Processor', {'extensions': ['.a']})
+        self.assertFalse(processor.may_have_inputs(['.b']))
+        self.assertTrue(processor.may_have_inputs(['.a', '.b']))
+        processor = LazyProcessor(
+            'staticpreprocessor.contrib.processors.less.LessProcessor')
+        self.assertEqual(processor.extensions, ['.less'])
+        processor = LazyProcessor('missing.Processor')
+        self.assertIsNone(processor.extensions)
+        self.assertTrue(processor.may_have_inputs([]))
+        processor = LazyProcessor('missing.Processor', {
+            'extensions': ['.a'], 'require_input': False})
+        self.assertTrue(processor.may_have_inputs([]))
+        self.assertTrue(
+            CommandListProcessor(extensions=['.a'], require_input=False)
+            .may_have_inputs([]))
+
+    def test_contrib_extensions(self):
+        from staticpreprocessor.contrib.processors import EXTENSIONS
+        declared = {}
+        for module in (concat, handlebars, images, sass, less):
+            for klass in vars(module).values():
+                if isinstance(klass, type) and \
+                        issubclass(klass, processors.BaseProcessor) and \
+                        klass.__module__ == module.__name__ and \
+                        klass.extensions is not None:
+                    declared['{0}.{1}'.format(
+                        klass.__module__, klass.__name__)] = klass.extensions
+        self.assertEqual(EXTENSIONS, declared)
+
+    def test_get_processors(self):
+        with override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+                'missing.Processor']):
+            self.assertIsInstance(
+                get_processors(lazy=True)[0], LazyProcessor)
+            with self.assertRaises(ImproperlyConfigured):
+                get_processors()
+
+    def test_unmatched_processors_not_imported(self):
+        output = self.run_command(
+            ('missing.Processor', {'extensions': ['.missing']}),
+            'staticpreprocessor.tests.ConcatenatingProcessor',
+        )
+        self.assertIn(
+            'Skipping processor with no matching files: missing.Processor',
+            output)
+        self.assertIn('Running processor: ConcatenatingProcessor', output)
+
+    def test_outputs_of_earlier_processors_match(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.run_command(
+                'staticpreprocessor.tests.ConcatenatingProcessor',
+                ('missing.Processor', {'extensions': ['.out']}),
+            )
+
+
+class TestStorageSync(TestCase):
+
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        self.remote_dir = tempfile.mkdtemp()
+        self.local = StaticPreprocessorFileStorage(location=self.local_dir)
+        self.remote = FileSystemStorage(location=self.remote_dir)
+        for name in ('a.css', 'js/b.js', 'js/c.js'):
+            self.write(name, name)
+
+    def tearDown(self):
+        for dir in (self.local_dir, self.remote_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def write(self, name, content):
+        self.local.save(name, ContentFile(content.encode('utf-8')))
+
+    def sync(self):
+        return StorageSync(self.local, self.remote, workers=2).sync()
+
+    def test_sync(self):
+        self.assertEqual(self.sync(), (['a.css', 'js/b.js', 'js/c.js'], []))
+        with self.remote.open('js/b.js') as f:
+            self.assertEqual(f.read(), b'js/b.js')
+        self.assertTrue(self.remote.exists(StorageSync.manifest_name))
+
+    def test_unchanged_files_skipped(self):
+        self.sync()
+        with patch.object(
+                self.remote, 'save', wraps=self.remote.save) as save:
+            self.assertEqual(self.sync(), ([], []))
+            # Only the manifest is written
+            self.assertEqual(save.call_count, 1)
+        self.write('js/b.js', 'changed')
+        self.local.delete('a.css')
+        self.assertEqual(self.sync(), (['js/b.js'], ['a.css']))
+        self.assertFalse(self.remote.exists('a.css'))
+        with self.remote.open('js/b.js') as f:
+            self.assertEqual(f.read(), b'changed')
+        self.assertEqual(self.remote.listdir('js')[1], ['b.js', 'c.js'])
+
+    @override_settings(
+        STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+        STATIC_PREPROCESSOR_FINDERS=[
+            'staticpreprocessor.finders.FastFileSystemFinder',
+        ],
+        STATIC_PREPROCESSOR_PROCESSORS=[
+            'staticpreprocessor.tests.ConcatenatingProcessor',
+        ],
+    )
+    def test_command(self):
+        pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        post = os.path.join(TEST_PROJECT, 'processedstatic')
+        for dir in (pre, post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        self.addCleanup(shutil.rmtree, pre, True)
+        self.addCleanup(shutil.rmtree, post, True)
+        with open(os.path.join(pre, 'a.txt'), 'w') as f:
+            f.write('abc')
+        with override_settings(STATIC_PREPROCESSOR_REMOTE_STORAGE=(
+                'django.core.files.storage.FileSystemStorage',
+                {'location': self.remote_dir})):
+            call_command('preprocess_static', interactive=False, verbosity=0)
+        with self.remote.open('concatenated.out') as f:
+            self.assertEqual(f.read(), b'abc')
+
+    @override_settings(
+        STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+        STATIC_PREPROCESSOR_FINDERS=[
+            'staticpreprocessor.finders.FastFileSystemFinder',
+        ],
+        STATIC_PREPROCESSOR_PROCESSORS=[
+            ('staticpreprocessor.contrib.processors.concat.ConcatProcessor',
+             {'extensions': ['.txt'], 'output': 'all.out'}),
+        ],
+    )
+    def test_command_stages_non_local_storage(self):
+        pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        post = os.path.join(TEST_PROJECT, 'processedstatic')
+        for dir in (pre, post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        self.addCleanup(shutil.rmtree, pre, True)
+        self.addCleanup(shutil.rmtree, post, True)
+        with open(os.path.join(pre, 'a.txt'), 'w') as f:
+            f.write('abc')
+        with patch('staticpreprocessor.storage.default_storage',
+                   NonLocalStorage(self.remote_dir)):
+            call_command('preprocess_static', interactive=False, verbosity=0)
+        with self.remote.open('all.out') as f:
+            self.assertEqual(f.read(), b'abc')
+        self.assertFalse(self.remote.exists('a.txt'))
+        self.assertTrue(os.path.exists(os.path.join(post, 'all.out')))
+
+    def test_uploads_in_parallel(self):
+        threads = set()
+        upload = StorageSync.upload
+
+        def slow_upload(sync, name):
+            threads.add(threading.current_thread())
+            time.sleep(0.1)
+            return upload(sync, name)
+        with patch.object(StorageSync, 'upload', slow_upload):
+            self.sync()
+        self.assertEqual(len(threads), 2)
+
+    def test_command_requires_local_storage(self):
+        command = Command()
+        command.local = False
+        with override_settings(
+                STATIC_PREPROCESSOR_REMOTE_STORAGE=self.remote), \
+                patch.object(command, 'collect') as collect:
+            with self.assertRaises(CommandError):
+                command.handle_noargs(interactive=False, clear=True)
+        self.assertFalse(collect.called)
+
+    @override_settings(STATIC_PREPROCESSOR_REMOTE_STORAGE='missing.Storage')
+    def test_invalid_remote_storage(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_remote_storage()
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.ConcatenatingProcessor',
+        'staticpreprocessor.tests.UppercasingProcessor',
+    ],
+)
+class TestShards(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.shards_dir = tempfile.mkdtemp()
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        for i in range(10):
+            with open(os.path.join(self.pre, '{0}.up'.format(i)), 'w') as f:
+                f.write('file {0}'.format(i))
+        for name in ('a.txt', 'b.txt'):
+            with open(os.path.join(self.pre, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        for dir in (self.pre, self.post, self.shards_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def run_command(self, **options):
+        call_command('preprocess_static', interactive=False, verbosity=0,
+                     **options)
+
+    def read_tree(self):
+        tree = {}
+        for name in walk_files(self.post):
+            with open(os.path.join(self.post, name)) as f:
+                tree[name] = f.read()
+        return tree
+
+    def run_shards(self, count):
+        directories = []
+        for number in range(1, count + 1):
+            self.run_command(shard='{0}/{1}'.format(number, count))
+            directory = os.path.join(self.shards_dir, str(number))
+            shutil.copytree(self.post, directory)
+            directories.append(directory)
+        return directories
+
+    def test_in_shard(self):
+        names = ['{0}.css'.format(i) for i in range(100)]
+        shards = [
+            set(name for name in names if in_shard(name, (i, 3)))
+            for i in range(3)
+        ]
+        self.assertEqual(sum(len(shard) for shard in shards), 100)
+        self.assertEqual(set().union(*shards), set(names))
+        self.assertTrue(all(shards))
+
+    def test_invalid_shard(self):
+        for shard in ('0/2', '3/2', 'a/b', '1'):
+            with self.assertRaises(CommandError):
+                self.run_command(shard=shard)
+
+    def test_merge_matches_unsharded_run(self):
+        self.run_command()
+        expected = self.read_tree()
+        self.assertEqual(expected['3.up'], 'FILE 3')
+        self.assertNotIn('a.txt', expected)
+        directories = self.run_shards(3)
+        self.assertNotEqual(self.read_tree(), expected)
+        self.run_command(merge=directories)
+        self.assertEqual(self.read_tree(), expected)
+
+    def test_merge_requires_every_shard(self):
+        directories = self.run_shards(2)
+        with self.assertRaises(CommandError):
+            self.run_command(merge=directories[:1])
+        with self.assertRaises(CommandError):
+            self.run_command(merge=[self.shards_dir])
+
+    @override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.UppercasingProcessor',
+        ('staticpreprocessor.tests.ConcatenatingProcessor',
+         {'extensions': ['.up']}),
+    ])
+    def test_processor_reading_earlier_outputs(self):
+        with self.assertRaises(CommandError):
+            self.run_command(shard='1/2')
+        self.run_command()
+        with open(os.path.join(self.post, 'concatenated.out')) as f:
+            self.assertEqual(f.read().count('FILE'), 10)
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[],
+)
+class TestDeduplication(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+        for app in ('one', 'two'):
+            os.makedirs(os.path.join(self.pre, app))
+            with open(os.path.join(self.pre, app, 'lib.up'), 'w') as f:
+                f.write('library')
+        with open(os.path.join(self.pre, 'one', 'app.up'), 'w') as f:
+            f.write('app')
+        os.makedirs(self.post)
+
+    def tearDown(self):
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.post, name)
+
+    def test_identical_files_linked(self):
+        with override_settings(STATIC_PREPROCESSOR_DEDUPLICATE=True):
+            call_command('preprocess_static', interactive=False, verbosity=0)
+        self.assertTrue(os.path.samefile(
+            self.path('one/lib.up'), self.path('two/lib.up')))
+        self.assertFalse(os.path.samefile(
+            self.path('one/lib.up'), self.path('one/app.up')))
+
+    def test_links_broken_before_processing(self):
+        with override_settings(STATIC_PREPROCESSOR_DEDUPLICATE=True):
+            call_command('preprocess_static', interactive=False, verbosity=0)
+            processor = AppendingProcessor()
+            processor.handle()
+        for name in ('one/lib.up', 'two/lib.up'):
+            with open(self.path(name)) as f:
+                self.assertEqual(f.read(), 'library!')
+        self.assertFalse(os.path.samefile(
+            self.path('one/lib.up'), self.path('two/lib.up')))
+
+    def test_not_linked_by_default(self):
+        call_command('preprocess_static', interactive=False, verbosity=0)
+        self.assertFalse(os.path.samefile(
+            self.path('one/lib.up'), self.path('two/lib.up')))
+
+    def test_duplicate_results_reused(self):
+        call_command('preprocess_static', interactive=False, verbosity=0)
+        processor = UppercasingProcessor(reuse_duplicates=True)
+        with patch.object(processor, 'handle_file',
+                          wraps=processor.handle_file) as handle_file:
+            processor.handle()
+        self.assertEqual(handle_file.call_count, 2)
+        for name in ('one/lib.up', 'two/lib.up'):
+            with open(self.path(name)) as f:
+                self.assertEqual(f.read(), 'LIBRARY')
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.UppercasingProcessor',
+    ],
+)
+class TestVariants(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.tmp = tempfile.mkdtemp()
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        for name, content in (('a.txt', 'a'), ('b.up', 'b')):
+            with open(os.path.join(self.pre, name), 'w') as f:
+                f.write(content)
+        self.variants = {
+            'debug': {
+                'ROOT': os.path.join(self.tmp, 'debug'),
+                'PROCESSORS': [
+                    'staticpreprocessor.tests.ConcatenatingProcessor',
+                ],
+            },
+            'release': {
+                'ROOT': os.path.join(self.tmp, 'release'),
+                'PROCESSORS': [
+                    ('staticpreprocessor.tests.ConcatenatingProcessor',
+                     {'output': 'release.out'}),
+                ],
+            },
+        }
+
+    def tearDown(self):
+        for dir in (self.pre, self.post, self.tmp):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def call(self, **options):
+        stdout = StringIO()
+        with override_settings(STATIC_PREPROCESSOR_VARIANTS=self.variants):
+            call_command('preprocess_static', interactive=False,
+                         verbosity=1, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def read(self, *path):
+        with open(os.path.join(self.tmp, *path)) as f:
+            return f.read()
+
+    def test_variants(self):
+        with patch.object(
+                Command, 'copy_file', autospec=True,
+                side_effect=Command.copy_file) as copy_file:
+            output = self.call()
+        self.assertEqual(copy_file.call_count, 2)
+        self.assertIn('[debug] Running processor: ConcatenatingProcessor',
+                      output)
+        # The shared processors run once, before the variants are copied
+        self.assertEqual(self.read('debug', 'b.up'), 'B')
+        self.assertEqual(self.read('debug', 'concatenated.out'), 'a')
+        self.assertEqual(self.read('release', 'release.out'), 'a')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmp, 'release', 'a.txt')))
+        self.assertEqual(
+            sorted(os.listdir(self.post)), ['a.txt', 'b.up'])
+
+    def test_select_variant(self):
+        self.call(variants=['release'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'debug')))
+        self.assertEqual(self.read('release', 'release.out'), 'a')
+        with self.assertRaises(CommandError):
+            self.call(variants=['missing'])
+
+    def test_invalid_root(self):
+        self.variants['debug']['ROOT'] = self.post
+        with self.assertRaises(CommandError):
+            self.call()
+        del self.variants['debug']['ROOT']
+        with self.assertRaises(CommandError):
+            self.call()
+
+    def test_copy_tree_removes_deleted_files(self):
+        source = os.path.join(self.tmp, 'source')
+        destination = os.path.join(self.tmp, 'destination')
+        os.makedirs(os.path.join(source, 'js'))
+        for name in ('a.txt', 'js/b.js'):
+            with open(os.path.join(source, name), 'w') as f:
+                f.write(name)
+        command = Command()
+        command.clear = False
+        command.verbosity = 0
+        command.copy_tree(source, destination)
+        os.remove(os.path.join(source, 'js', 'b.js'))
+        with open(os.path.join(destination, 'out.txt'), 'w') as f:
+            f.write('output')
+        command.copy_tree(source, destination, keep=['out.txt'])
+        self.assertEqual(
+            sorted(walk_files(destination)), ['a.txt', 'out.txt'])
+
+    def test_incremental(self):
+        state_file = os.path.join(self.tmp, 'state.json')
+        with override_settings(STATIC_PREPROCESSOR_STATE_FILE=state_file):
+            self.call()
+            output = self.call(incremental=True)
+        self.assertIn(
+            '[release] Skipping unchanged processor: ConcatenatingProcessor',
+            output)
+        self.assertEqual(self.read('release', 'release.out'), 'a')
+        with open(state_file) as f:
+            self.assertEqual(
+                json.load(f)['last_run']['variants']['release'],
+                ['release:staticpreprocessor.tests.ConcatenatingProcessor:'
+                 'release.out'])
+
+
+class TestBuildLock(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'static', 'root.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_exclusive(self):
+        first, second = BuildLock(self.path), BuildLock(self.path)
+        self.assertTrue(first.acquire(blocking=False))
+        self.assertTrue(first.locked)
+        self.assertFalse(second.acquire(blocking=False))
+        self.assertFalse(second.acquire(timeout=0.2))
+        self.assertFalse(second.locked)
+        first.release()
+        self.assertFalse(first.locked)
+        with second:
+            self.assertTrue(second.locked)
+            self.assertFalse(first.acquire(blocking=False))
+        self.assertTrue(first.acquire(blocking=False))
+        first.release()
+
+    def test_get_build_lock(self):
+        root = os.path.join(self.tmp, 'processed')
+        with override_settings(STATIC_PREPROCESSOR_ROOT=root + '/'):
+            self.assertEqual(get_build_lock().path, root + '.lock')
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.ConcatenatingProcessor',
+    ],
+)
+class TestConcurrentRuns(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.tmp = tempfile.mkdtemp()
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        self.write('abc')
+
+    def tearDown(self):
+        for dir in (self.pre, self.post, self.tmp):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def write(self, content):
+        with open(os.path.join(self.pre, 'a.txt'), 'w') as f:
+            f.write(content)
+
+    def call(self, **options):
+        stdout = StringIO()
+        with override_settings(STATIC_PREPROCESSOR_STATE_FILE=os.path.join(
+                self.tmp, 'state.json')):
+            call_command('preprocess_static', interactive=False,
+                         verbosity=1, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_fail_fast(self):
+        with BuildLock(self.post + '.lock'):
+            with self.assertRaises(CommandError):
+                self.call(wait=False)
+            with self.assertRaises(CommandError):
+                self.call(lock_timeout=0.2)
+        self.assertIn('Running processor', self.call(wait=False))
+
+    def test_wait(self):
+        lock = BuildLock(self.post + '.lock')
+        lock.acquire()
+        timer = threading.Timer(0.3, lock.release)
+        timer.start()
+        try:
+            output = self.call()
+        finally:
+            timer.cancel()
+            lock.release()
+        self.assertIn('Waiting for another preprocess_static run', output)
+        self.assertIn('Running processor', output)
+
+    def test_coalesce(self):
+        start = time.time()
+        self.call()
+        with patch.object(Command, 'acquire_lock', return_value=start):
+            output = self.call()
+            self.assertIn('Reusing the results of the run waited for',
+                          output)
+            self.assertNotIn('Running processor', output)
+            # A change to a processor's class isn't mistaken for a reusable
+            # run, even though its path and arguments are the same
+            with patch.object(
+                    ConcatenatingProcessor, 'exclude_match', 'b.txt'):
+                self.assertIn('Running processor', self.call())
+            self.write('abcd')
+            self.assertIn('Running processor', self.call())
+        # A run that finished before the wait began isn't reused
+        with patch.object(Command, 'acquire_lock',
+                          return_value=time.time() + 1):
+            self.assertIn('Running processor', self.call())
+
+
+class TestPatternSet(TestCase):
+
+    def test_names_match_at_any_depth(self):
+        patterns = PatternSet(['*.pyc', 'node_modules'])
+        self.assertTrue(patterns.match('a.pyc'))
+        self.assertTrue(patterns.match('js/lib/a.pyc'))
+        self.assertTrue(patterns.match('js/node_modules', is_dir=True))
+        self.assertFalse(patterns.match('js/a.py'))
+
+    def test_anchored(self):
+        patterns = PatternSet(['/build', 'docs/*.txt', 'vendor/**/test/'])
+        self.assertTrue(patterns.match('build', is_dir=True))
+        self.assertFalse(patterns.match('js/build', is_dir=True))
+        self.assertTrue(patterns.match('docs/a.txt'))
+        self.assertFalse(patterns.match('docs/sub/a.txt'))
+        self.assertTrue(patterns.match('vendor/test', is_dir=True))
+        self.assertTrue(patterns.match('vendor/a/b/test', is_dir=True))
+        self.assertFalse(patterns.match('vendor/a/test'))
+
+    def test_negation(self):
+        patterns = PatternSet([
+            '# comment', '', '*.css', '!keep.css', 'vendor/keep.css'])
+        self.assertTrue(patterns.match('a.css'))
+        self.assertFalse(patterns.match('css/keep.css'))
+        self.assertTrue(patterns.match('vendor/keep.css'))
+        self.assertFalse(patterns.match('# comment'))
+        self.assertFalse(PatternSet(['# only a comment']))
+
+    def test_character_classes(self):
+        patterns = PatternSet(['*.[ch]', 'file[!0-9]', r'\!important'])
+        self.assertTrue(patterns.match('a.c'))
+        self.assertFalse(patterns.match('a.o'))
+        self.assertTrue(patterns.match('filea'))
+        self.assertFalse(patterns.match('file1'))
+        self.assertTrue(patterns.match('!important'))
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_DIRS=[os.path.join(TEST_PROJECT, 'rawstatic')],
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+    STATIC_PREPROCESSOR_FINDERS=[
+        'staticpreprocessor.finders.FastFileSystemFinder',
+    ],
+    STATIC_PREPROCESSOR_PROCESSORS=[
+        'staticpreprocessor.tests.ConcatenatingProcessor',
+    ],
+)
+class TestSnapshots(TestCase):
+
+    def setUp(self):
+        self.pre = os.path.join(TEST_PROJECT, 'rawstatic')
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        self.state_file = os.path.join(self.tmp, 'state.json')
+        for dir in (self.pre, self.post):
+            shutil.rmtree(dir, ignore_errors=True)
+            os.makedirs(dir)
+        with open(os.path.join(self.pre, 'a.txt'), 'w') as f:
+            f.write('abc')
+        self.settings = override_settings(
+            STATIC_PREPROCESSOR_STATE_FILE=self.state_file,
+            STATIC_PREPROCESSOR_CACHE=(
+                'staticpreprocessor.cache.FileSystemCompileCache',
+                {'location': self.cache_dir}),
+        )
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        for dir in (self.pre, self.post, self.tmp):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def call(self, name, *args, **options):
+        stdout = StringIO()
+        call_command(name, *args, interactive=False, verbosity=1,
+                     stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def export(self):
+        self.call('preprocess_static')
+        FileSystemCompileCache(self.cache_dir).set('ab' * 20, b'cached')
+        archive = os.path.join(self.tmp, 'static-{fingerprint}.tar.gz')
+        self.call('preprocess_static_export', archive)
+        for path in (self.post, self.cache_dir, self.state_file):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        return archive
+
+    def test_round_trip(self):
+        archive = self.export()
+        fingerprint = self.call(
+            'preprocess_static_export', fingerprint=True).strip()
+        self.assertTrue(os.path.exists(
+            archive.format(fingerprint=fingerprint)))
+        self.assertIn('Imported 3 file(s)',
+                      self.call('preprocess_static_import', archive))
+        self.assertEqual(
+            FileSystemCompileCache(self.cache_dir).get('ab' * 20), b'cached')
+        output = self.call('preprocess_static', incremental=True)
+        self.assertIn('Skipping unchanged processor', output)
+        with open(os.path.join(self.post, 'concatenated.out')) as f:
+            self.assertEqual(f.read(), 'abc')
+
+    def test_settings_changed(self):
+        archive = self.export()
+        exported = archive.format(fingerprint=snapshot.get_fingerprint())
+        with override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+                ('staticpreprocessor.tests.ConcatenatingProcessor',
+                 {'exclude_match': '*.tmp'})]):
+            # The archive is keyed by fingerprint, so there is none to import
+            self.assertIn('No snapshot found',
+                          self.call('preprocess_static_import', archive))
+            with self.assertRaises(CommandError):
+                self.call('preprocess_static_import', exported)
+            self.call('preprocess_static_import', exported, force=True)
+        self.assertTrue(os.path.exists(self.state_file))
+
+    def test_no_state(self):
+        with self.assertRaises(CommandError):
+            self.call('preprocess_static_export', 'archive.tar.gz')
+
+    @patch.dict('staticpreprocessor.processors._tool_versions', clear=True)
+    def test_fingerprint_skips_unused_processors(self):
+        with override_settings(STATIC_PREPROCESSOR_PROCESSORS=[
+                'staticpreprocessor.tests.ConcatenatingProcessor',
+                'staticpreprocessor.contrib.processors.less.LessProcessor']):
+            with patch('subprocess.Popen') as popen:
+                fingerprint = snapshot.get_fingerprint()
+            self.assertFalse(popen.called)
+            with open(os.path.join(self.pre, 'a.less'), 'w') as f:
+                f.write('a {}')
+            with patch('subprocess.Popen', side_effect=OSError) as popen:
+                self.assertNotEqual(fingerprint, snapshot.get_fingerprint())
+            self.assertEqual(popen.call_args[0][0], ['lessc', '--version'])
+
+    def test_unsafe_paths(self):
+        path = self.export().format(fingerprint=snapshot.get_fingerprint())
+        with tarfile.open(path, 'r:gz') as source:
+            members = [(m, source.extractfile(m).read())
+                       for m in source.getmembers()]
+        with tarfile.open(path, 'w:gz') as target:
+            for member, content in members:
+                target.addfile(member, io.BytesIO(content))
+            member.name = 'root/../../escaped.txt'
+            target.addfile(member, io.BytesIO(content))
+        with self.assertRaises(CommandError):
+            self.call('preprocess_static_import', path)
+        # Nothing is written once an unsafe path has been found
+        self.assertFalse(os.path.exists(self.state_file))
+        self.assertFalse(os.path.exists(self.post))
+
+    def test_clears_root(self):
+        archive = self.export()
+        os.makedirs(self.post)
+        stale = os.path.join(self.post, 'stale.out')
+        with open(stale, 'w') as f:
+            f.write('stale')
+        self.call('preprocess_static_import', archive, clear=False)
+        self.assertTrue(os.path.exists(stale))
+        self.call('preprocess_static_import', archive)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.post, 'concatenated.out')))
+
+
+class TestFileSet(TestCase):
+
+    def test_membership_and_order(self):
+        files = FileSet(['b.css', 'css/a.css', 'css/b.css'])
+        self.assertTrue(files.add('a.css'))
+        self.assertFalse(files.add('css/a.css'))
+        self.assertEqual(
+            list(files), ['b.css', 'css/a.css', 'css/b.css', 'a.css'])
+        self.assertEqual(len(files), 4)
+        self.assertIn('css/b.css', files)
+        self.assertNotIn('css', files)
+        self.assertNotIn('js/a.js', files)
+
+    def test_discard(self):
+        files = FileSet(['a.css', 'css/a.css'])
+        files.discard('a.css')
+        files.discard('missing.css')
+        self.assertEqual(list(files), ['css/a.css'])
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files.add('a.css'))
+        self.assertEqual(list(files), ['css/a.css', 'a.css'])
+
+    def test_storages(self):
+        storage = StaticPreprocessorFileStorage(location=TEST_PROJECT)
+        prefixed = StaticPreprocessorFileStorage(location=TEST_PROJECT)
+        prefixed.prefix = 'prefix'
+        files = FileSet()
+        files.add('a.css', storage)
+        files.add('prefix/css/a.css', prefixed)
+        files.add('prefix/css/b.css', prefixed)
+        files.add('c.css')
+        self.assertEqual(len(files._storages), 2)
+        self.assertIs(files.get_storage('a.css'), storage)
+        self.assertEqual(
+            files.get_source('prefix/css/b.css'), (prefixed, 'css/b.css'))
+        self.assertEqual(files.get_source('c.css'), (None, 'c.css'))
+
+
+@override_settings(
+    STATIC_PREPROCESSOR_ROOT=os.path.join(TEST_PROJECT, 'processedstatic'),
+)
+class TestImageProcessors(TestCase):
+
+    def setUp(self):
+        self.post = os.path.join(TEST_PROJECT, 'processedstatic')
+        self.cache_dir = tempfile.mkdtemp()
+        shutil.rmtree(self.post, ignore_errors=True)
+        os.makedirs(os.path.join(self.post, 'img'))
+        self.images = {}
+        for i in range(4):
+            name = os.path.join('img', 'image{0}.png'.format(i))
+            self.images[name] = make_png(8 + i, 8, text=b'x' * 100)
+            self.write(name, self.images[name])
+
+    def tearDown(self):
+        for dir in (self.post, self.cache_dir):
+            shutil.rmtree(dir, ignore_errors=True)
+
+    def write(self, name, content):
+        with open(os.path.join(self.post, name), 'wb') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.post, name), 'rb') as f:
+            return f.read()
+
+    def test_png_recompressed_in_parallel(self):
+        processor = images.PNGProcessor(workers=2)
+        with patch.object(processor, 'get_encoder',
+                          return_value=recompress_png):
+            processor.handle()
+        for name, content in self.images.items():
+            self.assertEqual(self.read(name), recompress_png(content))
+            self.assertTrue(len(self.read(name)) < len(content))
+
+    def test_larger_results_discarded(self):
+        processor = images.PNGProcessor(workers=1)
+        with patch.object(processor, 'get_encoder',
+                          return_value=lambda content: content + b'x'):
+            processor.handle()
+        for name, content in self.images.items():
+            self.assertEqual(self.read(name), content)
+
+    def test_results_cached(self):
+        encoder = MagicMock(side_effect=recompress_png, __name__='encoder')
+        with override_settings(
+                STATIC_PREPROCESSOR_CACHE=FileSystemCompileCache(
+                    self.cache_dir)):
+            processor = images.PNGProcessor(workers=1)
+            with patch.object(processor, 'get_encoder', return_value=encoder):
+                processor.handle()
+                self.assertEqual(encoder.call_count, 4)
+                for name, content in self.images.items():
+                    self.write(name, content)
+                self.write('img/image0.png', make_png(32, 32, text=b'y'))
+                processor.handle()
+                self.assertEqual(encoder.call_count, 5)
+        for name, content in self.images.items():
+            if name != 'img/image0.png':
+                self.assertEqual(self.read(name), recompress_png(content))
+
+    def test_duplicates_encoded_once(self):
+        self.write('img/copy.png', self.images['img/image1.png'])
+        encoder = MagicMock(side_effect=recompress_png, __name__='encoder')
+        processor = images.PNGProcessor(workers=1)
+        with patch.object(processor, 'get_encoder', return_value=encoder):
+            processor.handle()
+        self.assertEqual(encoder.call_count, 4)
+        self.assertEqual(
+            self.read('img/copy.png'),
+            recompress_png(self.images['img/image1.png']))
+
+    def test_workers_read_paths(self):
+        with patch.object(images, '_encode',
+                          side_effect=images._encode) as encode:
+            processor = images.PNGProcessor(workers=1)
+            with patch.object(processor, 'get_encoder',
+                              return_value=recompress_png):
+                processor.handle()
+        self.assertEqual(
+            sorted(args[0][1] for args, kwargs in encode.call_args_list),
+            sorted(os.path.join(self.post, name) for name in self.images))
+        for name, content in self.images.items():
+            self.assertEqual(self.read(name), recompress_png(content))
+
+    def test_webp_variants(self):
+        processor = images.WebPProcessor(workers=1)
+        with patch.object(processor, 'get_encoder', return_value=fake_webp):
+            processor.handle()
+        for name, content in self.images.items():
+            self.assertEqual(self.read(name), content)
+            self.assertEqual(
+                self.read(name[:-4] + '.webp'), b'RIFFWEBP\x89PNG')
+
+    def test_command_encoder(self):
+        encoder = images.CommandEncoder('cp {input} {output}', suffix='.png')
+        self.assertEqual(encoder(b'content'), b'content')
+        encoder = images.CommandEncoder('true {input}')
+        self.assertEqual(encoder(b'in place'), b'in place')
+        with self.assertRaises(RuntimeError):
+            images.CommandEncoder('false')(b'content')
+
+    def test_command_encoder_limits(self):
+        encoder = images.PNGProcessor(timeout=0.1, retries=1).get_encoder()
+        self.assertEqual(encoder.runner.timeout, 0.1)
+        self.assertEqual(encoder.runner.retries, 1)
+        encoder = images.CommandEncoder(
+            'sleep 5', runner=CommandRunner(timeout=0.1))
+        with self.assertRaises(RuntimeError) as cm:
+            encoder(b'content')
+        self.assertIn('timed out', str(cm.exception))
+
+    def test_encoders(self):
+        self.assertEqual(
+            images.PNGProcessor().get_encoder().command,
+            'optipng -quiet -o2 {input}')
+        self.assertEqual(
+            images.JPEGProcessor().get_encoder().command,
+            'jpegtran -copy none -optimize -progressive '
+            '-outfile {output} {input}')
+        self.assertEqual(
+            images.WebPProcessor(lossless=True).get_encoder().command,
+            'cwebp -quiet -lossless {input} -o {output}')
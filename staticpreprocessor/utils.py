@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import fnmatch
+import gzip
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+
+from staticpreprocessor.patterns import PatternSet
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class _FileEntry(object):
+
+    __slots__ = ('directory', 'name', 'storage')
+
+    def __init__(self, directory, name, storage):
+        self.directory = directory
+        self.name = name
+        self.storage = storage
+
+
+class FileSet(object):
+    '''
+    A compact, insertion-ordered set of relative file paths, each optionally
+    tagged with the storage it was found in.
+
+    Each directory is stored once and shared by the entries for the files in
+    it, and storages are referred to by index rather than held by every
+    entry, so that sets of hundreds of thousands of files stay small.
+    Membership checks are constant time.
+    '''
+
+    def __init__(self, paths=()):
+        self._directories = []
+        self._directory_ids = {}
+        # One dictionary of file name to entry per directory
+        self._names = []
+        self._storages = []
+        self._storage_ids = {}
+        self._entries = []
+        self._length = 0
+        for path in paths:
+            self.add(path)
+
+    def _split(self, path):
+        directory, name = os.path.split(path)
+        return self._directory_ids.get(directory), name
+
+    def _lookup(self, path):
+        directory_id, name = self._split(path)
+        if directory_id is None:
+            return None
+        return self._names[directory_id].get(name)
+
+    def add(self, path, storage=None):
+        '''
+        Adds ``path``, found in ``storage``, to the set. Returns ``False``
+        without changing anything if ``path`` is already in the set.
+        '''
+        directory, name = os.path.split(path)
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = len(self._directories)
+            self._directories.append(directory)
+            self._directory_ids[directory] = directory_id
+            self._names.append({})
+        elif name in self._names[directory_id]:
+            return False
+        storage_id = None
+        if storage is not None:
+            storage_id = self._storage_ids.get(id(storage))
+            if storage_id is None:
+                storage_id = len(self._storages)
+                self._storages.append(storage)
+                self._storage_ids[id(storage)] = storage_id
+        entry = _FileEntry(directory_id, name, storage_id)
+        self._names[directory_id][name] = entry
+        self._entries.append(entry)
+        self._length += 1
+        return True
+
+    def discard(self, path):
+        '''
+        Removes ``path`` from the set if it is present.
+        '''
+        entry = self._lookup(path)
+        if entry is not None:
+            del self._names[entry.directory][entry.name]
+            # Removed entries are skipped when iterating
+            entry.name = None
+            self._length -= 1
+
+    def get_storage(self, path):
+        '''
+        Returns the storage ``path`` was added with, or ``None``.
+        '''
+        entry = self._lookup(path)
+        if entry is None or entry.storage is None:
+            return None
+        return self._storages[entry.storage]
+
+    def get_source(self, path):
+        '''
+        Returns a ``(storage, source_path)`` pair for ``path``, where
+        ``source_path`` is ``path`` without the storage's prefix, if any.
+        '''
+        storage = self.get_storage(path)
+        prefix = getattr(storage, 'prefix', None)
+        if prefix:
+            path = path[len(os.path.join(prefix, '')):]
+        return storage, path
+
+    def __contains__(self, path):
+        return self._lookup(path) is not None
+
+    def __iter__(self):
+        for entry in self._entries:
+            if entry.name is not None:
+                directory = self._directories[entry.directory]
+                if directory:
+                    yield os.path.join(directory, entry.name)
+                else:
+                    yield entry.name
+
+    def __len__(self):
+        return self._length
+
+
+def compile_patterns(patterns):
+    '''
+    Compiles a list of glob-type ``patterns`` into a single regex matching
+    any one of them, or ``None`` if there are no patterns.
+    '''
+    if not patterns:
+        return None
+    return re.compile('|'.join(
+        '(?:{0})'.format(fnmatch.translate(p)) for p in patterns))
+
+
+def file_hash(path, chunk_size=64 * 1024):
+    '''
+    Returns the hex SHA1 digest of the content of the file at ``path``.
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_mtime(path):
+    '''
+    Returns the modification time of ``path``, or ``None`` if it doesn't
+    exist.
+    '''
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def is_local_storage(storage):
+    '''
+    Returns whether ``storage`` keeps its files at local paths.
+    '''
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+def break_link(path):
+    '''
+    Replaces the file at ``path``, if it is one of several hard links to the
+    same file, with a copy of its own, so that modifying it in place leaves
+    the other links alone. Returns whether the link was broken.
+    '''
+    if os.stat(path).st_nlink < 2:
+        return False
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        shutil.copy2(path, tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True
+
+
+def in_shard(name, shard):
+    '''
+    Returns whether ``name`` belongs to ``shard``, an ``(index, count)``
+    pair with a zero-based index. Every name belongs to exactly one of the
+    ``count`` shards, and always the same one.
+    '''
+    index, count = shard
+    digest = hashlib.sha1(name.replace(os.sep, '/').encode('utf-8'))
+    return int(digest.hexdigest(), 16) % count == index
+
+
+def gzip_size(content):
+    '''
+    Returns the size in bytes of ``content`` once gzipped.
+    '''
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+        f.write(content)
+    return len(buffer.getvalue())
+
+
+def _iter_dir(path):
+    '''
+    Yields ``(name, is_dir)`` pairs for the entries of ``path``.
+
+    ``os.scandir`` (or the ``scandir`` backport) is used where available so
+    that the file type comes from the cached directory entry rather than a
+    separate ``stat`` call.
+    '''
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir()
+    else:  # pragma: no cover
+        for name in os.listdir(path):
+            yield name, os.path.isdir(os.path.join(path, name))
+
+
+def walk_files(root, ignore_patterns=None, location=''):
+    '''
+    Lazily yields the paths, relative to ``root``, of all files below
+    ``location`` in ``root``.
+
+    ``ignore_patterns`` is a list of gitignore-style patterns or a
+    ``PatternSet``. Ignored directories are never descended into.
+    '''
+    ignore = PatternSet.coerce(ignore_patterns)
+    stack = [location]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = _iter_dir(os.path.join(root, current))
+            for name, is_dir in entries:
+                path = os.path.join(current, name) if current else name
+                if ignore is not None and \
+                        ignore.match(path.replace(os.sep, '/'), is_dir):
+                    continue
+                if is_dir:
+                    stack.append(path)
+                else:
+                    yield path
+        except OSError:
+            continue
+
+
+def get_files(storage, ignore_patterns=None, location=''):
+    '''
+    Lazily yields the paths of the files in ``storage`` below ``location``,
+    joined to ``location``, using the storage API in the same way as
+    ``django.contrib.staticfiles.utils.get_files``.
+
+    ``ignore_patterns`` is a list of gitignore-style patterns or a
+    ``PatternSet``, matched against paths relative to ``location``. Ignored
+    directories are never listed.
+    '''
+    ignore = PatternSet.coerce(ignore_patterns)
+    stack = [(location, '')]
+    while stack:
+        current, relative = stack.pop()
+        directories, files = storage.listdir(current)
+        for name in files:
+            path = '/'.join((relative, name)) if relative else name
+            if ignore is None or not ignore.match(path):
+                yield os.path.join(current, name) if current else name
+        for name in reversed(directories):
+            path = '/'.join((relative, name)) if relative else name
+            if ignore is None or not ignore.match(path, is_dir=True):
+                stack.append(
+                    (os.path.join(current, name) if current else name, path))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+from staticpreprocessor import processors
+from staticpreprocessor.storage import StaticPreprocessorFileStorage
+
+
+class Variant(object):
+    '''
+    A named configuration of processors that is run on a copy of the
+    processed files in its own ``root``, e.g. a debug or a release build,
+    or a theme.
+    '''
+
+    def __init__(self, name, root, processors=()):
+        self.name = name
+        self.root = root
+        self.processors = list(processors)
+        self.storage = StaticPreprocessorFileStorage(location=root)
+
+    def __repr__(self):
+        return 'Variant({0!r})'.format(self.name)
+
+    def get_processors(self, lazy=False):
+        '''
+        Returns the variant's processors, working in its root.
+        '''
+        return processors.get_processors(
+            lazy, self.processors, self.storage)
+
+
+def get_variants(names=None):
+    '''
+    Returns a :py:class:`Variant` for each of ``names``, by default every
+    variant in the ``STATIC_PREPROCESSOR_VARIANTS`` setting, ordered by
+    name.
+
+    The setting maps each variant's name to a dictionary giving its
+    ``ROOT``, which must differ from ``STATIC_PREPROCESSOR_ROOT`` and from
+    every other variant's, and its ``PROCESSORS``.
+    '''
+    from staticpreprocessor.conf import settings
+    configured = settings.STATIC_PREPROCESSOR_VARIANTS or {}
+    roots = set([os.path.abspath(settings.STATIC_PREPROCESSOR_ROOT)])
+    variants = []
+    for name in sorted(configured):
+        options = configured[name]
+        try:
+            root = options['ROOT']
+            variant = Variant(name, root, options.get('PROCESSORS', ()))
+        except (KeyError, TypeError, AttributeError):
+            raise ImproperlyConfigured(
+                'Variant "{0}" must be a dictionary with a ROOT'.format(name))
+        if os.path.abspath(root) in roots:
+            raise ImproperlyConfigured(
+                'The ROOT of variant "{0}" must differ from '
+                'STATIC_PREPROCESSOR_ROOT and from those of the other '
+                'variants'.format(name))
+        roots.add(os.path.abspath(root))
+        variants.append(variant)
+    if names is not None:
+        unknown = set(names) - set(configured)
+        if unknown:
+            raise ImproperlyConfigured('Unknown variant(s): {0}'.format(
+                ', '.join(sorted(unknown))))
+        variants = [v for v in variants if v.name in names]
+    return variants